@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark reprodutível do processador de Notas Fiscais
+Gera um corpus sintético determinístico de DANFEs (imagens, PDFs digitais e PDFs
+escaneados) com gabarito conhecido, mede cada estágio do pipeline isoladamente e
+de ponta a ponta, e grava um relatório JSON comparável entre commits.
+
+Uso:
+    python py/bench_nf.py -n 40 --output bench_atual.json
+    python py/bench_nf.py -n 40 --output bench_novo.json --compare bench_atual.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import platform
+import argparse
+import tempfile
+import subprocess
+
+import cv2
+import numpy as np
+import fitz
+
+try:
+    import resource  # indisponível no Windows
+except ImportError:
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import index_nf  # noqa: E402
+
+UFS_IBGE = {'35': 'SP', '33': 'RJ', '31': 'MG', '41': 'PR', '43': 'RS', '29': 'BA'}
+
+# ------------------------------ Corpus Sintético ------------------------------
+def mod11_dv(digits):
+    """Dígito verificador módulo 11 com pesos 2..9 da direita para a esquerda"""
+    rest = sum(int(d) * (2 + i % 8) for i, d in enumerate(reversed(digits))) % 11
+    return '0' if rest < 2 else str(11 - rest)
+
+def cnpj_with_dv(base12):
+    """Completa 12 dígitos com os dois dígitos verificadores do CNPJ"""
+    digits = base12 + mod11_dv(base12)
+    return digits + mod11_dv(digits)
+
+def chave_with_dv(base43):
+    """Completa 43 dígitos com o dígito verificador da chave de acesso"""
+    return base43 + mod11_dv(base43)
+
+def format_cnpj(cnpj):
+    return f"{cnpj[:2]}.{cnpj[2:5]}.{cnpj[5:8]}/{cnpj[8:12]}-{cnpj[12:]}"
+
+def format_money(value):
+    inteiro, centavos = f"{value:.2f}".split('.')
+    return f"{int(inteiro):,}".replace(',', '.') + ',' + centavos
+
+def make_invoice(rng):
+    """Gera (gabarito, linhas) de uma DANFE com o layout típico da saída do OCR"""
+    cuf = rng.choice(sorted(UFS_IBGE))
+    year, month, day = rng.randint(2019, 2024), rng.randint(1, 12), rng.randint(1, 28)
+    cnpj_emit = cnpj_with_dv(''.join(str(rng.randint(0, 9)) for _ in range(8)) + '0001')
+    cnpj_dest = cnpj_with_dv(''.join(str(rng.randint(0, 9)) for _ in range(8)) + '0001')
+    serie, numero = rng.randint(1, 9), rng.randint(1, 999999)
+    chave = chave_with_dv(f"{cuf}{year % 100:02d}{month:02d}{cnpj_emit}55{serie:03d}{numero:09d}1"
+                          f"{rng.randint(0, 99999999):08d}")
+    items = []
+    for i in range(rng.randint(3, 25)):
+        qtd, unit = rng.randint(1, 50), rng.randint(100, 99999) / 100
+        items.append((i, f"PRODUTO {i} MODELO {rng.randint(100, 999)}", rng.randint(10000000, 99999999),
+                      qtd, unit, round(qtd * unit, 2)))
+    total = round(sum(item[-1] for item in items), 2)
+
+    truth = {
+        'chave_acesso': chave,
+        'cnpj_emitente': cnpj_emit,
+        'cnpj_destinatario': cnpj_dest,
+        'numero_nf': str(numero),
+        'serie': str(serie),
+        'uf': UFS_IBGE[cuf],
+        'data_emissao': f"{year}-{month:02d}-{day:02d}",
+        'valor_total': total,
+        'n_itens': len(items),
+    }
+    lines = [
+        "DANFE - DOCUMENTO AUXILIAR DA NOTA FISCAL ELETRONICA",
+        f"No {numero:09d} SERIE {serie}",
+        "EMPRESA ALFA COMERCIO LTDA",
+        f"CNPJ {format_cnpj(cnpj_emit)}",
+        "RUA DAS FLORES 123",
+        f"CENTRO, {UFS_IBGE[cuf]}",
+        "CHAVE DE ACESSO",
+        ' '.join(chave[i:i + 4] for i in range(0, 44, 4)),
+        "DESTINATARIO / REMETENTE",
+        "CLIENTE BETA SERVICOS S/A",
+        f"CNPJ/CPF {format_cnpj(cnpj_dest)} DATA DA EMISSAO {day:02d}/{month:02d}/{year}",
+        "CALCULO DO IMPOSTO",
+        f"VALOR TOTAL DA NOTA {format_money(total)}",
+        "DADOS DOS PRODUTOS/SERVICOS",
+        "CODIGO DESCRICAO NCM CFOP UN QTD V.UNIT V.TOTAL",
+    ]
+    for i, descricao, ncm, qtd, unit, vl_total in items:
+        lines.append(f"{i:04d} {descricao} {ncm} 5102 UN {qtd},0000 {format_money(unit)} {format_money(vl_total)}")
+    lines += ["DADOS ADICIONAIS", "INFORMACOES COMPLEMENTARES: DOCUMENTO EMITIDO POR ME OU EPP"]
+    return truth, lines
+
+def render_lines(lines, width=1700, line_height=34, noise=0.0, skew=0.0, rng=None):
+    """Desenha as linhas numa página branca (escala de cinza), com ruído/inclinação opcionais"""
+    height = max(2200, 120 + line_height * len(lines))
+    img = np.full((height, width), 255, np.uint8)
+    for i, line in enumerate(lines):
+        cv2.putText(img, line[:100], (60, 100 + i * line_height), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.75, 0, 2, cv2.LINE_AA)
+    if skew:
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), skew, 1.0)
+        img = cv2.warpAffine(img, matrix, (width, height), borderValue=255)
+    if noise:
+        gen = np.random.default_rng(rng.randint(0, 2**31) if rng else 0)
+        img = np.clip(img + gen.normal(0, noise, img.shape), 0, 255).astype(np.uint8)
+    return img
+
+def write_text_pdf(path, lines):
+    """PDF digital: texto real, com camada de texto"""
+    doc = fitz.open()
+    page = doc.new_page()
+    y = 40
+    for line in lines:
+        if y > 810:
+            page = doc.new_page()
+            y = 40
+        page.insert_text((30, y), line, fontsize=8)
+        y += 11
+    doc.save(path)
+    doc.close()
+
+def write_scanned_pdf(path, img):
+    """PDF escaneado: só a imagem da página, sem camada de texto"""
+    doc = fitz.open()
+    page = doc.new_page()
+    ok, png = cv2.imencode('.png', img)
+    page.insert_image(page.rect, stream=png.tobytes())
+    doc.save(path)
+    doc.close()
+
+def generate_corpus(corpus_dir, n, seed, noise=8.0, max_skew=1.5):
+    """Gera o corpus (idempotente para a mesma semente) e retorna o gabarito por arquivo"""
+    truth_path = os.path.join(corpus_dir, 'gabarito.json')
+    if os.path.exists(truth_path):
+        with open(truth_path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('seed') == seed and data.get('n') == n:
+            return data['arquivos']
+    os.makedirs(corpus_dir, exist_ok=True)
+    rng = random.Random(seed)
+    files = {}
+    for i in range(n):
+        truth, lines = make_invoice(rng)
+        kind = ('pdf_texto', 'pdf_escaneado', 'imagem', 'imagem_ruido')[i % 4]
+        if kind == 'pdf_texto':
+            name = f'nf{i:04d}_texto.pdf'
+            write_text_pdf(os.path.join(corpus_dir, name), lines)
+        elif kind == 'pdf_escaneado':
+            name = f'nf{i:04d}_escaneado.pdf'
+            write_scanned_pdf(os.path.join(corpus_dir, name), render_lines(lines))
+        elif kind == 'imagem':
+            name = f'nf{i:04d}.png'
+            cv2.imwrite(os.path.join(corpus_dir, name), render_lines(lines))
+        else:
+            name = f'nf{i:04d}_ruido.png'
+            img = render_lines(lines, noise=noise, skew=rng.uniform(-max_skew, max_skew), rng=rng)
+            cv2.imwrite(os.path.join(corpus_dir, name), img)
+        files[name] = dict(truth, tipo_arquivo=kind, texto='\n'.join(lines))
+    with open(truth_path, 'w', encoding='utf-8') as f:
+        json.dump({'seed': seed, 'n': n, 'arquivos': files}, f, ensure_ascii=False, indent=2)
+    return files
+
+# ------------------------------ Medição ------------------------------
+class Cronometro:
+    """Acumula latências (segundos) por estágio"""
+
+    def __init__(self):
+        self.samples = {}
+
+    def measure(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        report = {}
+        for stage, values in self.samples.items():
+            arr = np.array(values) * 1000
+            report[stage] = {
+                'n': len(values),
+                'media_ms': round(float(arr.mean()), 3),
+                'p50_ms': round(float(np.percentile(arr, 50)), 3),
+                'p90_ms': round(float(np.percentile(arr, 90)), 3),
+                'p99_ms': round(float(np.percentile(arr, 99)), 3),
+                'max_ms': round(float(arr.max()), 3),
+            }
+        return report
+
+def tesseract_available():
+    try:
+        index_nf.pytesseract.get_tesseract_version()
+        return True
+    except Exception:
+        return index_nf.tesserocr is not None
+
+def peak_rss_mb():
+    """Pico de memória residente do processo e dos workers já encerrados"""
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return {'principal': round(own, 1), 'workers': round(children, 1)}
+
+def field_matches(field, expected, found):
+    if found is None:
+        return False
+    if field == 'valor_total':
+        return abs(float(found) - expected) < 0.005
+    return str(found) == str(expected)
+
+ACCURACY_FIELDS = ('chave_acesso', 'cnpj_emitente', 'cnpj_destinatario', 'numero_nf',
+                   'serie', 'uf', 'data_emissao', 'valor_total')
+
+def accuracy(results, truth):
+    """Acurácia por campo (fração de arquivos com o valor correto)"""
+    report = {}
+    for field in ACCURACY_FIELDS:
+        hits = sum(field_matches(field, truth[name][field], (results.get(name) or {}).get(field))
+                   for name in truth)
+        report[field] = round(hits / len(truth), 4) if truth else None
+    report['arquivos_com_resultado'] = sum(1 for name in truth if results.get(name))
+    return report
+
+def bench_stages(corpus_dir, truth, opts, with_ocr):
+    """Mede cada estágio isoladamente, arquivo a arquivo, no processo atual"""
+    timer = Cronometro()
+    for name, expected in truth.items():
+        path = os.path.join(corpus_dir, name)
+        timer.measure('hash', index_nf.sha256_file, path)
+        timer.measure('parse', index_nf.parse_invoice_data, expected['texto'], name)
+        if name.endswith('.pdf'):
+            with fitz.open(path) as doc:
+                page = doc.load_page(0)
+                timer.measure('text_layer', index_nf.page_text_layer, page)
+                img = timer.measure('render_pdf', index_nf.render_page, page, opts.dpi)
+        else:
+            img = timer.measure('decode_imagem', cv2.imread, path)
+        processed = timer.measure('preprocess', index_nf.advanced_preprocess, img)
+        if with_ocr:
+            timer.measure('ocr', index_nf.recognize, processed, opts)
+    return timer.summary()
+
+def bench_end_to_end(corpus_dir, truth, opts):
+    """Pipeline completo (process_single_file) no processo atual, arquivo a arquivo"""
+    timer = Cronometro()
+    results = {}
+    for name in truth:
+        invoice_data, _ = timer.measure('ponta_a_ponta', index_nf.process_single_file,
+                                        os.path.join(corpus_dir, name), opts)
+        results[name] = invoice_data
+    return timer.summary()['ponta_a_ponta'], results
+
+def bench_throughput(corpus_dir, truth, opts, workers):
+    """Vazão de process_files com um pool de workers"""
+    paths = [os.path.join(corpus_dir, name) for name in truth]
+    start = time.perf_counter()
+    index_data, _ = index_nf.process_files(paths, max_workers=workers, opts=opts)
+    elapsed = time.perf_counter() - start
+    pages = sum(invoice.get('paginas_processadas') or 1 for invoice in index_data)
+    return {
+        'workers': workers,
+        'arquivos': len(paths),
+        'segundos': round(elapsed, 3),
+        'paginas': pages,
+        'paginas_por_s': round(pages / elapsed, 3) if elapsed else None,
+        'arquivos_por_s': round(len(paths) / elapsed, 3) if elapsed else None,
+    }
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except Exception:
+        return None
+
+def compare_reports(current, baseline):
+    """Imprime a variação de latência/vazão/acurácia em relação a um relatório anterior"""
+    print(f"\nComparação com {baseline['meta'].get('commit')} -> {current['meta'].get('commit')}")
+    for stage, stats in current['estagios'].items():
+        old = baseline['estagios'].get(stage)
+        if old and old['p50_ms']:
+            delta = (stats['p50_ms'] - old['p50_ms']) / old['p50_ms'] * 100
+            print(f"  {stage:<15} p50 {old['p50_ms']:>9.3f} -> {stats['p50_ms']:>9.3f} ms ({delta:+.1f}%)")
+    old, new = baseline.get('vazao') or {}, current.get('vazao') or {}
+    if old.get('paginas_por_s') and new.get('paginas_por_s'):
+        print(f"  vazão           {old['paginas_por_s']} -> {new['paginas_por_s']} páginas/s")
+    for field, value in current['acuracia'].items():
+        old_value = baseline['acuracia'].get(field)
+        if old_value is not None and old_value != value:
+            print(f"  acurácia {field}: {old_value} -> {value}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark do processador de Notas Fiscais')
+    parser.add_argument('-n', '--documents', type=int, default=40, help='Documentos no corpus sintético')
+    parser.add_argument('--seed', type=int, default=42, help='Semente do corpus')
+    parser.add_argument('--corpus', help='Diretório do corpus (padrão: temporário, apagado ao final)')
+    parser.add_argument('--noise', type=float, default=8.0, help='Desvio do ruído gaussiano nas imagens ruidosas')
+    parser.add_argument('--skew', type=float, default=1.5, help='Inclinação máxima (graus) nas imagens ruidosas')
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Workers na medição de vazão')
+    parser.add_argument('--no-ocr', action='store_true', help='Não mede estágios que dependem do Tesseract')
+    parser.add_argument('--layout', action='store_true', help='OCR com layout (zonas da DANFE) em vez das passadas cegas')
+    parser.add_argument('--output', help='Grava o relatório JSON neste arquivo')
+    parser.add_argument('--compare', metavar='JSON', help='Relatório anterior para comparação')
+    args = parser.parse_args()
+
+    corpus_dir = args.corpus or tempfile.mkdtemp(prefix='bench_nf_')
+    truth = generate_corpus(corpus_dir, args.documents, args.seed, args.noise, args.skew)
+    with_ocr = not args.no_ocr and tesseract_available()
+    # Sem OCR, só entram no ponta a ponta os PDFs com camada de texto
+    e2e_truth = truth if with_ocr else {name: t for name, t in truth.items() if t['tipo_arquivo'] == 'pdf_texto'}
+
+    opts = index_nf.OpcoesProcessamento(layout=args.layout)
+    try:
+        stages = bench_stages(corpus_dir, truth, opts, with_ocr)
+        stages['ponta_a_ponta'], results = bench_end_to_end(corpus_dir, e2e_truth, opts)
+        throughput = bench_throughput(corpus_dir, e2e_truth, opts, args.workers)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': git_revision(),
+            'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'seed': args.seed,
+            'documentos': len(truth),
+            'documentos_ponta_a_ponta': len(e2e_truth),
+            'ocr': with_ocr,
+            'layout': args.layout,
+            'corpus_sha256': hashlib.sha256(
+                json.dumps(sorted(truth), ensure_ascii=False).encode('utf-8')).hexdigest()[:16],
+        },
+        'estagios': stages,
+        'vazao': throughput,
+        'pico_rss_mb': peak_rss_mb(),
+        'acuracia': accuracy(results, e2e_truth),
+    }
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare_reports(report, json.load(f))
+
+if __name__ == "__main__":
+    main()
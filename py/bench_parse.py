@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark do parsing de Notas Fiscais
+Mede o tempo por documento de parse_invoice_data + parse_items_detailed sobre um
+corpus sintético determinístico e confere a saída com a esperada para o corpus
+padrão (bench_parse_esperado.json). Opcionalmente mede outra revisão git: a
+comparação com ela é só de tempo, já que a saída muda entre versões do parsing.
+
+Uso:
+    python py/bench_parse.py                      # tempo + conferência com a saída esperada
+    python py/bench_parse.py --baseline HEAD~1    # tempo antes x depois
+    python py/bench_parse.py --update-expected    # regrava a saída esperada (mudança intencional)
+"""
+
+import os
+import sys
+import json
+import hashlib
+import random
+import argparse
+import subprocess
+import tempfile
+import importlib.util
+import time
+from dataclasses import asdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import index_nf  # noqa: E402
+
+# Saída esperada do corpus sintético: um resumo do JSON canônico por documento
+ESPERADO_PATH = os.path.join(HERE, 'bench_parse_esperado.json')
+
+# ------------------------------ Corpus Sintético ------------------------------
+def random_cnpj(rng):
+    return (f"{rng.randint(10, 99)}.{rng.randint(100, 999)}.{rng.randint(100, 999)}"
+            f"/0001-{rng.randint(10, 99)}")
+
+def make_invoice_text(rng):
+    """Gera o texto de uma DANFE com o layout típico da saída do OCR"""
+    chave = ''.join(str(rng.randint(0, 9)) for _ in range(44))
+    lines = [
+        "DANFE",
+        "DOCUMENTO AUXILIAR DA NOTA FISCAL ELETRÔNICA",
+        f"Nº {rng.randint(1, 999999):09d} SÉRIE {rng.randint(1, 9)}",
+        "EMPRESA ALFA COMÉRCIO LTDA",
+        f"CNPJ {random_cnpj(rng)}",
+        "RUA DAS FLORES, 123",
+        "SÃO PAULO, SP",
+        "CHAVE DE ACESSO",
+        ' '.join(chave[i:i + 4] for i in range(0, 44, 4)),
+        "DESTINATÁRIO / REMETENTE",
+        "CLIENTE BETA SERVIÇOS S/A",
+        f"CNPJ/CPF {random_cnpj(rng)} DATA DA EMISSÃO {rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2023",
+        "INSCRIÇÃO ESTADUAL 123.456.789.110",
+        "CÁLCULO DO IMPOSTO",
+        f"VALOR TOTAL DOS PRODUTOS {rng.randint(100, 9999)},{rng.randint(10, 99)}",
+        f"VALOR TOTAL DA NOTA {rng.randint(100, 9999)},{rng.randint(10, 99)}",
+        "DADOS DOS PRODUTOS/SERVIÇOS",
+        "CÓDIGO DESCRIÇÃO NCM CST CFOP UN QTD V.UNIT V.TOTAL",
+    ]
+    for i in range(rng.randint(3, 30)):
+        lines.append(f"{i:04d} PRODUTO {i} DESCRIÇÃO {rng.randint(10000000, 99999999)} 000 5102 UN "
+                     f"{rng.randint(1, 50)},0000 {rng.randint(1, 999)},{rng.randint(10, 99)} "
+                     f"{rng.randint(1, 9999)},{rng.randint(10, 99)}")
+    lines += ["DADOS ADICIONAIS", "INFORMAÇÕES COMPLEMENTARES: " + "texto livre " * 20]
+    return '\n'.join(lines)
+
+def make_corpus(n, seed):
+    rng = random.Random(seed)
+    return [make_invoice_text(rng) for _ in range(n)]
+
+# ------------------------------ Medição ------------------------------
+def parse_document(module, text):
+    data = module.parse_invoice_data(text, 'bench.pdf')
+    items = module.parse_items_detailed(data.get('itens_raw'), data.get('chave_acesso'), data['arquivo'])
+    return data, [asdict(item) for item in items]
+
+def output_digest(module, text):
+    """Resumo (SHA256 do JSON canônico) da saída do parsing de um documento"""
+    payload = json.dumps(parse_document(module, text), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+def load_expected(path=ESPERADO_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def write_expected(corpus, seed, path=ESPERADO_PATH):
+    expected = {
+        'documentos': len(corpus),
+        'seed': seed,
+        'pipeline_version': index_nf.PIPELINE_VERSION,
+        'resumos': [output_digest(index_nf, text) for text in corpus],
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(expected, f, indent=0)
+        f.write('\n')
+    return expected
+
+def count_divergent(corpus, seed, expected):
+    """Documentos cuja saída difere da esperada; None se o corpus não está coberto"""
+    if expected is None or expected['seed'] != seed or len(corpus) > len(expected['resumos']):
+        return None
+    return sum(output_digest(index_nf, text) != digest for text, digest in zip(corpus, expected['resumos']))
+
+def time_module(module, corpus, repeat):
+    """Melhor tempo médio por documento (ms) entre ``repeat`` rodadas"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            parse_document(module, text)
+        best = min(best, (time.perf_counter() - start) / len(corpus))
+    return best * 1000
+
+def load_revision(rev):
+    """Carrega py/index_nf.py de uma revisão git como módulo separado"""
+    source = subprocess.run(
+        ['git', 'show', f'{rev}:py/index_nf.py'],
+        cwd=HERE, check=True, capture_output=True
+    ).stdout
+    path = os.path.join(tempfile.mkdtemp(prefix='bench_parse_'), 'index_nf_baseline.py')
+    with open(path, 'wb') as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location('index_nf_baseline', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark do parsing de Notas Fiscais')
+    parser.add_argument('-n', '--documents', type=int, default=500, help='Documentos no corpus sintético')
+    parser.add_argument('--seed', type=int, default=42, help='Semente do corpus')
+    parser.add_argument('--repeat', type=int, default=5, help='Rodadas (vale a melhor)')
+    parser.add_argument('--baseline', metavar='REV', help='Revisão git para comparar o tempo (ex.: HEAD~1)')
+    parser.add_argument('--expected', default=ESPERADO_PATH, metavar='ARQUIVO',
+                        help='Saída esperada do corpus (padrão: py/bench_parse_esperado.json)')
+    parser.add_argument('--update-expected', action='store_true',
+                        help='Regrava a saída esperada com a saída atual, após uma mudança intencional do parsing')
+    parser.add_argument('--json', action='store_true', help='Saída em JSON')
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.documents, args.seed)
+    report = {
+        'documentos': len(corpus),
+        'seed': args.seed,
+        'atual_ms_por_doc': round(time_module(index_nf, corpus, args.repeat), 4),
+    }
+
+    if args.update_expected:
+        write_expected(corpus, args.seed, args.expected)
+        report['esperado_gravado'] = args.expected
+    else:
+        divergentes = count_divergent(corpus, args.seed, load_expected(args.expected))
+        report['resultados_divergentes'] = 'corpus fora da saída esperada' if divergentes is None else divergentes
+
+    if args.baseline:
+        baseline = load_revision(args.baseline)
+        report['baseline'] = args.baseline
+        report['baseline_ms_por_doc'] = round(time_module(baseline, corpus, args.repeat), 4)
+        report['speedup'] = round(report['baseline_ms_por_doc'] / report['atual_ms_por_doc'], 2)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        for key, value in report.items():
+            print(f"{key}: {value}")
+
+if __name__ == "__main__":
+    main()
@@ -9,19 +9,48 @@ import os
 import re
 import json
 import glob
+import itertools
+import shutil
+import mmap
+import operator
+import copy
 import cv2
 import pandas as pd
 import numpy as np
 import hashlib
 import logging
+import csv
+import sqlite3
+import time
+import cProfile
+import queue
+import threading
+import zipfile
+import zlib
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager, nullcontext
+from collections import Counter
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple, Any
 import pytesseract
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import util as mp_util
 from unidecode import unidecode
-from dataclasses import dataclass
+from dataclasses import dataclass, field, fields, asdict
+from functools import lru_cache
 import fitz  # PyMuPDF para PDFs
 
+try:
+    import pyarrow as pa  # Parquet (opcional)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import tesserocr  # API C do Tesseract (opcional, evita um processo por chamada)
+except ImportError:
+    tesserocr = None
+
 # ------------------------------ Configuração ------------------------------
 logging.basicConfig(
     level=logging.INFO,
@@ -34,6 +63,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ------------------------------ Constantes/Regex ------------------------------
+# Incrementar sempre que uma mudança no OCR/parsing alterar os resultados gerados
+# (invalida automaticamente as entradas do cache de resultados)
+PIPELINE_VERSION = "2.11"
+
 UF_RE = r'\b(AC|AL|AP|AM|BA|CE|DF|ES|GO|MA|MT|MS|MG|PA|PB|PR|PE|PI|RJ|RN|RS|RO|RR|SC|SP|SE|TO)\b'
 CNPJ_RE = r'\b\d{2}\.?\d{3}\.?\d{3}\/?\d{4}-?\d{2}\b'
 CPF_RE = r'\b\d{3}\.?\d{3}\.?\d{3}-\d{2}\b'
@@ -51,6 +84,44 @@ VALOR_PATS = [
     r'VALOR\s+TOTAL\s+DOS\s+SERVI[CÇ]OS[:\s]*R?\$?\s*([0-9][0-9\.\,]*)',
 ]
 
+# Padrões pré-compilados usados no parsing (compilados uma vez por processo)
+CHAVE_RX = re.compile(r'(\d{44})')
+CNPJ_RX = re.compile(CNPJ_RE)
+CPF_RX = re.compile(CPF_RE)
+IE_RX = re.compile(IE_RE, re.IGNORECASE)
+UF_RX = re.compile(UF_RE)
+NUMERO_RX = re.compile(r'N[ºO]?\s*[:\-]?\s*(\d{1,3}(?:\.\d{3})+|\d{1,12})')
+SERIE_RX = re.compile(r'S[ÉE]RIE?\s*[:\-]?\s*(\d{1,5}|\w{1,3})')
+NON_ASCII_RX = re.compile(r'[^\x00-\x7f]+')
+NON_DIGIT_RX = re.compile(r'\D+')
+MONEY_CLEAN_RX = re.compile(r'[^\d,\.]')
+DOTTED_NUMBER_RX = re.compile(r'\d+\.\d+\.\d+')
+DIGITS4_RX = re.compile(r'\d{4,}')
+MUNICIPIO_RX = re.compile(r',\s*[A-Z][A-Z]\s*$')
+ROTULOS_RX = re.compile(r'\b(CNPJ|CPF|RAZAO SOCIAL)\b')
+ENDERECO_PREFIXOS = ('RUA ', 'AV ', 'AVENIDA ', 'RODOVIA ', 'TRAVESSA ')
+DATE_RXS = [
+    re.compile(r'(\d{2})[/\-](\d{2})[/\-](\d{2,4})'),
+    re.compile(r'(\d{4})[/\-](\d{2})[/\-](\d{2})'),
+    re.compile(r'(\d{2})\.(\d{2})\.(\d{4})'),
+]
+NCM_RX = re.compile(r'\b(\d{8})\b')
+CFOP_RX = re.compile(r'\b([123456]\d{3})\b')
+QTD_RX = re.compile(r'(\d+[,.]?\d*)\s*(KG|UN|M|M2|M3|LT|CX|PC)')
+ITEM_END_RX = re.compile(r'\d+[,.]\d{2}$')
+ITEM_VALUE_RXS = [
+    re.compile(r'(\d+[.,]\d{2})\s*$'),  # Valor no final da linha
+    re.compile(r'R\$\s*(\d+[.,]\d+)'),  # Formato R$
+    re.compile(r'(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})'),  # Formato com milhares
+]
+
+# Todos os VALOR_PATS numa única alternância percorrida uma vez; o grupo nomeado
+# v<i> identifica qual padrão casou (i = prioridade em VALOR_PATS)
+VALOR_RX = re.compile('|'.join(
+    re.sub(r'\((?!\?)', f'(?P<v{i}>', pattern, count=1) for i, pattern in enumerate(VALOR_PATS)
+))
+VALOR_RXS = [re.compile(pattern) for pattern in VALOR_PATS]
+
 ITEMS_START = [
     'DADOS DOS PRODUTOS/SERVI', 'DADOS DO PRODUTO/SERVI',
     'DADOS DOS PRODUTOS / SERVI', 'DISCRIMINAÇÃO DOS SERVIÇOS',
@@ -65,10 +136,133 @@ ITEMS_END = [
     'VALOR TOTAL', 'OBSERVACOES'
 ]
 
+# Configurações do Tesseract para diferentes tipos de conteúdo, na ordem padrão
+# de tentativa (psm 8, palavra única, raramente vence numa página inteira)
+OCR_CONFIGS = [
+    "--oem 3 --psm 6 -l por+eng",  # Padrão
+    "--oem 3 --psm 4 -l por+eng",  # Coluna única
+    "--oem 3 --psm 13 -l por+eng", # Linha bruta
+    "--oem 3 --psm 8 -l por+eng",  # Palavra única
+]
+
+# Pontuação de score_nf_text a partir da qual o OCR para (chave de acesso + CNPJ)
+OCR_EARLY_EXIT_SCORE = 150
+
+# Modo layout: passada única com caixas de palavras (segmentação automática) e
+# releitura de recortes de zona como bloco uniforme
+OCR_LAYOUT_CONFIG = "--oem 3 --psm 3 -l por+eng"
+# ocr_config das notas lidas no modo layout: o parsing trata o texto por zonas e colunas
+OCR_LAYOUT_ROTULO = 'layout'
+OCR_ROI_CONFIG = OCR_CONFIGS[0]
+# Zonas da DANFE na ordem da página, com os títulos (normalizados) que abrem cada uma;
+# o emitente vai do topo da página até o primeiro título encontrado
+ZONAS_DANFE = (
+    ('emitente', ()),
+    ('destinatario', ('DESTINATARIO',)),
+    ('fatura', ('FATURA',)),
+    ('totais', ('CALCULO DO IMPOSTO',)),
+    ('transporte', ('TRANSPORTADOR',)),
+    ('produtos', tuple(dict.fromkeys(unidecode(pattern) for pattern in ITEMS_START))),
+    ('adicionais', ('DADOS ADICIONAIS', 'INFORMACOES COMPLEMENTARES', 'CALCULO DO ISSQN', 'RESERVADO AO FISCO')),
+)
+# Zona relida quando a passada única não traz o campo crítico
+ZONA_CAMPO = {'chave': 'emitente', 'cnpj': 'emitente', 'valor_total': 'totais'}
+# Colunas da tabela de itens: (campo, rótulo no texto, padrão do cabeçalho); a ordem
+# resolve ambiguidades ('CODIGO PRODUTO' é código, 'VALOR UNIT' não é total)
+COLUNAS_ITENS = (
+    ('codigo', 'CODIGO', re.compile(r'\bCOD')),
+    ('vl_unit', 'V.UNIT', re.compile(r'UNIT')),
+    ('vl_total', 'V.TOTAL', re.compile(r'TOTAL')),
+    ('descricao', 'DESCRICAO', re.compile(r'DESCRI|DISCRIMINA|PRODUTO')),
+    ('ncm', 'NCM', re.compile(r'NCM')),
+    ('cst', 'CST', re.compile(r'\bCST|CSOSN')),
+    ('cfop', 'CFOP', re.compile(r'CFOP')),
+    ('qtd', 'QTD', re.compile(r'\bQ(?:TDE?|UANT)')),
+    ('unidade', 'UN', re.compile(r'\bUN(?:D|ID|IDADE)?\b')),
+)
+COLUNAS_ROTULOS = {campo: rotulo for campo, rotulo, _ in COLUNAS_ITENS}
+# Espaço entre palavras (em alturas de linha) a partir do qual começa outra coluna
+LAYOUT_ESPACO_COLUNA = 1.5
+
+# Larguras (barra, espaço, ...) em módulos de cada símbolo Code-128; 106 = stop
+CODE128_PADROES = (
+    '212222', '222122', '222221', '121223', '121322', '131222', '122213', '122312', '132212', '221213',
+    '221312', '231212', '112232', '122132', '122231', '113222', '123122', '123221', '223211', '221132',
+    '221231', '213212', '223112', '312131', '311222', '321122', '321221', '312212', '322112', '322211',
+    '212123', '212321', '232121', '111323', '131123', '131321', '112313', '132113', '132311', '211313',
+    '231113', '231311', '112133', '112331', '132131', '113123', '113321', '133121', '313121', '211331',
+    '231131', '213113', '213311', '213131', '311123', '311321', '331121', '312113', '312311', '332111',
+    '314111', '221411', '431111', '111224', '111422', '121124', '121421', '141122', '141221', '112214',
+    '112412', '122114', '122411', '142112', '142211', '241211', '221114', '413111', '241112', '134111',
+    '111242', '121142', '121241', '114212', '124112', '124211', '411212', '421112', '421211', '212141',
+    '214121', '412121', '111143', '111341', '131141', '114113', '114311', '411113', '411311', '113141',
+    '114131', '311141', '411131', '211412', '211214', '211232', '2331112',
+)
+CODE128_SIMBOLOS = {pattern[:6]: value for value, pattern in enumerate(CODE128_PADROES)}
+CODE128_START_C, CODE128_STOP = 105, 106
+# Pesos do DV (módulo 11) da chave de acesso, da direita para a esquerda
+CHAVE_PESOS = [2 + i % 8 for i in range(43)]
+# Pesos dos dígitos verificadores de CNPJ (12 e 13 posições) e CPF (9 e 10 posições)
+CNPJ_PESOS = ((5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2), (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2))
+CPF_PESOS = (tuple(range(10, 1, -1)), tuple(range(11, 1, -1)))
+# Base do CNPJ pode ser alfanumérica (IN RFB 2.229/2024); os dígitos verificadores não
+CNPJ_FORMATO_RX = re.compile(r'[0-9A-Z]{12}\d{2}')
+CPF_FORMATO_RX = re.compile(r'\d{11}')
+CHAVE_FORMATO_RX = re.compile(r'\d{44}')
+# Chave de acesso dentro do conteúdo de um QR Code (URL da NFC-e) ou código de barras
+CHAVE_PAYLOAD_RX = re.compile(r'(?<!\d)(\d{44})(?!\d)')
+# Maior lado da página na detecção de códigos (a decodificação usa a resolução original)
+CODIGO_BARRAS_MAX_LADO = 1600
+
+# Código IBGE da UF (dois primeiros dígitos da chave de acesso)
+UF_CODIGOS = {
+    '11': 'RO', '12': 'AC', '13': 'AM', '14': 'RR', '15': 'PA', '16': 'AP', '17': 'TO',
+    '21': 'MA', '22': 'PI', '23': 'CE', '24': 'RN', '25': 'PB', '26': 'PE', '27': 'AL', '28': 'SE', '29': 'BA',
+    '31': 'MG', '32': 'ES', '33': 'RJ', '35': 'SP', '41': 'PR', '42': 'SC', '43': 'RS',
+    '50': 'MS', '51': 'MT', '52': 'GO', '53': 'DF',
+}
+# Modelo do documento fiscal (posições 21-22 da chave)
+MODELOS_DOCUMENTO = {'55': 'NF-e', '65': 'NFC-e', '57': 'CT-e', '67': 'CT-e OS', '58': 'MDF-e'}
+
+# Perfis de pré-processamento: maior lado da miniatura usada nas métricas de qualidade
+# e limites de contraste (níveis de cinza), nitidez (relativa) e ruído (desvio)
+PERFIS_PREPROCESSAMENTO = ('fast', 'standard', 'heavy')
+QUALIDADE_MINIATURA = 1024
+PERFIL_FAST = {'contraste': 120, 'nitidez': 0.9, 'ruido': 1.0}
+PERFIL_HEAVY = {'contraste': 80, 'nitidez': 0.7, 'ruido': 6.0}
+RUIDO_KERNEL = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], np.float32)
+
+# dHash da primeira página: lado da miniatura, faixas indexadas e distância (bits) aceita
+DHASH_LADO = 8
+DHASH_BANDAS = 4
+DHASH_MAX_DISTANCIA = 5
+
+# Conteúdos (SHA256) lembrados por lote para reaproveitar o resultado de arquivos repetidos
+CONTEUDOS_MAX = 10000
+
+# Arquivo de textos extraídos: campo temporário que leva o texto do worker ao processo
+# principal, nível do zlib e textos por tarefa do reparse
+CAMPO_TEXTO = '_texto_extraido'
+TEXTO_COMPRESSAO = 6
+REPARSE_LOTE = 200
+
+# Modo --shard: subdiretório de saída de cada shard e manifesto gravado nele
+SHARD_DIR = 'shard_{indice}_de_{total}'
+SHARD_MANIFESTO = 'shard.json'
+# --shard-by hash: bytes do início de cada arquivo que entram na chave (com o tamanho)
+SHARD_HASH_PREFIXO = 64 * 1024
+
+# Extensões processadas ao percorrer diretórios (comparação sem diferenciar maiúsculas)
+EXTENSOES_XML = ('.xml', '.zip')
+EXTENSOES_ENTRADA = EXTENSOES_XML + ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.pdf')
+
 # ------------------------------ Classes de Dados ------------------------------
 @dataclass
 class ItemNota:
     """Representa um item da nota fiscal"""
+    # Sem __dict__ por item: lotes grandes mantêm milhões deles em memória
+    __slots__ = ('chave_acesso', 'arquivo', 'descricao', 'ncm', 'cfop', 'qtd', 'unidade',
+                 'vl_unit', 'vl_total', 'linha_ocr')
     chave_acesso: str
     arquivo: str
     descricao: str
@@ -101,6 +295,174 @@ class NotaFiscal:
     endereco_emitente: Optional[str]
     municipio_emitente: Optional[str]
     ie_emitente: Optional[str]
+    mes_emissao: Optional[str]
+    chave_valida: Optional[bool]
+
+@dataclass
+class OpcoesProcessamento:
+    """Opções do pipeline repassadas aos workers (campos com metadata 'versao' entram na chave do cache)"""
+    cache_path: Optional[str] = None
+    ocr_backend: str = 'auto'
+    # Diretório onde cada worker grava seu cProfile (None = sem profiling)
+    profile_dir: Optional[str] = None
+    # Índice de duplicatas consultado antes do OCR (None = sem deduplicação)
+    dedup_path: Optional[str] = None
+    # Arquivo de textos extraídos, base do reparse (None = texto não é guardado)
+    textos_path: Optional[str] = None
+    # 'auto': usa a camada de texto nativa do PDF quando existir; 'off': sempre OCR
+    text_layer: str = field(default='auto', metadata={'versao': True})
+    text_layer_min_score: int = field(default=50, metadata={'versao': True})
+    # 'adaptive': para no primeiro OCR confiável; 'exhaustive': roda todas as configs
+    ocr_strategy: str = field(default='adaptive', metadata={'versao': True})
+    dpi: int = field(default=200, metadata={'versao': True})
+    # DPI da primeira tentativa de OCR de PDFs; só re-renderiza a ``dpi`` se faltarem
+    # campos críticos (None = renderiza direto a ``dpi``)
+    dpi_inicial: Optional[int] = field(default=None, metadata={'versao': True})
+    # Lê páginas seguintes do PDF enquanto o bloco de itens não terminar
+    multipage: bool = field(default=False, metadata={'versao': True})
+    max_pages: int = field(default=50, metadata={'versao': True})
+    # Lê a chave de acesso do código de barras/QR Code antes do OCR
+    codigo_barras: bool = field(default=True, metadata={'versao': True})
+    # 'auto': perfil escolhido pela qualidade da página; ou fixo em fast/standard/heavy
+    preprocess: str = field(default='auto', metadata={'versao': True})
+    # OCR com layout: uma passada com caixas de palavras, zonas da DANFE e tabela de
+    # itens em colunas, relendo só as zonas com campos faltando
+    layout: bool = field(default=False, metadata={'versao': True})
+
+    def versao(self):
+        """Identificador da versão do pipeline + opções que afetam o resultado"""
+        relevantes = {f.name: getattr(self, f.name) for f in fields(self) if f.metadata.get('versao')}
+        payload = json.dumps({'pipeline': PIPELINE_VERSION, 'opcoes': relevantes}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+# ------------------------------ Instrumentação ------------------------------
+class MedidorEstagios:
+    """Tempos de parede e de CPU por estágio do processamento de um arquivo"""
+
+    def __init__(self):
+        self.tempos = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.tempos.setdefault(name, [0.0, 0.0])
+            entry[0] += time.perf_counter() - wall
+            entry[1] += time.process_time() - cpu
+
+    def to_dict(self):
+        return {name: {'wall_ms': round(wall * 1000, 3), 'cpu_ms': round(cpu * 1000, 3)}
+                for name, (wall, cpu) in self.tempos.items()}
+
+# Medidor do arquivo em processamento na thread atual
+_stage_local = threading.local()
+
+def stage(name):
+    """Mede um estágio no medidor do arquivo atual (sem custo se não houver medidor)"""
+    timer = getattr(_stage_local, 'timer', None)
+    return timer.stage(name) if timer else nullcontext()
+
+class MetricasEstagios:
+    """Histogramas dos tempos por estágio agregados de todos os workers (metricas.json)"""
+    # Limites superiores dos buckets em ms: 0,1 ms dobrando até ~14 minutos
+    BUCKETS_MS = [0.1 * 2 ** k for k in range(24)]
+
+    def __init__(self):
+        self.stages = {}
+
+    def _stage(self, name):
+        return self.stages.setdefault(name, {
+            'n': 0, 'wall_total_ms': 0.0, 'cpu_total_ms': 0.0,
+            'wall_min_ms': None, 'wall_max_ms': 0.0,
+            'histograma': [0] * (len(self.BUCKETS_MS) + 1),
+        })
+
+    def add(self, tempos):
+        for name, tempo in tempos.items():
+            agg = self._stage(name)
+            wall = tempo['wall_ms']
+            agg['n'] += 1
+            agg['wall_total_ms'] += wall
+            agg['cpu_total_ms'] += tempo['cpu_ms']
+            agg['wall_min_ms'] = wall if agg['wall_min_ms'] is None else min(agg['wall_min_ms'], wall)
+            agg['wall_max_ms'] = max(agg['wall_max_ms'], wall)
+            agg['histograma'][self._bucket(wall)] += 1
+
+    def merge(self, report):
+        """Soma um relatório de to_dict() (metricas.json de outra execução, ex.: um shard)"""
+        if report.get('buckets_ms') != [round(b, 3) for b in self.BUCKETS_MS]:
+            raise ValueError("metricas.json com buckets diferentes")
+        for name, metric in report['estagios'].items():
+            agg = self._stage(name)
+            agg['n'] += metric['n']
+            agg['wall_total_ms'] += metric['wall_total_ms']
+            agg['cpu_total_ms'] += metric['cpu_total_ms']
+            if metric['wall_min_ms'] is not None:
+                agg['wall_min_ms'] = (metric['wall_min_ms'] if agg['wall_min_ms'] is None
+                                      else min(agg['wall_min_ms'], metric['wall_min_ms']))
+            agg['wall_max_ms'] = max(agg['wall_max_ms'], metric['wall_max_ms'])
+            agg['histograma'] = [a + b for a, b in zip(agg['histograma'], metric['histograma'])]
+
+    def _bucket(self, value_ms):
+        for i, bound in enumerate(self.BUCKETS_MS):
+            if value_ms <= bound:
+                return i
+        return len(self.BUCKETS_MS)
+
+    def _percentile(self, histogram, n, q):
+        """Percentil aproximado pelo limite superior do bucket"""
+        target, seen = q * n, 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                return round(self.BUCKETS_MS[i], 3) if i < len(self.BUCKETS_MS) else None
+        return None
+
+    def to_dict(self):
+        report = {'buckets_ms': [round(b, 3) for b in self.BUCKETS_MS], 'estagios': {}}
+        for name, agg in sorted(self.stages.items(), key=lambda kv: -kv[1]['wall_total_ms']):
+            report['estagios'][name] = {
+                'n': agg['n'],
+                'wall_total_ms': round(agg['wall_total_ms'], 3),
+                'cpu_total_ms': round(agg['cpu_total_ms'], 3),
+                'wall_media_ms': round(agg['wall_total_ms'] / agg['n'], 3),
+                'wall_min_ms': agg['wall_min_ms'],
+                'wall_max_ms': agg['wall_max_ms'],
+                'wall_p50_ms': self._percentile(agg['histograma'], agg['n'], 0.50),
+                'wall_p90_ms': self._percentile(agg['histograma'], agg['n'], 0.90),
+                'wall_p99_ms': self._percentile(agg['histograma'], agg['n'], 0.99),
+                'histograma': agg['histograma'],
+            }
+        return report
+
+# Profiler do processo worker (modo --profile): o pstats é gravado na saída do
+# processo e, para não se perder se o worker for morto, a cada PROFILE_GRAVAR_A_CADA arquivos
+PROFILE_GRAVAR_A_CADA = 200
+_profiler = None
+_profiled_files = 0
+
+def get_worker_profiler(opts):
+    global _profiler
+    if opts.profile_dir and _profiler is None:
+        os.makedirs(opts.profile_dir, exist_ok=True)
+        _profiler = cProfile.Profile()
+        # Finalize (e não atexit) também roda na saída dos workers do pool
+        mp_util.Finalize(None, dump_worker_profile, args=(opts,), exitpriority=10)
+    return _profiler
+
+def profile_file_done(opts):
+    """Conta um arquivo perfilado e grava o pstats a cada PROFILE_GRAVAR_A_CADA"""
+    global _profiled_files
+    _profiled_files += 1
+    if _profiled_files % PROFILE_GRAVAR_A_CADA == 0:
+        dump_worker_profile(opts)
+
+def dump_worker_profile(opts):
+    """Grava o pstats acumulado deste worker"""
+    if _profiler is not None:
+        _profiler.dump_stats(os.path.join(opts.profile_dir, f'worker_{os.getpid()}.pstats'))
 
 # ------------------------------ Utilitários ------------------------------
 def setup_tesseract():
@@ -130,27 +492,105 @@ def sha256_file(path):
             h.update(chunk)
     return h.hexdigest()
 
+@contextmanager
+def map_file(path):
+    """Conteúdo do arquivo como memoryview sobre um mmap (válido só dentro do bloco with)"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:  # mmap não aceita arquivo vazio
+            yield memoryview(b'')
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            yield view
+
+class _PixmapArray(np.ndarray):
+    """ndarray sobre o buffer de amostras de um fitz.Pixmap, mantendo o pixmap vivo"""
+    def __array_finalize__(self, obj):
+        self._pixmap = getattr(obj, '_pixmap', None)
+
+def render_page(page, dpi=200, grayscale=True):
+    """Renderiza uma página como array NumPy direto do buffer do pixmap (sem PNG)"""
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), colorspace=colorspace, alpha=False)
+    if pix.n == 1:
+        shape, strides = (pix.height, pix.width), (pix.stride, 1)
+    else:
+        shape, strides = (pix.height, pix.width, pix.n), (pix.stride, pix.n, 1)
+    samples = pix.samples_mv if hasattr(pix, 'samples_mv') else pix.samples
+    img = _PixmapArray(shape, dtype=np.uint8, buffer=samples, strides=strides)
+    img._pixmap = pix
+    return img
+
+def iter_pdf_pages(pdf_path, dpi=200, grayscale=True, first_page=0):
+    """Gera as páginas do PDF sob demanda, uma por vez"""
+    with fitz.open(pdf_path) as doc:
+        for page_num in range(first_page, len(doc)):
+            yield render_page(doc.load_page(page_num), dpi, grayscale)
+
 def pdf_to_images(pdf_path, dpi=200):
     """Converte PDF para lista de imagens"""
     try:
-        doc = fitz.open(pdf_path)
-        images = []
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72))
-            img_data = pix.tobytes("png")
-            nparr = np.frombuffer(img_data, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            if img is not None:
-                images.append(img)
-        doc.close()
-        return images
+        return [cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+                for img in iter_pdf_pages(pdf_path, dpi, grayscale=False)]
     except Exception as e:
         logger.error(f"Erro ao converter PDF {pdf_path}: {e}")
         return []
 
-def advanced_preprocess(img):
-    """Pré-processamento avançado da imagem"""
+def group_lines(words):
+    """Agrupa palavras com posição (x0, y0, x1, y1, texto, ...) em linhas visuais"""
+    lines = []
+    for word in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        center = (word[1] + word[3]) / 2
+        if lines and abs(center - lines[-1][0]) <= max(2.0, (word[3] - word[1]) / 2):
+            lines[-1][1].append(word)
+        else:
+            lines.append((center, [word]))
+    return [sorted(line, key=lambda w: (w[0], w[4])) for _, line in lines]
+
+def line_text(line):
+    return ' '.join(w[4] for w in line)
+
+def words_to_text(words):
+    """Reconstrói o texto a partir de palavras com posição, imitando a saída do OCR por página"""
+    return '\n'.join(line_text(line) for line in group_lines(words))
+
+def page_text_layer(page):
+    """Extrai a camada de texto nativa de uma página do PDF (vazio se não houver)"""
+    return words_to_text([w[:5] for w in page.get_text("words")])
+
+def _percentiles_u8(values, qs):
+    """Percentis de um array uint8 pelo histograma (evita ordenar a imagem)"""
+    cumulative = np.cumsum(np.bincount(values.ravel(), minlength=256))
+    return [int(np.searchsorted(cumulative, q / 100.0 * cumulative[-1])) for q in qs]
+
+def estimate_image_quality(gray):
+    """Métricas rápidas de contraste, nitidez e ruído de uma página em cinza"""
+    h, w = gray.shape[:2]
+    scale = min(1.0, QUALIDADE_MINIATURA / max(h, w))
+    thumb = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR) if scale < 1 else gray
+    tinta, papel = _percentiles_u8(thumb, (1, 50))
+    contraste = papel - tinta
+    edges = cv2.convertScaleAbs(cv2.Laplacian(thumb, cv2.CV_16S))
+    nitidez = _percentiles_u8(edges, (99.5,))[0] / max(contraste, 1)
+    
+    cy, cx = h // 2, w // 2
+    crop = gray[max(0, cy - 256):cy + 256, max(0, cx - 256):cx + 256].astype(np.float32)
+    residual = np.abs(cv2.filter2D(crop, -1, RUIDO_KERNEL))[1:-1, 1:-1]
+    ruido = 1.4826 * float(np.median(residual)) / 6 if residual.size else 0.0
+    
+    return {'contraste': contraste, 'nitidez': round(nitidez, 3), 'ruido': round(ruido, 3)}
+
+def choose_preprocess_profile(quality):
+    """Perfil de pré-processamento ('fast', 'standard' ou 'heavy') para as métricas da página"""
+    if (quality['ruido'] >= PERFIL_HEAVY['ruido'] or quality['contraste'] < PERFIL_HEAVY['contraste']
+            or quality['nitidez'] < PERFIL_HEAVY['nitidez']):
+        return 'heavy'
+    if (quality['ruido'] < PERFIL_FAST['ruido'] and quality['contraste'] >= PERFIL_FAST['contraste']
+            and quality['nitidez'] >= PERFIL_FAST['nitidez']):
+        return 'fast'
+    return 'standard'
+
+def advanced_preprocess(img, profile='heavy'):
+    """Pré-processamento da imagem para o OCR conforme o perfil (fast, standard ou heavy)"""
     # Redimensionamento inteligente
     h, w = img.shape[:2]
     if w > 2000:
@@ -158,79 +598,595 @@ def advanced_preprocess(img):
         new_w, new_h = int(w * scale), int(h * scale)
         img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
     
-    # Conversão para escala de cinza
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    # Conversão para escala de cinza (páginas de PDF já chegam em cinza)
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    
+    if profile == 'fast':
+        return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
     
-    # Múltiplas técnicas de melhoria
     # 1. Equalização de histograma adaptativa
     clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
     gray = clahe.apply(gray)
     
-    # 2. Filtro bilateral para reduzir ruído preservando bordas
-    gray = cv2.bilateralFilter(gray, 9, 75, 75)
+    # 2. Redução de ruído: mediana (barata) ou bilateral (preserva bordas, bem mais cara)
+    if profile == 'standard':
+        gray = cv2.medianBlur(gray, 3)
+    else:
+        gray = cv2.bilateralFilter(gray, 9, 75, 75)
     
     # 3. Threshold adaptativo
-    thresh = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, 
-                                  cv2.THRESH_BINARY, 11, 2)
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                 cv2.THRESH_BINARY, 11, 2)
+
+def score_nf_text(text, chave_conhecida=None):
+    """Pontua um texto pela presença de características de NF"""
+    score = 0
+    chave = find_chave(text.replace(' ', ''))
+    cnpj = CNPJ_RX.search(text)
+    if chave or (chave_conhecida and cnpj):
+        score += 100  # Chave de acesso (a do código de barras só com o CNPJ lido no texto)
+    if chave_valida(chave) or cnpj:
+        score += 50   # CNPJ (o do emitente vem da chave válida)
+    if 'NOTA FISCAL' in text.upper():
+        score += 30   # Menção a nota fiscal
+    if DOTTED_NUMBER_RX.search(text):
+        score += 20   # Números com formato de valor
+    return score
+
+def missing_critical_fields(text, chave_conhecida=None):
+    """Campos críticos (chave, CNPJ, valor total) que o OCR de uma página não trouxe"""
+    upper_text = normalize_text(text).upper()
+    chave = chave_conhecida or find_chave(upper_text.replace(' ', '').replace('\n', '').replace('\t', ''))
+    missing = []
+    if not chave:
+        missing.append('chave')
+    if not (chave_valida(chave) or CNPJ_RX.search(upper_text)):
+        missing.append('cnpj')
+    if find_total_value(upper_text) is None:
+        missing.append('valor_total')
+    return missing
+
+class BackendOCR:
+    """Motor de OCR usado por smart_ocr (um por processo worker)"""
+    name = None
+
+    def image_to_string(self, img, config):
+        raise NotImplementedError
+
+    def image_to_data(self, img, config):
+        """Palavras reconhecidas com posição: lista de (x0, y0, x1, y1, texto, confiança)"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class BackendPytesseract(BackendOCR):
+    """Chama o executável do Tesseract a cada imagem (fallback sempre disponível)"""
+    name = 'pytesseract'
+
+    def image_to_string(self, img, config):
+        return pytesseract.image_to_string(img, config=config)
+
+    def image_to_data(self, img, config):
+        data = pytesseract.image_to_data(img, config=config, output_type=pytesseract.Output.DICT)
+        return [
+            (left, top, left + width, top + height, text.strip(), float(conf))
+            for left, top, width, height, text, conf in zip(
+                data['left'], data['top'], data['width'], data['height'], data['text'], data['conf'])
+            if text and text.strip()
+        ]
+
+class BackendTesserocr(BackendOCR):
+    """Mantém o Tesseract carregado no processo via tesserocr, uma API por (idioma, OEM)"""
+    name = 'tesserocr'
+
+    def __init__(self):
+        if tesserocr is None:
+            raise RuntimeError("tesserocr não está instalado")
+        self.apis = {}
+        # Falha cedo (ex.: traineddata ausente) para permitir o fallback
+        self._api(*parse_tesseract_config(OCR_CONFIGS[0])[:2])
+
+    def _api(self, lang, oem):
+        key = (lang, oem)
+        if key not in self.apis:
+            self.apis[key] = tesserocr.PyTessBaseAPI(lang=lang, oem=oem)
+        return self.apis[key]
+
+    def _set_image(self, img, config):
+        lang, oem, psm = parse_tesseract_config(config)
+        api = self._api(lang, oem)
+        api.SetPageSegMode(psm)
+        img = np.ascontiguousarray(img)
+        h, w = img.shape[:2]
+        channels = 1 if img.ndim == 2 else img.shape[2]
+        api.SetImageBytes(img.tobytes(), w, h, channels, w * channels)
+        return api
+
+    def image_to_string(self, img, config):
+        return self._set_image(img, config).GetUTF8Text()
+
+    def image_to_data(self, img, config):
+        api = self._set_image(img, config)
+        api.Recognize()
+        level = tesserocr.RIL.WORD
+        words = []
+        for word in tesserocr.iterate_level(api.GetIterator(), level):
+            text = word.GetUTF8Text(level)
+            box = word.BoundingBox(level)
+            if text and text.strip() and box:
+                words.append((*box, text.strip(), word.Confidence(level)))
+        return words
+
+    def close(self):
+        for api in self.apis.values():
+            api.End()
+        self.apis.clear()
+
+OCR_BACKENDS = {
+    'tesserocr': BackendTesserocr,
+    'pytesseract': BackendPytesseract,
+}
+
+def parse_tesseract_config(config):
+    """Extrai (idioma, oem, psm) de uma string de configuração do Tesseract"""
+    lang = re.search(r'-l\s+(\S+)', config)
+    oem = re.search(r'--oem\s+(\d+)', config)
+    psm = re.search(r'--psm\s+(\d+)', config)
+    return (lang.group(1) if lang else 'eng',
+            int(oem.group(1)) if oem else 3,
+            int(psm.group(1)) if psm else 3)
+
+def create_ocr_backend(name='auto'):
+    """Cria o backend pedido; 'auto' tenta tesserocr e recorre ao pytesseract"""
+    if name != 'auto':
+        return OCR_BACKENDS[name]()
+    try:
+        return BackendTesserocr()
+    except Exception as e:
+        logger.debug(f"tesserocr indisponível ({e}), usando pytesseract")
+        return BackendPytesseract()
+
+# Backend do processo atual, criado no inicializador do pool (ou no primeiro uso)
+_ocr_backend = None
+
+def get_ocr_backend():
+    global _ocr_backend
+    if _ocr_backend is None:
+        _ocr_backend = create_ocr_backend()
+    return _ocr_backend
+
+def init_worker(opts):
+    """Inicializador dos processos do pool: cria o motor de OCR de longa duração"""
+    global _ocr_backend
+    _ocr_backend = create_ocr_backend(opts.ocr_backend)
+    logger.debug(f"Worker {os.getpid()} usando backend de OCR {_ocr_backend.name}")
+
+class AgendadorOCR:
+    """Agenda as configurações do Tesseract com parada antecipada, aprendendo por tipo de documento"""
+
+    def __init__(self, configs=None, threshold=OCR_EARLY_EXIT_SCORE):
+        self.configs = list(configs or OCR_CONFIGS)
+        self.threshold = threshold
+        self.wins = {}
+        self.pages = 0
+        self.passes_run = 0
+
+    def order(self, doc_type=None, exclude=()):
+        """Configurações restantes, das que mais venceram para as que menos venceram"""
+        wins = self.wins.get(doc_type) or self.wins.get(None, {})
+        # sorted é estável: em caso de empate vale a ordem padrão de OCR_CONFIGS
+        return sorted((c for c in self.configs if c not in exclude), key=lambda c: -wins.get(c, 0))
+
+    def record(self, doc_type, config, passes):
+        """Registra a configuração vencedora de uma página"""
+        self.pages += 1
+        self.passes_run += passes
+        if config:
+            for key in (None, doc_type):
+                wins = self.wins.setdefault(key, {})
+                wins[config] = wins.get(config, 0) + 1
+
+    def stats(self):
+        """Resumo de passadas executadas/economizadas neste processo"""
+        return {
+            'paginas': self.pages,
+            'passadas_executadas': self.passes_run,
+            'passadas_economizadas': self.pages * len(self.configs) - self.passes_run,
+            'vitorias': {str(k): v for k, v in self.wins.items()},
+        }
+
+# Um agendador por processo worker: o aprendizado vale para todas as páginas dele
+_ocr_scheduler = None
+
+def get_ocr_scheduler():
+    global _ocr_scheduler
+    if _ocr_scheduler is None:
+        _ocr_scheduler = AgendadorOCR()
+    return _ocr_scheduler
+
+def smart_ocr_detailed(img, strategy='adaptive', chave_conhecida=None):
+    """OCR com múltiplas estratégias, retornando (texto, config vencedora, score, passadas)"""
+    scheduler = get_ocr_scheduler()
+    backend = get_ocr_backend()
+    threshold = scheduler.threshold if strategy == 'adaptive' else float('inf')
+    
+    pending = scheduler.order()
+    done = []
+    doc_type = None
+    best_text, best_config, best_score = "", None, 0
+    first_text = None
     
-    # 4. Operações morfológicas para limpeza
-    kernel = np.ones((1,1), np.uint8)
-    thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-    thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
+    while pending:
+        config = pending.pop(0)
+        done.append(config)
+        try:
+            with stage(f"ocr_psm{parse_tesseract_config(config)[2]}"):
+                text = backend.image_to_string(img, config)
+        except Exception as e:
+            logger.warning(f"OCR com config {config} falhou: {e}")
+            continue
+        if first_text is None:
+            first_text = text
+            # Com o tipo do documento conhecido, reordena pelo histórico desse tipo
+            doc_type = detect_doc_type(unidecode(text).upper())
+            pending = scheduler.order(doc_type, exclude=done)
+        
+        # Escolhe o resultado com mais conteúdo válido
+        score = score_nf_text(text, chave_conhecida)
+        if score > best_score:
+            best_text, best_config, best_score = text, config, score
+        if best_score >= threshold:
+            break
     
-    return thresh
+    scheduler.record(doc_type, best_config, len(done))
+    if not best_text:
+        return first_text or "", None, 0, len(done)
+    return best_text, best_config, best_score, len(done)
 
-def smart_ocr(img):
+def smart_ocr(img, strategy='adaptive'):
     """OCR inteligente com múltiplas estratégias"""
-    # Configurações para diferentes tipos de conteúdo
-    configs = [
-        "--oem 3 --psm 6 -l por+eng",  # Padrão
-        "--oem 3 --psm 4 -l por+eng",  # Coluna única
-        "--oem 3 --psm 8 -l por+eng",  # Palavra única
-        "--oem 3 --psm 13 -l por+eng", # Linha bruta
-    ]
+    return smart_ocr_detailed(img, strategy)[0]
+
+# ------------------------------ Layout da DANFE ------------------------------
+def line_zones(texts):
+    """Zona da DANFE de cada linha (texto normalizado) e se a linha é o título da zona"""
+    zonas, titulos = [], []
+    current = 0
+    for text in texts:
+        upper_text = text.upper()
+        titulo = False
+        for k in range(current + 1, len(ZONAS_DANFE)):
+            if any(title in upper_text for title in ZONAS_DANFE[k][1]):
+                current, titulo = k, True
+                break
+        zonas.append(ZONAS_DANFE[current][0])
+        titulos.append(titulo)
+    return zonas, titulos
+
+def segment_zones(lines):
+    """Divide as linhas visuais da página nas zonas da DANFE: lista de (zona, linhas)"""
+    zonas, _ = line_zones(normalize_text(line_text(line)) for line in lines)
+    segments = []
+    for zona, line in zip(zonas, lines):
+        if not segments or segments[-1][0] != zona:
+            segments.append((zona, []))
+        segments[-1][1].append(line)
+    return segments
+
+def item_column(label):
+    """Campo da tabela de itens correspondente a um rótulo de cabeçalho (None se outro)"""
+    upper_label = normalize_text(label).upper()
+    for campo, _, pattern in COLUNAS_ITENS:
+        if pattern.search(upper_label):
+            return campo
+    return None
+
+def table_columns(labels):
+    """Campos de uma sequência de rótulos de cabeçalho; cada campo vale só na 1ª coluna"""
+    seen = set()
+    columns = []
+    for label in labels:
+        campo = item_column(label)
+        columns.append(campo if campo not in seen else None)
+        seen.add(campo)
+    return columns
+
+def header_cells(words):
+    """Células do cabeçalho da tabela: [x0, x1, palavras, campo], da esquerda para a direita"""
+    cells = []
+    for word in sorted(words, key=lambda w: w[0]):
+        campo = item_column(word[4])
+        if cells:
+            cell = cells[-1]
+            touches = word[0] - cell[1] <= (word[3] - word[1]) / 2
+            if touches and (campo is None or cell[3] in (None, campo)):
+                cell[1] = max(cell[1], word[2])
+                cell[2].append(word)
+                cell[3] = cell[3] or campo
+                continue
+        cells.append([word[0], word[2], [word], campo])
+    return cells
+
+def find_table_header(lines):
+    """Índice da linha de cabeçalho da tabela de itens (3+ colunas conhecidas) ou None"""
+    for i, line in enumerate(lines):
+        if sum(campo is not None for campo in table_columns(w[4] for w in line)) >= 3:
+            return i
+    return None
+
+def assign_column(word, cells):
+    """Coluna de uma palavra: a célula do cabeçalho com maior sobreposição ou a mais próxima"""
+    def overlap(cell):
+        return min(word[2], cell[1]) - max(word[0], cell[0])
+    best = max(range(len(cells)), key=lambda k: overlap(cells[k]))
+    if overlap(cells[best]) > 0:
+        return best
+    center = (word[0] + word[2]) / 2
+    return min(range(len(cells)), key=lambda k: abs((cells[k][0] + cells[k][1]) / 2 - center))
+
+def table_text_lines(lines):
+    """Texto da zona de produtos com a tabela reconstruída pelas posições x"""
+    header = find_table_header(lines)
+    if header is None:
+        return [line_text(line) for line in lines]
+    header_words = list(lines[header])
+    body = lines[header + 1:]
+    if body and not any(ch.isdigit() for w in body[0] for ch in w[4]):
+        header_words += body.pop(0)
+    cells = header_cells(header_words)
+    labels = [' '.join(w[4] for w in sorted(cell[2], key=lambda w: (w[1], w[0]))) for cell in cells]
+    columns = table_columns(labels)
     
-    results = []
-    for config in configs:
+    texts = [line_text(line) for line in lines[:header]]
+    texts.append('\t'.join(COLUNAS_ROTULOS[campo] if campo else label for campo, label in zip(columns, labels)))
+    rows = []
+    for line in body:
+        row = [[] for _ in cells]
+        for word in line:
+            row[assign_column(word, cells)].append(word[4])
+        outside = any(words for campo, words in zip(columns, row) if campo != 'descricao')
+        if rows and not outside and 'descricao' in columns:
+            rows[-1][columns.index('descricao')].extend(row[columns.index('descricao')])
+        else:
+            rows.append(row)
+    texts.extend('\t'.join(' '.join(words) for words in row) for row in rows)
+    return texts
+
+def split_segments(line):
+    """Divide uma linha visual nos trechos separados por espaços largos (colunas)"""
+    segments = [[line[0]]]
+    for prev, word in zip(line, line[1:]):
+        height = max(word[3] - word[1], prev[3] - prev[1], 1)
+        if word[0] - prev[2] > LAYOUT_ESPACO_COLUNA * height:
+            segments.append([])
+        segments[-1].append(word)
+    return segments
+
+def column_text_lines(lines):
+    """Texto de uma zona lido coluna a coluna, cada rótulo logo acima do seu valor"""
+    segments = [segment for line in lines for segment in split_segments(line)]
+    columns = []
+    keyed = []
+    for segment in sorted(segments, key=lambda seg: seg[0][0]):
+        x0, height = segment[0][0], segment[0][3] - segment[0][1]
+        if not columns or x0 - columns[-1] > LAYOUT_ESPACO_COLUNA * height:
+            columns.append(x0)
+        keyed.append((len(columns), min(w[1] for w in segment), segment))
+    return [line_text(segment) for _, _, segment in sorted(keyed, key=lambda k: k[:2])]
+
+def zone_bounds(segments, zona, height, margin=4):
+    """Faixa vertical (y0, y1) em pixels de uma zona, até o início da zona seguinte"""
+    for k, (name, lines) in enumerate(segments):
+        if name == zona:
+            y0 = 0 if k == 0 else min(w[1] for w in lines[0])
+            y1 = min(w[1] for w in segments[k + 1][1][0]) if k + 1 < len(segments) else height
+            return max(0, int(y0) - margin), min(height, int(y1) + margin)
+    return None
+
+def zones_text(texts):
+    return '\n'.join(text for _, text in texts if text)
+
+def layout_ocr(img, chave_conhecida=None):
+    """OCR com layout, retornando (texto, config, score, passadas) como smart_ocr_detailed"""
+    backend = get_ocr_backend()
+    height = img.shape[0]
+    with stage('ocr_layout'):
         try:
-            text = pytesseract.image_to_string(img, config=config)
-            results.append((config, text))
+            words = backend.image_to_data(img, OCR_LAYOUT_CONFIG)
         except Exception as e:
-            logger.warning(f"OCR com config {config} falhou: {e}")
+            logger.warning(f"OCR com layout falhou: {e}")
+            words = []
+    segments = segment_zones(group_lines(words))
+    texts = [(zona, '\n'.join(table_text_lines(lines) if zona == 'produtos' else column_text_lines(lines)))
+             for zona, lines in segments]
+    text = zones_text(texts)
+    passes = 1
     
-    # Escolhe o resultado com mais conteúdo válido
-    best_text = ""
-    best_score = 0
-    
-    for config, text in results:
-        # Pontua baseado em características de NF
-        score = 0
-        if re.search(r'\d{44}', text.replace(' ', '')):
-            score += 100  # Chave de acesso
-        if re.search(CNPJ_RE, text):
-            score += 50   # CNPJ
-        if re.search(r'NOTA FISCAL', text.upper()):
-            score += 30   # Menção a nota fiscal
-        if len(re.findall(r'\d+\.\d+\.\d+', text)) > 0:
-            score += 20   # Números com formato de valor
-            
-        if score > best_score:
-            best_score = score
-            best_text = text
+    missing = missing_critical_fields(text, chave_conhecida)
+    for zona in dict.fromkeys(ZONA_CAMPO[campo] for campo in missing):
+        # Zona não encontrada: relê a página inteira
+        y0, y1 = zone_bounds(segments, zona, height) or (0, height)
+        with stage('ocr_roi'):
+            try:
+                roi_text = backend.image_to_string(img[y0:y1], OCR_ROI_CONFIG)
+            except Exception as e:
+                logger.warning(f"OCR da zona {zona} falhou: {e}")
+                continue
+        passes += 1
+        if any(name == zona for name, _ in texts):
+            candidate = [(name, roi_text if name == zona else zone_text) for name, zone_text in texts]
+        else:
+            candidate = texts + [(zona, roi_text)]
+        candidate_missing = missing_critical_fields(zones_text(candidate), chave_conhecida)
+        if len(candidate_missing) < len(missing):
+            texts, missing = candidate, candidate_missing
+        if not missing:
+            break
+    
+    text = zones_text(texts)
+    return text, OCR_LAYOUT_ROTULO, score_nf_text(text, chave_conhecida), passes
+
+# ------------------------------ Código de Barras / QR Code ------------------------------
+def chave_valida(chave):
+    """Confere o dígito verificador (módulo 11) de uma chave de acesso de 44 dígitos"""
+    if not chave or len(chave) != 44 or not chave.isdigit():
+        return False
+    total = sum(map(operator.mul, map(int, reversed(chave[:43])), CHAVE_PESOS))
+    dv = 11 - total % 11
+    return (0 if dv >= 10 else dv) == int(chave[43])
+
+def find_chave(no_spaces):
+    """Chave de acesso num texto sem espaços: a primeira com DV válido ou, na falta, a primeira"""
+    first = None
+    for match in CHAVE_RX.finditer(no_spaces):
+        if chave_valida(match.group(1)):
+            return match.group(1)
+        first = first or match.group(1)
+    return first
+
+def decode_chave_acesso(chave):
+    """Campos codificados numa chave de acesso válida (None se o DV ou a UF não conferirem)"""
+    if not chave_valida(chave) or chave[:2] not in UF_CODIGOS:
+        return None
+    ano, mes = 2000 + int(chave[2:4]), int(chave[4:6])
+    if not 1 <= mes <= 12:
+        return None
+    return {
+        'uf': UF_CODIGOS[chave[:2]],
+        'mes_emissao': f"{ano:04d}-{mes:02d}",
+        'cnpj_emitente': chave[6:20],
+        'modelo': chave[20:22],
+        'tipo': MODELOS_DOCUMENTO.get(chave[20:22]),
+        'serie': str(int(chave[22:25])),
+        'numero_nf': str(int(chave[25:34])),
+        'tipo_emissao': chave[34],
+    }
+
+def chave_from_payload(payload):
+    """Primeira chave de acesso válida no conteúdo decodificado de um código"""
+    for match in CHAVE_PAYLOAD_RX.finditer(payload or ''):
+        if chave_valida(match.group(1)):
+            return match.group(1)
+    return None
+
+def decode_code128_row(row):
+    """Decodifica uma linha de pixels (escuro = barra) como Code-128 subconjunto C"""
+    dark = row < (float(row.min()) + float(row.max())) / 2
+    edges = np.flatnonzero(dark[1:] != dark[:-1]) + 1
+    bounds = np.concatenate(([0], edges, [len(dark)]))
+    runs = np.diff(bounds)
+    first_bar = 0 if dark[0] else 1
+    for start in range(first_bar, len(runs) - 6, 2):
+        values = []
+        pos = start
+        while pos + 6 <= len(runs):
+            widths = runs[pos:pos + 6]
+            modules = np.rint(widths * 11.0 / widths.sum()).astype(int)
+            value = CODE128_SIMBOLOS.get(''.join(map(str, modules)))
+            if value is None:
+                break
+            values.append(value)
+            if value == CODE128_STOP:
+                break
+            if value > 99 and len(values) > 1:
+                break
+            pos += 6
+        if len(values) < 4 or values[0] != CODE128_START_C or values[-1] != CODE128_STOP:
+            continue
+        data, check = values[1:-2], values[-2]
+        if (CODE128_START_C + sum(v * (i + 1) for i, v in enumerate(data))) % 103 != check:
+            continue
+        return ''.join(f"{v:02d}" for v in data)
+    return None
+
+# Detectores do OpenCV, criados uma vez por processo (None = indisponíveis nesta build)
+_code_detectors = None
+
+def get_code_detectors():
+    global _code_detectors
+    if _code_detectors is None:
+        barcode = cv2.barcode.BarcodeDetector() if hasattr(cv2, 'barcode') else None
+        _code_detectors = (barcode, cv2.QRCodeDetector())
+    return _code_detectors
+
+def _decode_barcode_region(gray, points, upscale=3):
+    """Endireita a região detectada e tenta algumas faixas de varredura nos dois sentidos"""
+    bottom_left, top_left, top_right = points[0], points[1], points[2]
+    width = int(np.linalg.norm(top_right - top_left))
+    height = int(np.linalg.norm(bottom_left - top_left))
+    if width < 50 or height < 4:
+        return None
+    # Margem lateral: a caixa detectada pode cortar a primeira/última barra
+    margin = width // 20
+    src = np.float32([top_left, top_right, bottom_left])
+    dst = np.float32([[margin * upscale, 0], [(margin + width) * upscale, 0], [margin * upscale, height]])
+    region = cv2.warpAffine(gray, cv2.getAffineTransform(src, dst), ((width + 2 * margin) * upscale, height),
+                            flags=cv2.INTER_LINEAR, borderValue=255)
+    band = max(1, height // 10)
+    for frac in (0.5, 0.3, 0.7, 0.15, 0.85):
+        y = int(height * frac)
+        row = region[max(0, y - band):y + band + 1].mean(axis=0)
+        for candidate in (row, row[::-1]):
+            digits = decode_code128_row(candidate)
+            if digits and chave_valida(digits):
+                return digits
+    return None
+
+def detect_chave_codigo_barras(img, max_side=CODIGO_BARRAS_MAX_LADO):
+    """Lê a chave de acesso do código de barras (DANFE) ou do QR Code (NFC-e)"""
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    scale = min(1.0, max_side / max(gray.shape[:2]))
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    barcode, qr = get_code_detectors()
     
-    return best_text if best_text else results[0][1] if results else ""
+    try:
+        if barcode is not None:
+            found, points = barcode.detect(small)
+            if found and points is not None:
+                for box in points:
+                    chave = _decode_barcode_region(gray, box / scale)
+                    if chave:
+                        return chave
+        
+        # Binarizado, o QR Code reduzido ainda é localizado com módulos de ~2 px
+        binary = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+        payload, _, _ = qr.detectAndDecode(binary)
+        return chave_from_payload(payload)
+    except cv2.error as e:
+        logger.debug(f"Falha na leitura de código de barras/QR: {e}")
+        return None
+
+@lru_cache(maxsize=4096)
+def _transliterate(chars):
+    return unidecode(chars)
 
-def normalize_text(text):
-    """Normaliza texto removendo acentos e padronizando"""
+def normalize_text(text, layout=False):
+    """Normaliza texto removendo acentos e padronizando (com ``layout`` preserva quebras de linha e tabulações)"""
     if not text:
         return ""
-    text = unidecode(text)
-    text = re.sub(r'\s+', ' ', text)
-    return text.strip()
+    # Equivalente a unidecode(text) + colapso de espaços, mas só translitera os
+    # trechos não ASCII (o laço caractere a caractere do unidecode é o gargalo)
+    if not text.isascii():
+        text = NON_ASCII_RX.sub(lambda m: _transliterate(m.group()), text)
+    if layout:
+        return '\n'.join('\t'.join(' '.join(cell.split()) for cell in line.split('\t'))
+                         for line in text.splitlines()).strip()
+    return ' '.join(text.split())
 
 def clean_number(s):
     """Remove caracteres não numéricos"""
-    return re.sub(r'\D+', '', s or '')
+    return NON_DIGIT_RX.sub('', s or '')
+
+def normalize_numero_nf(value):
+    """Número da nota sem pontuação nem zeros à esquerda ('000.339.250' -> '339250')"""
+    digits = clean_number(value)
+    return str(int(digits)) if digits else None
+
+def normalize_serie(value):
+    """Série sem zeros à esquerda ('001' -> '1'), como na chave de acesso"""
+    value = (value or '').strip()
+    return str(int(value)) if value.isdigit() else value or None
 
 def parse_money(value_str):
     """Converte string para valor monetário com tratamento robusto"""
@@ -239,7 +1195,7 @@ def parse_money(value_str):
     
     # Limpa e padroniza
     value_str = value_str.upper().replace('R$', '').replace('RS', '').strip()
-    value_str = re.sub(r'[^\d,\.]', '', value_str)
+    value_str = MONEY_CLEAN_RX.sub('', value_str)
     
     # Encontra o padrão de decimal
     if ',' in value_str and '.' in value_str:
@@ -261,16 +1217,16 @@ def parse_money(value_str):
     except (ValueError, TypeError):
         return None
 
+def parse_decimal(value_str):
+    """Número de uma coluna da DANFE, com a vírgula como separador decimal"""
+    if value_str and ',' in value_str:
+        return parse_money(value_str.replace('.', '').replace(',', '.'))
+    return parse_money(value_str)
+
 def parse_date(text):
     """Extrai e valida datas com múltiplos formatos"""
-    date_patterns = [
-        r'(\d{2})[/\-](\d{2})[/\-](\d{2,4})',
-        r'(\d{4})[/\-](\d{2})[/\-](\d{2})',
-        r'(\d{2})\.(\d{2})\.(\d{4})',
-    ]
-    
-    for pattern in date_patterns:
-        matches = re.finditer(pattern, text)
+    for pattern in DATE_RXS:
+        matches = pattern.finditer(text)
         for match in matches:
             groups = match.groups()
             if len(groups[2]) == 2:  # Ano com 2 dígitos
@@ -290,6 +1246,16 @@ def parse_date(text):
                     continue
     return None
 
+def detect_doc_type(upper_text):
+    """Identifica o tipo de documento por palavras-chave (texto normalizado em maiúsculas)"""
+    if any(x in upper_text for x in ['NFS-E', 'NOTA FISCAL DE SERVI']):
+        return "NFS-e"
+    elif any(x in upper_text for x in ['CT-E', 'CONHECIMENTO']):
+        return "CT-e"
+    elif any(x in upper_text for x in ['CCE', 'CARTA DE CORRECAO']):
+        return "CC-e"
+    return "NF-e"
+
 def extract_text_block(text, start_patterns, end_patterns):
     """Extrai bloco de texto entre padrões de início e fim"""
     upper_text = text.upper()
@@ -312,68 +1278,535 @@ def extract_text_block(text, start_patterns, end_patterns):
     
     return text[start_pos:end_pos].strip()
 
+# ------------------------------ Cache de Resultados ------------------------------
+class CacheResultados:
+    """Cache persistente (SQLite) de resultados indexado por SHA256 + versão do pipeline"""
+
+    def __init__(self, path, versao, readonly=False):
+        self.path = path
+        self.versao = versao
+        if not readonly:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        if not readonly:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS resultados ('
+                ' sha256 TEXT NOT NULL,'
+                ' versao TEXT NOT NULL,'
+                ' nota TEXT NOT NULL,'
+                ' itens TEXT NOT NULL,'
+                ' criado_em REAL NOT NULL,'
+                ' acessado_em REAL NOT NULL,'
+                ' PRIMARY KEY (sha256, versao))'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_resultados_acesso ON resultados (acessado_em)')
+            self.conn.commit()
+
+    def get(self, sha256):
+        """Retorna (invoice_data, items) em cache ou None"""
+        try:
+            row = self.conn.execute(
+                'SELECT nota, itens FROM resultados WHERE sha256 = ? AND versao = ?',
+                (sha256, self.versao)
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Falha ao consultar cache {self.path}: {e}")
+            return None
+        if not row:
+            return None
+        invoice_data = json.loads(row[0])
+        items = [ItemNota(**item) for item in json.loads(row[1])]
+        return invoice_data, items
+
+    def put(self, sha256, invoice_data, items, commit=True):
+        """Grava (ou apenas renova o acesso de) um resultado no cache"""
+        agora = time.time()
+        self.conn.execute(
+            'INSERT INTO resultados (sha256, versao, nota, itens, criado_em, acessado_em) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (sha256, versao) DO UPDATE SET acessado_em = excluded.acessado_em',
+            (sha256, self.versao,
+             json.dumps(invoice_data, ensure_ascii=False),
+             json.dumps([asdict(item) for item in items], ensure_ascii=False),
+             agora, agora)
+        )
+        if commit:
+            self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def evict(self, max_age_days=None, max_entries=None):
+        """Remove entradas de outras versões, antigas (sem acesso) e excedentes (LRU)"""
+        removed = self.conn.execute('DELETE FROM resultados WHERE versao != ?', (self.versao,)).rowcount
+        if max_age_days is not None:
+            limite = time.time() - max_age_days * 86400
+            removed += self.conn.execute('DELETE FROM resultados WHERE acessado_em < ?', (limite,)).rowcount
+        if max_entries is not None:
+            removed += self.conn.execute(
+                'DELETE FROM resultados WHERE rowid IN ('
+                ' SELECT rowid FROM resultados ORDER BY acessado_em DESC LIMIT -1 OFFSET ?)',
+                (max(0, max_entries),)
+            ).rowcount
+        self.conn.commit()
+        return removed
+
+    def clear(self):
+        """Invalida todo o cache"""
+        removed = self.conn.execute('DELETE FROM resultados').rowcount
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+        return removed
+
+    def count(self):
+        """Número de entradas válidas para a versão atual"""
+        return self.conn.execute('SELECT COUNT(*) FROM resultados WHERE versao = ?', (self.versao,)).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+# Conexão de leitura do cache, aberta uma vez por processo worker (ou thread de E/S)
+_worker_cache = {}
+
+def get_worker_cache(opts):
+    """Retorna a conexão de cache do processo/thread atual (ou None se desabilitado)"""
+    if not opts.cache_path or not os.path.exists(opts.cache_path):
+        return None
+    key = (os.getpid(), threading.get_ident(), opts.cache_path)
+    if key not in _worker_cache:
+        _worker_cache[key] = CacheResultados(opts.cache_path, opts.versao(), readonly=True)
+    return _worker_cache[key]
+
+# ------------------------------ Índice de Duplicatas ------------------------------
+class IndiceDuplicatas:
+    """Índice persistente (SQLite) de documentos canônicos e das duplicatas ligadas a eles"""
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        if not readonly:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        if not readonly:
+            bandas = ''.join(f' b{i} INTEGER,' for i in range(DHASH_BANDAS))
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS documentos ('
+                ' caminho TEXT NOT NULL,'
+                " chave TEXT NOT NULL DEFAULT '',"
+                ' sha256 TEXT,'
+                ' metodo TEXT,'
+                ' dhash TEXT,'
+                f'{bandas}'
+                ' registrado_em REAL NOT NULL,'
+                ' PRIMARY KEY (caminho, chave))'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS duplicatas ('
+                ' caminho TEXT NOT NULL,'
+                ' sha256 TEXT,'
+                ' chave TEXT,'
+                ' canonico TEXT NOT NULL,'
+                ' motivo TEXT NOT NULL,'
+                ' registrado_em REAL NOT NULL,'
+                ' PRIMARY KEY (caminho, canonico))'
+            )
+            for column in ['sha256', 'chave'] + [f'b{i}' for i in range(DHASH_BANDAS)]:
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_documentos_{column} ON documentos ({column})')
+            self.conn.commit()
+
+    def by_sha256(self, sha256):
+        """Caminho canônico de um conteúdo já registrado (ou None)"""
+        row = self.conn.execute('SELECT caminho FROM documentos WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone()
+        return row[0] if row else None
+
+    def by_chave(self, chave):
+        """(caminho, metodo) do canônico de uma chave de acesso; notas de XML têm precedência"""
+        return self.conn.execute(
+            "SELECT caminho, metodo FROM documentos WHERE chave = ? "
+            "ORDER BY metodo = 'xml' DESC, registrado_em LIMIT 1", (chave,)
+        ).fetchone()
+
+    def by_dhash(self, dhash):
+        """(caminho, distância) do documento de dHash mais próximo dentro de DHASH_MAX_DISTANCIA"""
+        bands = dhash_bands(dhash)
+        where = ' OR '.join(f'b{i} = ?' for i in range(DHASH_BANDAS))
+        best = None
+        for caminho, other in self.conn.execute(f'SELECT caminho, dhash FROM documentos WHERE {where}', bands):
+            distance = bin(dhash ^ int(other, 16)).count('1')
+            if distance <= DHASH_MAX_DISTANCIA and (best is None or distance < best[1]):
+                best = (caminho, distance)
+        return best
+
+    def add(self, caminho, sha256=None, chave=None, metodo=None, dhash=None, commit=True):
+        """Registra (ou atualiza) um documento canônico"""
+        bands = dhash_bands(dhash) if dhash is not None else [None] * DHASH_BANDAS
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO documentos VALUES (?, ?, ?, ?, ?, {', '.join('?' * DHASH_BANDAS)}, ?)",
+            (caminho, chave or '', sha256, metodo, f'{dhash:016x}' if dhash is not None else None,
+             *bands, time.time())
+        )
+        if commit:
+            self.conn.commit()
+
+    def link(self, caminho, canonico, motivo, sha256=None, chave=None, commit=True):
+        """Liga um arquivo repetido ao seu documento canônico"""
+        self.conn.execute(
+            'INSERT OR REPLACE INTO duplicatas VALUES (?, ?, ?, ?, ?, ?)',
+            (caminho, sha256, chave, canonico, motivo, time.time())
+        )
+        if commit:
+            self.conn.commit()
+
+    def iter_duplicatas(self):
+        """Entradas de ``duplicatas`` como dicionários, das mais antigas às mais novas"""
+        cursor = self.conn.execute('SELECT * FROM duplicatas ORDER BY registrado_em')
+        columns = [d[0] for d in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class DuplicataEncontrada(Exception):
+    """Interrompe o processamento de um arquivo reconhecido como duplicata antes do OCR"""
+
+    def __init__(self, canonico, motivo, chave=None):
+        super().__init__(f"duplicata de {canonico} ({motivo})")
+        self.canonico = canonico
+        self.motivo = motivo
+        self.chave = chave
+
+def dhash_image(gray):
+    """dHash de 64 bits: gradiente horizontal de uma miniatura 9x8 da página"""
+    # Primeiro uma redução por fator inteiro (INTER_AREA com fator inteiro é bem mais barato)
+    h, w = gray.shape
+    fy, fx = max(1, h // (8 * DHASH_LADO)), max(1, w // (8 * (DHASH_LADO + 1)))
+    small = cv2.resize(gray, (w // fx, h // fy), interpolation=cv2.INTER_AREA)
+    small = cv2.resize(small, (DHASH_LADO + 1, DHASH_LADO), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def dhash_bands(dhash):
+    """Faixas de 16 bits do dHash: documentos a poucos bits de distância dividem alguma delas"""
+    return [(dhash >> (16 * i)) & 0xFFFF for i in range(DHASH_BANDAS)]
+
+def dedup_path(filepath, invoice_data=None):
+    """Identificador de um documento no índice: caminho absoluto (+ #membro para zips)"""
+    caminho = os.path.abspath(filepath)
+    if invoice_data and '#' in invoice_data.get('arquivo', ''):
+        caminho += '#' + invoice_data['arquivo'].partition('#')[2]
+    return caminho
+
+def duplicate_record(filepath, canonico, motivo, sha256=None, chave=None):
+    """Registro que substitui o resultado de um arquivo reconhecido como duplicata"""
+    return {
+        'arquivo': os.path.basename(filepath),
+        'sha256': sha256,
+        'chave_acesso': chave,
+        'duplicata_de': canonico,
+        'motivo_duplicata': motivo,
+    }
+
+def check_duplicate_before_ocr(filepath, img, info, opts):
+    """Consulta o índice com a chave do código de barras e o dHash da primeira página"""
+    dedup = get_worker_dedup(opts)
+    if not dedup:
+        return
+    caminho = os.path.abspath(filepath)
+    with stage('dhash'):
+        gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        dhash = dhash_image(gray)
+    info['dhash'] = f'{dhash:016x}'
+    if info['chave_codigo_barras']:
+        found = dedup.by_chave(info['chave_codigo_barras'])
+        if found and found[0] != caminho:
+            raise DuplicataEncontrada(found[0], 'chave', info['chave_codigo_barras'])
+    found = dedup.by_dhash(dhash)
+    if found and found[0] != caminho:
+        info['possivel_duplicata_de'] = found[0]
+
+def find_canonical(dedup, filepath, invoice_data):
+    """Canônico (caminho, motivo) de um resultado, ou None após registrá-lo como canônico"""
+    if invoice_data.get('duplicata_de'):
+        return invoice_data['duplicata_de'], invoice_data['motivo_duplicata']
+    caminho = dedup_path(filepath, invoice_data)
+    chave = invoice_data.get('chave_acesso')
+    metodo = invoice_data.get('metodo_extracao')
+    if chave_valida(chave):
+        found = dedup.by_chave(chave)
+        if found and found[0] != caminho and not (metodo == 'xml' and found[1] != 'xml'):
+            return found[0], 'chave'
+    dhash = invoice_data.get('dhash')
+    dedup.add(caminho, invoice_data.get('sha256'), chave if chave_valida(chave) else None, metodo,
+              int(dhash, 16) if dhash else None)
+    return None
+
+# Conexão de leitura do índice de duplicatas, aberta uma vez por processo worker (ou thread de E/S)
+_worker_dedup = {}
+
+def get_worker_dedup(opts):
+    """Retorna a conexão do índice de duplicatas do processo/thread atual (ou None se desabilitado)"""
+    if not opts.dedup_path or not os.path.exists(opts.dedup_path):
+        return None
+    key = (os.getpid(), threading.get_ident(), opts.dedup_path)
+    if key not in _worker_dedup:
+        _worker_dedup[key] = IndiceDuplicatas(opts.dedup_path, readonly=True)
+    return _worker_dedup[key]
+
+# ------------------------------ Arquivo de Textos ------------------------------
+class ArquivoTextos:
+    """Arquivo persistente (SQLite) do texto extraído de cada conteúdo, por SHA256"""
+
+    def __init__(self, path, versao=None, readonly=False):
+        self.path = path
+        self.versao = versao
+        if not readonly:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        if not readonly:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS textos ('
+                ' sha256 TEXT PRIMARY KEY,'
+                ' arquivo TEXT NOT NULL,'
+                ' texto BLOB NOT NULL,'
+                ' info TEXT NOT NULL,'
+                ' versao TEXT,'
+                ' registrado_em REAL NOT NULL)'
+            )
+            self.conn.commit()
+
+    def put(self, invoice_data, texto, commit=True):
+        """Grava o texto de uma nota; um novo OCR do mesmo conteúdo substitui o anterior"""
+        info = {key: invoice_data.get(key) for key in new_extraction_info()}
+        self.conn.execute(
+            'INSERT INTO textos (sha256, arquivo, texto, info, versao, registrado_em) '
+            'VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (sha256) DO UPDATE SET texto = excluded.texto, info = excluded.info, '
+            ' versao = excluded.versao, registrado_em = excluded.registrado_em',
+            (invoice_data['sha256'], invoice_data['arquivo'],
+             zlib.compress(texto.encode('utf-8'), TEXTO_COMPRESSAO),
+             json.dumps(info, ensure_ascii=False), self.versao, time.time())
+        )
+        if commit:
+            self.conn.commit()
+
+    def _row(self, row):
+        sha256, arquivo, texto, info = row
+        return sha256, arquivo, zlib.decompress(texto).decode('utf-8'), json.loads(info)
+
+    def get(self, sha256):
+        """Retorna (sha256, arquivo, texto, info) do conteúdo ou None"""
+        row = self.conn.execute(
+            'SELECT sha256, arquivo, texto, info FROM textos WHERE sha256 = ?', (sha256,)
+        ).fetchone()
+        return self._row(row) if row else None
+
+    def rowid_ranges(self, size):
+        """Faixas [primeiro, último] de rowid com até ``size`` textos cada (tarefas do reparse)"""
+        first, last = self.conn.execute('SELECT MIN(rowid), MAX(rowid) FROM textos').fetchone()
+        if first is None:
+            return []
+        return [(start, min(start + size - 1, last)) for start in range(first, last + 1, size)]
+
+    def iter_range(self, first, last):
+        """Gera (sha256, arquivo, texto, info) dos textos com rowid entre ``first`` e ``last``"""
+        rows = self.conn.execute(
+            'SELECT sha256, arquivo, texto, info FROM textos WHERE rowid BETWEEN ? AND ? ORDER BY rowid',
+            (first, last)
+        )
+        for row in rows:
+            yield self._row(row)
+
+    def commit(self):
+        self.conn.commit()
+
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM textos').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+# Conexão de leitura do arquivo de textos, aberta uma vez por worker do reparse
+_worker_textos = {}
+
+def get_worker_textos(path):
+    key = (os.getpid(), path)
+    if key not in _worker_textos:
+        _worker_textos[key] = ArquivoTextos(path, readonly=True)
+    return _worker_textos[key]
+
+# ------------------------------ Journal de Processamento ------------------------------
+class JournalProcessamento:
+    """Journal (write-ahead) de um lote, gravado em JSONL no diretório de saída"""
+
+    def __init__(self, path, resume=False, sync_every=100):
+        self.path = path
+        self.sync_every = sync_every
+        self._pending_sync = 0
+        # As entradas 'pendente' vêm da thread que alimenta o pipeline
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        # Uma queda pode ter deixado a última linha pela metade: recomeça numa linha nova
+        if resume and self.file.tell() > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+
+    def _write(self, entry):
+        entry['ts'] = time.time()
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()
+            self._pending_sync += 1
+            if self._pending_sync >= self.sync_every:
+                self.sync()
+
+    def pending(self, filepath):
+        self._write({'arquivo': os.path.abspath(filepath), 'status': 'pendente'})
+
+    def done(self, filepath, invoice_data, items):
+        self._write({
+            'arquivo': os.path.abspath(filepath),
+            'status': 'ok',
+            'sha256': invoice_data.get('sha256'),
+            'nota': invoice_data,
+            'itens': [asdict(item) for item in items],
+        })
+
+    def failed(self, filepath, error=None):
+        self._write({'arquivo': os.path.abspath(filepath), 'status': 'falha', 'erro': error})
+
+    def skipped(self, filepath, reason):
+        self._write({'arquivo': os.path.abspath(filepath), 'status': 'ignorado', 'motivo': reason})
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self._pending_sync = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+    @staticmethod
+    def iter_entries(path):
+        """Entradas do journal em ordem (linhas truncadas por uma queda são ignoradas)"""
+        if not os.path.exists(path):
+            return
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Linha inválida ignorada no journal {path}")
+
+def journal_finished_files(path):
+    """Caminhos absolutos dos arquivos concluídos (com sucesso ou ignorados) no journal"""
+    return {entry['arquivo'] for entry in JournalProcessamento.iter_entries(path)
+            if entry.get('status') in ('ok', 'ignorado')}
+
+def iter_journal_done(path):
+    """Entradas 'ok' do journal, uma por nota (repetições de um arquivo reprocessado são puladas)"""
+    seen = set()
+    for entry in JournalProcessamento.iter_entries(path):
+        if entry.get('status') != 'ok':
+            continue
+        key = (entry['arquivo'], entry.get('sha256'), entry['nota'].get('chave_acesso'))
+        if key in seen:
+            continue
+        seen.add(key)
+        yield entry
+
+def iter_journal_results(path):
+    """Gera (invoice_data, items) de cada nota concluída no journal, sem repetições"""
+    for entry in iter_journal_done(path):
+        yield entry['nota'], [ItemNota(**item) for item in entry['itens']]
+
+def load_journal_results(path):
+    """Carrega os resultados do journal nas listas usadas por export_results"""
+    index_data, items_data = [], []
+    for invoice_data, items in iter_journal_results(path):
+        index_data.append(invoice_data)
+        items_data.extend(items)
+    return index_data, items_data
+
 # ------------------------------ Parsing Principal ------------------------------
-def parse_invoice_data(text, filename):
+def parse_invoice_data(text, filename, chave_conhecida=None, layout=False):
     """Extrai dados principais da nota fiscal"""
-    normalized = normalize_text(text)
+    normalized = normalize_text(text, layout)
     upper_text = normalized.upper()
-    no_spaces = upper_text.replace(' ', '')
+    no_spaces = upper_text.replace(' ', '').replace('\n', '').replace('\t', '')
     
     # Chave de acesso
-    chave_match = re.search(r'(\d{44})', no_spaces)
-    chave_acesso = chave_match.group(1) if chave_match else None
-    
-    # Tipo de documento
-    doc_type = "NF-e"
-    if any(x in upper_text for x in ['NFS-E', 'NOTA FISCAL DE SERVI']):
-        doc_type = "NFS-e"
-    elif any(x in upper_text for x in ['CT-E', 'CONHECIMENTO']):
-        doc_type = "CT-e"
-    elif any(x in upper_text for x in ['CCE', 'CARTA DE CORRECAO']):
-        doc_type = "CC-e"
+    chave_texto = find_chave(no_spaces)
+    chave_acesso = chave_conhecida or chave_texto
+    campos_chave = decode_chave_acesso(chave_acesso)
     
     # CNPJs
-    cnpjs = re.findall(CNPJ_RE, upper_text)
-    cnpj_emit = clean_number(cnpjs[0]) if cnpjs else None
-    cnpj_dest = clean_number(cnpjs[1]) if len(cnpjs) > 1 else None
-    
-    # Número e série
-    num_match = re.search(r'N[ºO]?\s*[:\-]?\s*(\d{1,12})', upper_text)
-    numero = num_match.group(1) if num_match else None
+    cnpjs = CNPJ_RX.findall(upper_text)
+    if campos_chave:
+        cnpj_emit = campos_chave['cnpj_emitente']
+        outros = [c for c in map(clean_number, cnpjs) if c != cnpj_emit]
+        cnpj_dest = outros[0] if outros else None
+    else:
+        cnpj_emit = clean_number(cnpjs[0]) if cnpjs else None
+        cnpj_dest = clean_number(cnpjs[1]) if len(cnpjs) > 1 else None
     
-    serie_match = re.search(r'S[ÉE]RIE?\s*[:\-]?\s*(\d{1,5}|\w{1,3})', upper_text)
-    serie = serie_match.group(1) if serie_match else None
+    if campos_chave:
+        doc_type = campos_chave['tipo'] or detect_doc_type(upper_text)
+        numero, serie = campos_chave['numero_nf'], campos_chave['serie']
+    else:
+        # Tipo de documento
+        doc_type = detect_doc_type(upper_text)
+        
+        # Número e série
+        num_match = NUMERO_RX.search(upper_text)
+        numero = normalize_numero_nf(num_match.group(1)) if num_match else None
+        
+        serie_match = SERIE_RX.search(upper_text)
+        serie = normalize_serie(serie_match.group(1)) if serie_match else None
     
     # Data de emissão
     data_emissao = parse_date(text)
     
     # Valor total
-    valor_total = None
-    for pattern in VALOR_PATS:
-        match = re.search(pattern, upper_text)
-        if match:
-            valor_total = parse_money(match.group(1))
-            if valor_total:
-                break
+    valor_total = find_total_value(upper_text)
     
-    # Razões sociais (tentativa inteligente)
+    # Razões sociais (tentativa inteligente); a busca de CNPJ por linha é feita
+    # uma única vez e compartilhada com a extração de endereço
     lines = [line.strip() for line in normalized.split('\n') if line.strip()]
-    razao_emit, razao_dest = find_company_names(lines, cnpjs)
+    cnpj_flags = [bool(CNPJ_RX.search(line)) for line in lines]
+    zonas = line_zones(lines) if layout else None
+    razao_emit, razao_dest = find_company_names(lines, cnpjs, cnpj_flags, zonas)
     
     # UF
-    uf_match = re.search(UF_RE, upper_text)
-    uf = uf_match.group(1) if uf_match else None
+    if campos_chave:
+        uf = campos_chave['uf']
+    else:
+        uf_match = UF_RX.search(upper_text)
+        uf = uf_match.group(1) if uf_match else None
     
     # Bloco de itens
     itens_block = extract_text_block(normalized, ITEMS_START, ITEMS_END)
     
     # Endereço e município
-    endereco, municipio = extract_address(lines)
+    endereco, municipio = extract_address(lines, cnpj_flags)
     
     # IE
     ie_emit = extract_ie(lines)
     
-    return {
+    invoice_data = {
         'arquivo': filename,
         'tipo': doc_type,
         'chave_acesso': chave_acesso,
@@ -389,30 +1822,64 @@ def parse_invoice_data(text, filename):
         'itens_raw': itens_block,
         'endereco_emitente': endereco,
         'municipio_emitente': municipio,
-        'ie_emitente': ie_emit
+        'ie_emitente': ie_emit,
+        'mes_emissao': campos_chave['mes_emissao'] if campos_chave else None,
+        'chave_valida': campos_chave is not None if chave_acesso else None,
     }
+    if chave_conhecida:
+        invoice_data['chave_confere_codigo_barras'] = chave_texto == chave_conhecida if chave_texto else None
+    return invoice_data
+
+def find_total_value(upper_text):
+    """Valor total pelo padrão de VALOR_PATS de maior prioridade que casar"""
+    first = {}
+    for match in VALOR_RX.finditer(upper_text):
+        first.setdefault(match.lastgroup, match.group(match.lastgroup))
+        if match.lastgroup == 'v0' and parse_money(first['v0']):
+            break
+    for i in range(len(VALOR_PATS)):
+        if f'v{i}' in first:
+            valor_total = parse_money(first[f'v{i}'])
+            if valor_total:
+                return valor_total
+            for pattern in VALOR_RXS[i + 1:]:
+                match = pattern.search(upper_text)
+                valor_total = parse_money(match.group(1)) if match else None
+                if valor_total:
+                    return valor_total
+            return None
+    return None
 
-def find_company_names(lines, cnpjs_found):
+def find_company_names(lines, cnpjs_found, cnpj_flags=None, zonas=None):
     """Encontra razões sociais próximas aos CNPJs"""
     razao_emit, razao_dest = None, None
-    cnpj_lines = []
+    if cnpj_flags is None:
+        cnpj_flags = [bool(CNPJ_RX.search(line)) for line in lines]
     
-    # Encontra linhas com CNPJ
-    for i, line in enumerate(lines):
-        if re.search(CNPJ_RE, line):
-            cnpj_lines.append(i)
+    # Linhas com CNPJ
+    cnpj_lines = [i for i, has_cnpj in enumerate(cnpj_flags) if has_cnpj]
+    por_zona = zonas is not None and 'destinatario' in zonas[0]
+    if por_zona:
+        zona_linha, titulos = zonas
+        cnpj_lines = [next((i for i in cnpj_lines if zona_linha[i] == zona), None)
+                      for zona in ('emitente', 'destinatario')]
     
     for i, cnpj_line_idx in enumerate(cnpj_lines):
+        if cnpj_line_idx is None:
+            continue
         # Procura até 3 linhas acima do CNPJ
         for j in range(1, 4):
             candidate_line = cnpj_line_idx - j
             if candidate_line >= 0:
                 candidate = lines[candidate_line]
+                if por_zona and (zona_linha[candidate_line] != zona_linha[cnpj_line_idx] or
+                                 titulos[candidate_line] or is_label_or_address(candidate)):
+                    continue
                 # Verifica se parece ser um nome de empresa
                 if (len(candidate) > 5 and len(candidate) < 100 and
-                    not re.search(CNPJ_RE, candidate) and
-                    not re.search(CPF_RE, candidate) and
-                    not re.search(r'\d{4,}', candidate)):
+                    not cnpj_flags[candidate_line] and
+                    not CPF_RX.search(candidate) and
+                    not DIGITS4_RX.search(candidate)):
                     if i == 0 and not razao_emit:
                         razao_emit = candidate
                     elif i == 1 and not razao_dest:
@@ -421,41 +1888,56 @@ def find_company_names(lines, cnpjs_found):
     
     return razao_emit, razao_dest
 
-def extract_address(lines):
+def is_label_or_address(line):
+    """Linha de rótulo (CNPJ/CPF, razão social) ou de endereço/município"""
+    upper_line = line.upper()
+    return bool(ROTULOS_RX.search(upper_line) or MUNICIPIO_RX.search(line)
+                or any(x in upper_line for x in ENDERECO_PREFIXOS))
+
+def extract_address(lines, cnpj_flags=None):
     """Extrai endereço e município"""
     endereco, municipio = None, None
+    if cnpj_flags is None:
+        cnpj_flags = [bool(CNPJ_RX.search(line)) for line in lines]
     
     for i, line in enumerate(lines):
         upper_line = line.upper()
         # Procura por padrões de endereço
-        if any(x in upper_line for x in ['RUA ', 'AV ', 'AVENIDA ', 'RODOVIA ', 'TRAVESSA ']):
+        if any(x in upper_line for x in ENDERECO_PREFIXOS):
             # Combina com linha seguinte se necessário
             address_parts = [line]
-            if i + 1 < len(lines) and not re.search(CNPJ_RE, lines[i + 1]):
+            if i + 1 < len(lines) and not cnpj_flags[i + 1]:
                 address_parts.append(lines[i + 1])
             endereco = ' '.join(address_parts)
         
         # Procura município
-        if not municipio and re.search(r',\s*[A-Z][A-Z]\s*$', line):
-            municipio = re.sub(r',\s*[A-Z][A-Z]\s*$', '', line).strip()
+        if not municipio:
+            municipio_match = MUNICIPIO_RX.search(line)
+            if municipio_match:
+                municipio = line[:municipio_match.start()].strip()
     
     return endereco, municipio
 
 def extract_ie(lines):
     """Extrai Inscrição Estadual"""
     for line in lines:
-        ie_match = re.search(IE_RE, line, re.IGNORECASE)
+        ie_match = IE_RX.search(line)
         if ie_match and ie_match.group(1).upper() != 'ISENTO':
             return ie_match.group(1)
     return None
 
-def parse_items_detailed(block_text, chave_acesso, filename):
+def parse_items_detailed(block_text, chave_acesso, filename, layout=False):
     """Analisa detalhadamente os itens da nota"""
     if not block_text:
         return []
     
     items = []
     lines = [line.strip() for line in block_text.split('\n') if line.strip()]
+    if layout:
+        # Tabela reconstruída pelo OCR com layout: colunas separadas por tabulação
+        if any('\t' in line for line in lines[:2]):
+            return parse_table_items(lines, chave_acesso, filename)
+        return parse_layout_lines(lines, chave_acesso, filename)
     
     current_item = {}
     item_lines = []
@@ -468,7 +1950,7 @@ def parse_items_detailed(block_text, chave_acesso, filename):
             continue
         
         # Tenta identificar fim do item atual
-        if current_item and (re.search(r'\d+[,.]\d{2}$', line) or len(item_lines) >= 3):
+        if current_item and (ITEM_END_RX.search(line) or len(item_lines) >= 3):
             # Processa item completo
             item_data = parse_single_item(item_lines, chave_acesso, filename)
             if item_data:
@@ -486,21 +1968,78 @@ def parse_items_detailed(block_text, chave_acesso, filename):
     
     return items
 
+def parse_layout_lines(lines, chave_acesso, filename):
+    """Itens do texto do OCR com layout sem tabela reconhecida: um item por linha com valor"""
+    items = []
+    item_lines = []
+    
+    for line in lines:
+        upper_line = line.upper()
+        
+        # Ignora o título do bloco, cabeçalhos e totais
+        if (any(x in upper_line for x in ITEMS_START) or
+                any(x in upper_line for x in ['COD', 'NCM', 'CFOP', 'QTD', 'UNIT', 'TOTAL', 'UNID'])):
+            continue
+        
+        item_lines.append(line)
+        
+        # O item termina na linha que fecha com um valor (ou após 3 linhas)
+        if ITEM_END_RX.search(line) or len(item_lines) >= 3:
+            item_data = parse_single_item(item_lines, chave_acesso, filename)
+            if item_data:
+                items.append(item_data)
+            item_lines = []
+    
+    if item_lines:
+        item_data = parse_single_item(item_lines, chave_acesso, filename)
+        if item_data:
+            items.append(item_data)
+    
+    return items
+
+def parse_table_items(lines, chave_acesso, filename):
+    """Itens da tabela remontada pelo OCR com layout (colunas separadas por tabulação)"""
+    header = next(i for i, line in enumerate(lines) if '\t' in line)
+    columns = table_columns(lines[header].split('\t'))
+    items = []
+    for line in lines[header + 1:]:
+        if '\t' not in line:
+            continue
+        cells = {campo: cell for campo, cell in zip(columns, line.split('\t')) if campo and cell}
+        vl_total = parse_decimal(cells.get('vl_total'))
+        if not cells.get('descricao') and vl_total is None:
+            continue
+        ncm = NCM_RX.search(cells.get('ncm', ''))
+        cfop = CFOP_RX.search(cells.get('cfop', ''))
+        items.append(ItemNota(
+            chave_acesso=chave_acesso,
+            arquivo=filename,
+            descricao=cells.get('descricao', ''),
+            ncm=ncm.group(1) if ncm else None,
+            cfop=cfop.group(1) if cfop else None,
+            qtd=parse_decimal(cells.get('qtd')),
+            unidade=cells.get('unidade'),
+            vl_unit=parse_decimal(cells.get('vl_unit')),
+            vl_total=vl_total,
+            linha_ocr=' '.join(cell for cell in line.split('\t') if cell)
+        ))
+    return items
+
 def parse_single_item(lines, chave_acesso, filename):
     """Analisa um único item da nota"""
     full_text = ' '.join(lines)
     
     # NCM
-    ncm_match = re.search(r'\b(\d{8})\b', full_text)
+    ncm_match = NCM_RX.search(full_text)
     ncm = ncm_match.group(1) if ncm_match else None
     
     # CFOP
-    cfop_match = re.search(r'\b([123456]\d{3})\b', full_text)
+    cfop_match = CFOP_RX.search(full_text)
     cfop = cfop_match.group(1) if cfop_match else None
     
     # Quantidade
     qtd = None
-    qtd_match = re.search(r'(\d+[,.]?\d*)\s*(KG|UN|M|M2|M3|LT|CX|PC)', full_text.upper())
+    qtd_match = QTD_RX.search(full_text.upper())
     if qtd_match:
         qtd = parse_money(qtd_match.group(1))
     
@@ -525,15 +2064,9 @@ def extract_values_from_text(text):
     vl_unit = vl_total = None
     
     # Procura padrões de valores
-    value_patterns = [
-        r'(\d+[.,]\d{2})\s*$',  # Valor no final da linha
-        r'R\$\s*(\d+[.,]\d+)',  # Formato R$
-        r'(\d{1,3}(?:[.,]\d{3})*[.,]\d{2})',  # Formato com milhares
-    ]
-    
     values = []
-    for pattern in value_patterns:
-        matches = re.findall(pattern, text)
+    for pattern in ITEM_VALUE_RXS:
+        matches = pattern.findall(text)
         for match in matches:
             value = parse_money(match)
             if value and value > 0:
@@ -549,127 +2082,1102 @@ def extract_values_from_text(text):
     
     return vl_unit, vl_total
 
+# ------------------------------ XML da NF-e ------------------------------
+def is_xml_source(filepath):
+    return filepath.lower().endswith(EXTENSOES_XML)
+
+def _xml_float(value):
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+def _xml_children(elem):
+    """Filhos diretos de um elemento por nome local (sem namespace)"""
+    return {child.tag.rpartition('}')[2]: child for child in elem} if elem is not None else {}
+
+def _xml_texts(elem):
+    """Texto dos filhos diretos de um elemento por nome local"""
+    return {child.tag.rpartition('}')[2]: child.text for child in elem} if elem is not None else {}
+
+def parse_nfe_element(inf, arquivo, sha256):
+    """Converte um elemento infNFe em (invoice_data, items) no formato do OCR"""
+    sections, dets = {}, []
+    for child in inf:
+        tag = child.tag.rpartition('}')[2]
+        if tag == 'det':
+            dets.append(child)
+        else:
+            sections[tag] = child
+    ide = _xml_texts(sections.get('ide'))
+    emit_group = _xml_children(sections.get('emit'))
+    emit = _xml_texts(sections.get('emit'))
+    ender = _xml_texts(emit_group.get('enderEmit'))
+    dest = _xml_texts(sections.get('dest'))
+    totais = _xml_texts(_xml_children(sections.get('total')).get('ICMSTot'))
+    
+    chave = (inf.get('Id') or '')[3:] or None
+    campos_chave = decode_chave_acesso(chave)
+    data_emissao = ide.get('dhEmi') or ide.get('dEmi')
+    logradouro = ', '.join(filter(None, (ender.get('xLgr'), ender.get('nro'))))
+    
+    invoice_data = {
+        'arquivo': arquivo,
+        'tipo': MODELOS_DOCUMENTO.get(ide.get('mod'), 'NF-e'),
+        'chave_acesso': chave,
+        'numero_nf': campos_chave['numero_nf'] if campos_chave else normalize_numero_nf(ide.get('nNF')),
+        'serie': campos_chave['serie'] if campos_chave else normalize_serie(ide.get('serie')),
+        'data_emissao': data_emissao[:10] if data_emissao else None,
+        'cnpj_emitente': emit.get('CNPJ') or emit.get('CPF'),
+        'razao_emitente': emit.get('xNome'),
+        'cnpj_destinatario': dest.get('CNPJ') or dest.get('CPF'),
+        'razao_destinatario': dest.get('xNome'),
+        'uf': ender.get('UF'),
+        'valor_total': _xml_float(totais.get('vNF')),
+        'itens_raw': None,
+        'endereco_emitente': logradouro or None,
+        'municipio_emitente': ender.get('xMun'),
+        'ie_emitente': emit.get('IE'),
+        'mes_emissao': campos_chave['mes_emissao'] if campos_chave else None,
+        'chave_valida': campos_chave is not None if chave else None,
+        'sha256': sha256,
+    }
+    invoice_data.update(new_extraction_info())
+    invoice_data['metodo_extracao'] = 'xml'
+    
+    items = []
+    for det in dets:
+        prod = _xml_texts(_xml_children(det).get('prod'))
+        if not prod:
+            continue
+        items.append(ItemNota(
+            chave_acesso=chave,
+            arquivo=arquivo,
+            descricao=prod.get('xProd') or "",
+            ncm=prod.get('NCM'),
+            cfop=prod.get('CFOP'),
+            qtd=_xml_float(prod.get('qCom')),
+            unidade=prod.get('uCom'),
+            vl_unit=_xml_float(prod.get('vUnCom')),
+            vl_total=_xml_float(prod.get('vProd')),
+            linha_ocr="",
+        ))
+    return invoice_data, items
+
+class _LeitorComHash:
+    """Arquivo somente leitura que atualiza um SHA256 com tudo o que é lido"""
+
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self._f.read(size)
+        self._hash.update(chunk)
+        return chunk
+
+    def drain(self):
+        """Lê o que o parser deixou de fora (o hash cobre o arquivo inteiro)"""
+        for chunk in iter(lambda: self.read(1 << 20), b''):
+            pass
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+def iter_nfe_xml(source, arquivo, sha256):
+    """Lê as NF-e de um XML (nfeProc, NFe avulsa ou lote) com iterparse"""
+    if isinstance(source, bytes):
+        root = ET.fromstring(source)
+        ns = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+        for inf in root.iter(f'{ns}infNFe'):
+            yield parse_nfe_element(inf, arquivo, sha256)
+        return
+    for _, elem in ET.iterparse(source, events=('end',)):
+        tag = elem.tag.rpartition('}')[2]
+        if tag == 'infNFe':
+            yield parse_nfe_element(elem, arquivo, sha256)
+            elem.clear()
+        elif tag in ('NFe', 'protNFe', 'nfeProc'):
+            # Assinatura e protocolo do documento já lido
+            elem.clear()
+
+def read_xml_documents(filepath, sha256=None):
+    """(invoice_data, items) de todas as NF-e de um .xml ou dos .xml de um .zip"""
+    name = os.path.basename(filepath)
+    if not filepath.lower().endswith('.zip'):
+        if sha256:
+            return list(iter_nfe_xml(filepath, name, sha256))
+        # Hash calculado durante o próprio parsing: o arquivo é lido uma única vez
+        with open(filepath, 'rb') as f:
+            reader = _LeitorComHash(f)
+            docs = list(iter_nfe_xml(reader, name, None))
+            reader.drain()
+        for invoice_data, _ in docs:
+            invoice_data['sha256'] = reader.hexdigest()
+        return docs
+    
+    docs = []
+    with zipfile.ZipFile(filepath) as archive:
+        for member in archive.infolist():
+            if member.is_dir() or not member.filename.lower().endswith('.xml'):
+                continue
+            data = archive.read(member)
+            arquivo = f"{name}#{os.path.basename(member.filename)}"
+            try:
+                docs.extend(iter_nfe_xml(data, arquivo, hashlib.sha256(data).hexdigest()))
+            except ET.ParseError as e:
+                logger.warning(f"XML inválido {arquivo}: {e}")
+    return docs
+
+def prefer_xml_results(index_data, items_data):
+    """Remove as notas extraídas por OCR cuja chave também veio de um XML"""
+    chaves_xml = {inv['chave_acesso'] for inv in index_data
+                  if inv.get('metodo_extracao') == 'xml' and inv.get('chave_acesso')}
+    if not chaves_xml:
+        return index_data, items_data
+    dropped = {(inv['arquivo'], inv['chave_acesso']) for inv in index_data
+               if inv.get('metodo_extracao') != 'xml' and inv.get('chave_acesso') in chaves_xml}
+    if dropped:
+        logger.info(f"{len(dropped)} notas por OCR substituídas pelo XML de mesma chave")
+        index_data = [inv for inv in index_data if inv.get('metodo_extracao') == 'xml'
+                      or (inv['arquivo'], inv.get('chave_acesso')) not in dropped]
+        items_data = [item for item in items_data if (item.arquivo, item.chave_acesso) not in dropped]
+    return index_data, items_data
+
+# ------------------------------ Descoberta de Arquivos ------------------------------
+def shard_of(key, total):
+    """Shard (1..total) de uma chave de partição: o mesmo em qualquer máquina e execução"""
+    return int.from_bytes(hashlib.sha256(key.encode('utf-8')).digest()[:8], 'big') % total + 1
+
+def shard_key(path, root, shard_by='path'):
+    """Chave de partição de um arquivo: caminho relativo à entrada ou hash do início do conteúdo"""
+    if shard_by == 'hash':
+        try:
+            with open(path, 'rb') as f:
+                prefixo = f.read(SHARD_HASH_PREFIXO)
+                tamanho = os.fstat(f.fileno()).st_size
+            return f"{hashlib.sha256(prefixo).hexdigest()}:{tamanho}"
+        except OSError:
+            pass  # o erro de leitura aparece no processamento, num único shard
+    return os.path.relpath(path, root).replace(os.sep, '/')
+
+def iter_input_files(inputs, extensions=EXTENSOES_ENTRADA, recursive=True, shard=None, shard_by='path'):
+    """Gera os arquivos a processar à medida que a árvore é percorrida"""
+    extensions = tuple(ext.lower() for ext in extensions)
+    seen_dirs = set()
+    seen_files = set()
+    
+    def owned(path, root):
+        return shard is None or shard_of(shard_key(path, root, shard_by), shard[1]) == shard[0]
+    
+    def walk(path, root):
+        real = os.path.realpath(path)
+        if real in seen_dirs:
+            return
+        seen_dirs.add(real)
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: (not is_xml_source(entry.name), entry.name))
+        except OSError as e:
+            logger.warning(f"Não foi possível ler o diretório {path}: {e}")
+            return
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_file():
+                    if entry.name.lower().endswith(extensions) and owned(entry.path, root):
+                        yield entry.path
+                elif recursive and entry.is_dir():
+                    subdirs.append(entry.path)
+            except OSError:
+                continue
+        for subdir in subdirs:
+            yield from walk(subdir, root)
+    
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            yield from walk(input_path, input_path)
+        elif input_path not in seen_files:
+            seen_files.add(input_path)
+            if owned(input_path, os.path.dirname(input_path) or '.'):
+                yield input_path
+
 # ------------------------------ Processamento Principal ------------------------------
-def process_single_file(filepath):
+def read_chave_codigo_barras(img, opts):
+    """Chave de acesso lida do código de barras/QR Code da página (None se desabilitado ou ausente)"""
+    if not opts.codigo_barras:
+        return None
+    with stage('codigo_barras'):
+        return detect_chave_codigo_barras(img)
+
+def recognize(processed_img, opts, chave_conhecida=None):
+    """OCR da imagem pré-processada no modo escolhido: (texto, config, score, passadas)"""
+    if opts.layout:
+        return layout_ocr(processed_img, chave_conhecida)
+    return smart_ocr_detailed(processed_img, opts.ocr_strategy, chave_conhecida)
+
+def ocr_image(img, opts, chave_conhecida=None, retry_heavy=True):
+    """Pré-processa e executa o OCR de uma imagem"""
+    if opts.preprocess == 'auto':
+        with stage('qualidade'):
+            gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            profile = choose_preprocess_profile(estimate_image_quality(gray))
+    else:
+        profile = opts.preprocess
+    
+    with stage('preprocess'):
+        processed_img = advanced_preprocess(img, profile)
+    with stage('ocr'):
+        text, config, score, passes = recognize(processed_img, opts, chave_conhecida)
+    
+    if retry_heavy and opts.preprocess == 'auto' and profile != 'heavy' and score < opts.text_layer_min_score:
+        logger.debug(f"Perfil {profile} insuficiente (score {score}), refazendo com 'heavy'")
+        profile = 'heavy'
+        with stage('preprocess'):
+            processed_img = advanced_preprocess(img, profile)
+        with stage('ocr'):
+            retry = recognize(processed_img, opts, chave_conhecida)
+        passes += retry[3]
+        if retry[2] >= score:
+            text, config, score = retry[:3]
+        return text, config, score, passes, profile, 2
+    return text, config, score, passes, profile, 1
+
+def items_block_open(text):
+    """Indica se o bloco de itens começou e ainda não terminou no texto"""
+    upper_text = normalize_text(text).upper()
+    for pattern in ITEMS_START:
+        start_pos = upper_text.find(pattern)
+        if start_pos != -1:
+            return not any(upper_text.find(end, start_pos + 1) != -1 for end in ITEMS_END)
+    return False
+
+def new_extraction_info():
+    """Metadados de extração anexados a cada nota"""
+    return {
+        'metodo_extracao': None,
+        'ocr_config': None,
+        'ocr_score': None,
+        'ocr_passadas': None,
+        # Imagens entregues ao OCR (páginas, refeitas com 'heavy' ou em outra resolução)
+        'ocr_leituras': None,
+        'paginas_processadas': 0,
+        'chave_codigo_barras': None,
+        'perfil_preprocessamento': None,
+        'dpi_ocr': None,
+        'dpi_escalado': None,
+        'dhash': None,
+        'possivel_duplicata_de': None,
+    }
+
+def ocr_pdf_page(filepath, page, opts, info, page_num):
+    """Renderiza e executa o OCR de uma página de PDF, atualizando info"""
+    if page_num > 0:
+        dpis = [info['dpi_ocr'] or opts.dpi]
+    elif opts.dpi_inicial and opts.dpi_inicial < opts.dpi:
+        dpis = [opts.dpi_inicial, opts.dpi]
+    else:
+        dpis = [opts.dpi]
+    
+    best = None
+    for attempt, dpi in enumerate(dpis):
+        with stage('render'):
+            img = render_page(page, dpi)
+        if page_num == 0 and not info['chave_codigo_barras']:
+            info['chave_codigo_barras'] = read_chave_codigo_barras(img, opts)
+        if page_num == 0 and attempt == 0:
+            check_duplicate_before_ocr(filepath, img, info, opts)
+        last = attempt == len(dpis) - 1
+        text, config, score, passes, profile, readings = ocr_image(img, opts, info['chave_codigo_barras'],
+                                                                   retry_heavy=last)
+        info['ocr_passadas'] = (info['ocr_passadas'] or 0) + passes
+        info['ocr_leituras'] = (info['ocr_leituras'] or 0) + readings
+        
+        missing = missing_critical_fields(text, info['chave_codigo_barras']) if len(dpis) > 1 else []
+        # Em empate de campos prevalece a leitura de maior resolução
+        if best is None or len(missing) <= best[0]:
+            best = (len(missing), text, config, score, profile, dpi)
+        if not missing:
+            break
+        if not last:
+            logger.debug(f"Página {page_num + 1} a {dpi} DPI sem {', '.join(missing)}: "
+                         f"re-renderizando a {dpis[attempt + 1]} DPI")
+    
+    _, text, config, score, profile, dpi = best
+    if info['ocr_config'] is None:
+        info['ocr_config'], info['ocr_score'] = config, score
+        info['perfil_preprocessamento'] = profile
+    if page_num == 0:
+        info['dpi_ocr'] = dpi
+        if len(dpis) > 1:
+            info['dpi_escalado'] = attempt > 0
+    return text
+
+def extract_pdf_text(filepath, opts, data=None):
+    """Extrai o texto de um PDF página a página, renderizando só o necessário"""
+    info = new_extraction_info()
+    texts = []
+    with (fitz.open(filepath) if data is None else fitz.open(stream=data, filetype='pdf')) as doc:
+        last_page = min(len(doc), opts.max_pages if opts.multipage else 1)
+        for page_num in range(last_page):
+            if page_num > 0 and not items_block_open('\n'.join(texts)):
+                break
+            page = doc.load_page(page_num)
+            
+            # PDFs gerados digitalmente já trazem texto: evita rasterização + OCR
+            page_text = ""
+            if opts.text_layer != 'off' and info['metodo_extracao'] != 'ocr':
+                with stage('text_layer'):
+                    page_text = page_text_layer(page)
+                if page_num == 0:
+                    if page_text.strip() and score_nf_text(page_text) >= opts.text_layer_min_score:
+                        info['metodo_extracao'] = 'texto_pdf'
+                    else:
+                        if page_text.strip():
+                            logger.debug(f"Camada de texto insuficiente em {filepath}, usando OCR")
+                        page_text = ""
+            
+            if not page_text.strip():
+                if info['metodo_extracao'] is None:
+                    info['metodo_extracao'] = 'ocr'
+                page_text = ocr_pdf_page(filepath, page, opts, info, page_num)
+            
+            texts.append(page_text)
+            info['paginas_processadas'] += 1
+    
+    return '\n'.join(texts), info
+
+def extract_image_text(filepath, opts, data=None):
+    """Executa o OCR de um arquivo de imagem; info é None se a imagem não puder ser lida"""
+    with stage('decode_imagem'):
+        if data is None:
+            img = cv2.imread(filepath)
+        else:
+            img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) if len(data) else None
+    if img is None:
+        logger.warning(f"Não foi possível ler imagem: {filepath}")
+        return "", None
+    info = new_extraction_info()
+    info['chave_codigo_barras'] = read_chave_codigo_barras(img, opts)
+    check_duplicate_before_ocr(filepath, img, info, opts)
+    (text, info['ocr_config'], info['ocr_score'], info['ocr_passadas'],
+     info['perfil_preprocessamento'], info['ocr_leituras']) = ocr_image(img, opts, info['chave_codigo_barras'])
+    info['metodo_extracao'] = 'ocr'
+    info['paginas_processadas'] = 1
+    return text, info
+
+def lookup_cache(filepath, sha256, opts):
+    """Resultado em cache para o conteúdo ``sha256`` (renomeado para ``filepath``) ou None"""
+    cache = get_worker_cache(opts)
+    if not cache:
+        return None
+    with stage('cache'):
+        cached = cache.get(sha256)
+    if not cached:
+        return None
+    # O mesmo conteúdo pode ter chegado com outro nome
+    invoice_data, items = rename_result(*cached, filepath)
+    logger.info(f"Cache: {filepath} - {len(items)} itens")
+    return invoice_data, items
+
+def rename_result(invoice_data, items, filepath):
+    """Cópia de um resultado atribuída a ``filepath`` (mesmo conteúdo, outro nome)"""
+    invoice_data = dict(invoice_data, arquivo=os.path.basename(filepath))
+    items = [copy.copy(item) for item in items]
+    for item in items:
+        item.arquivo = invoice_data['arquivo']
+    return invoice_data, items
+
+def process_single_file(filepath, opts=None, sha256=None, data=None):
     """Processa um único arquivo"""
+    opts = opts or OpcoesProcessamento()
+    timer = MedidorEstagios()
+    _stage_local.timer = timer
+    profiler = get_worker_profiler(opts)
+    if profiler:
+        profiler.enable()
+    try:
+        with timer.stage('total'):
+            if data is not None:
+                invoice_data, items = _process_single_file(filepath, opts, sha256, data)
+            else:
+                with map_file(filepath) as buf:
+                    invoice_data, items = _process_single_file(filepath, opts, sha256, buf)
+    finally:
+        _stage_local.timer = None
+        if profiler:
+            profiler.disable()
+            profile_file_done(opts)
+    if invoice_data:
+        invoice_data['tempos'] = timer.to_dict()
+    return invoice_data, items
+
+def parse_extracted_text(text, info, filepath, sha256):
+    """Parsing do texto extraído (OCR ou camada de texto): retorna (invoice_data, items)"""
+    layout = info.get('ocr_config') == OCR_LAYOUT_ROTULO
+    # O código de barras tem DV conferido: prevalece sobre a chave lida pelo OCR
+    with stage('parse'):
+        invoice_data = parse_invoice_data(text, os.path.basename(filepath), info['chave_codigo_barras'], layout)
+    invoice_data['sha256'] = sha256
+    invoice_data.update(info)
+    if invoice_data.get('chave_confere_codigo_barras') is False:
+        logger.warning(f"Chave do OCR diverge do código de barras em {filepath}")
+    
+    # Extração de itens
+    with stage('itens'):
+        items = parse_items_detailed(
+            invoice_data.get('itens_raw'), 
+            invoice_data.get('chave_acesso'),
+            invoice_data['arquivo'],
+            layout
+        )
+    return invoice_data, items
+
+def _process_single_file(filepath, opts, sha256, data):
     try:
         logger.info(f"Processando: {filepath}")
         
-        # Verifica tipo de arquivo
+        # Hash primeiro (do mesmo buffer decodificado depois): arquivos inalterados
+        # são servidos direto do cache
+        if sha256 is None:
+            with stage('hash'):
+                sha256 = hashlib.sha256(data).hexdigest()
+            cached = lookup_cache(filepath, sha256, opts)
+            if cached:
+                return cached
+        
         if filepath.lower().endswith('.pdf'):
-            images = pdf_to_images(filepath)
-            if not images:
-                return None, []
-            # Usa primeira página do PDF para análise principal
-            img = images[0]
+            text, info = extract_pdf_text(filepath, opts, data)
         else:
-            img = cv2.imread(filepath)
-            if img is None:
-                logger.warning(f"Não foi possível ler imagem: {filepath}")
+            text, info = extract_image_text(filepath, opts, data)
+            if info is None:
                 return None, []
         
-        # Pré-processamento e OCR
-        processed_img = advanced_preprocess(img)
-        text = smart_ocr(processed_img)
-        
         if not text.strip():
             logger.warning(f"OCR não retornou texto para: {filepath}")
             return None, []
         
-        # Extração de dados
-        invoice_data = parse_invoice_data(text, os.path.basename(filepath))
-        invoice_data['sha256'] = sha256_file(filepath)
+        invoice_data, items = parse_extracted_text(text, info, filepath, sha256)
+        # Texto bruto devolvido ao processo principal para o arquivo de textos (reparse)
+        if opts.textos_path:
+            invoice_data[CAMPO_TEXTO] = text
         
-        # Extração de itens
-        items = parse_items_detailed(
-            invoice_data.get('itens_raw'), 
-            invoice_data.get('chave_acesso'),
-            invoice_data['arquivo']
-        )
-        
-        logger.info(f"Sucesso: {filepath} - {len(items)} itens encontrados")
+        logger.info(f"Sucesso: {filepath} - {len(items)} itens encontrados ({info['metodo_extracao']})")
         return invoice_data, items
         
+    except DuplicataEncontrada as dup:
+        logger.info(f"Duplicata: {filepath} - {dup}")
+        return duplicate_record(filepath, dup.canonico, dup.motivo, sha256, dup.chave), []
     except Exception as e:
         logger.error(f"Erro processando {filepath}: {str(e)}")
         return None, []
 
-def process_files(file_paths, max_workers=None):
-    """Processa múltiplos arquivos em paralelo"""
+def prepare_file(filepath, opts, claim=None):
+    """Estágio de E/S do pipeline: uma única leitura do arquivo para hash, cache e OCR"""
+    timer = MedidorEstagios()
+    _stage_local.timer = timer
+    cached = data = None
+    try:
+        with map_file(filepath) as buf:
+            with stage('hash'):
+                sha256 = hashlib.sha256(buf).hexdigest()
+            if not (claim and claim(sha256)):
+                cached = lookup_cache(filepath, sha256, opts)
+                if not cached:
+                    with stage('leitura'):
+                        data = bytes(buf)
+    finally:
+        _stage_local.timer = None
+    return sha256, cached, data, timer.to_dict()
+
+def merge_tempos(tempos, tempos_io):
+    """Acrescenta os tempos do estágio de E/S aos do worker (inclusive ao total)"""
+    merged = dict(tempos)
+    total = dict(merged.get('total', {'wall_ms': 0.0, 'cpu_ms': 0.0}))
+    for name, tempo in tempos_io.items():
+        merged[name] = tempo
+        total['wall_ms'] = round(total['wall_ms'] + tempo['wall_ms'], 3)
+        total['cpu_ms'] = round(total['cpu_ms'] + tempo['cpu_ms'], 3)
+    merged['total'] = total
+    return merged
+
+class PipelineProcessamento:
+    """Pipeline produtor/consumidor em estágios para um lote de arquivos"""
+
+    def __init__(self, opts, ocr_workers=None, io_workers=4, queue_size=None, journal=None):
+        self.opts = opts
+        self.ocr_workers = ocr_workers or os.cpu_count() or 1
+        self.io_workers = max(1, io_workers)
+        self.queue_size = queue_size or 2 * self.ocr_workers
+        self.journal = journal
+        self.dedup = bool(opts.dedup_path)
+        self.chaves_xml = set()
+        # SHA256 -> (caminho, Future com o (invoice_data, items)) do primeiro arquivo com esse conteúdo
+        self.conteudos = {}
+        self._conteudos_lock = threading.Lock()
+
+    def claim(self, sha256, filepath):
+        """Registra o conteúdo ``sha256`` no lote; devolve (caminho, Future) do original se já visto"""
+        with self._conteudos_lock:
+            original = self.conteudos.get(sha256)
+            if original is None:
+                self.conteudos[sha256] = (os.path.abspath(filepath), Future())
+                while len(self.conteudos) > CONTEUDOS_MAX:
+                    # Descarta o mais antigo já resolvido (ordem de inserção)
+                    oldest = next(iter(self.conteudos))
+                    if not self.conteudos[oldest][1].done():
+                        break
+                    del self.conteudos[oldest]
+            return original
+
+    def run(self, file_paths):
+        """Gera (filepath, invoice_data, items, erro) na ordem em que as notas ficam prontas"""
+        results = queue.Queue()
+        slots = threading.Semaphore(self.queue_size)
+        stop = threading.Event()
+        fim = object()
+        io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='nf-io')
+        ocr_pool = ProcessPoolExecutor(max_workers=self.ocr_workers, initializer=init_worker,
+                                       initargs=(self.opts,))
+
+        # Cada entrada da fila é (filepath, [(invoice_data, items), ...], erro, ignorado)
+        def ocr_done(future, filepath, pending, tempos_io):
+            try:
+                invoice_data, items = future.result()
+            except Exception as e:
+                pending.set_result((None, []))
+                results.put((filepath, [], str(e), False))
+                return
+            pending.set_result((invoice_data, items))
+            if not invoice_data:
+                results.put((filepath, [], None, False))
+                return
+            invoice_data['tempos'] = merge_tempos(invoice_data.get('tempos', {}), tempos_io)
+            results.put((filepath, [(invoice_data, items)], None, False))
+
+        def duplicate_done(original, filepath, canonico, sha256, tempos_io):
+            invoice_data, items = original.result()
+            if self.dedup and invoice_data:
+                # Com o índice de duplicatas a cópia só é ligada ao original (ou ao canônico dele)
+                canonico = invoice_data.get('duplicata_de') or canonico
+                invoice_data = duplicate_record(filepath, canonico, 'sha256', sha256, invoice_data.get('chave_acesso'))
+                results.put((filepath, [(invoice_data, [])], None, False))
+                return
+            if not invoice_data:
+                results.put((filepath, [], "conteúdo idêntico a um arquivo sem resultado", False))
+                return
+            invoice_data, items = rename_result(invoice_data, items, filepath)
+            invoice_data['tempos'] = merge_tempos({}, tempos_io)
+            logger.info(f"Conteúdo repetido no lote: {filepath} - {len(items)} itens")
+            results.put((filepath, [(invoice_data, items)], None, False))
+
+        def prepare(filepath):
+            original = pending = canonico = None
+            
+            def claim(sha256):
+                nonlocal original, pending, canonico
+                # Conteúdo já registrado no índice por outro arquivo (em execuções anteriores)
+                dedup = get_worker_dedup(self.opts)
+                canonico = dedup.by_sha256(sha256) if dedup else None
+                if canonico == os.path.abspath(filepath):
+                    canonico = None
+                if canonico:
+                    return True
+                original = self.claim(sha256, filepath)
+                if original is None:
+                    pending = self.conteudos[sha256][1]
+                return original is not None
+            
+            try:
+                if is_xml_source(filepath):
+                    timer = MedidorEstagios()
+                    with timer.stage('xml'):
+                        docs = read_xml_documents(filepath)
+                    if not docs:
+                        results.put((filepath, [], "nenhuma NF-e encontrada no XML", False))
+                        return
+                    self.chaves_xml.update(inv['chave_acesso'] for inv, _ in docs if inv['chave_acesso'])
+                    docs[0][0]['tempos'] = merge_tempos({}, timer.to_dict())
+                    results.put((filepath, docs, None, False))
+                    return
+                chave_nome = chave_from_payload(os.path.basename(filepath))
+                if chave_nome in self.chaves_xml:
+                    if self.journal:
+                        self.journal.skipped(filepath, f"XML da chave {chave_nome} já processado")
+                    results.put((filepath, [], None, True))
+                    return
+                sha256, cached, data, tempos_io = prepare_file(filepath, self.opts, claim)
+                if canonico:
+                    logger.info(f"Duplicata: {filepath} - conteúdo idêntico a {canonico}")
+                    invoice_data = duplicate_record(filepath, canonico, 'sha256', sha256)
+                    results.put((filepath, [(invoice_data, [])], None, False))
+                    return
+                if original is not None:
+                    original[1].add_done_callback(
+                        lambda f: duplicate_done(f, filepath, original[0], sha256, tempos_io))
+                    return
+                if cached:
+                    pending.set_result(cached)
+                    invoice_data, items = cached
+                    invoice_data['tempos'] = merge_tempos({}, tempos_io)
+                    results.put((filepath, [(invoice_data, items)], None, False))
+                    return
+                future = ocr_pool.submit(process_single_file, filepath, self.opts, sha256, data)
+                del data
+                future.add_done_callback(lambda f: ocr_done(f, filepath, pending, tempos_io))
+            except Exception as e:
+                # Arquivos repetidos que aguardam este conteúdo não podem ficar pendentes
+                if pending is not None and not pending.done():
+                    pending.set_result((None, []))
+                results.put((filepath, [], str(e), False))
+
+        def feed():
+            submitted = 0
+            try:
+                for filepath in file_paths:
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    if self.journal:
+                        self.journal.pending(filepath)
+                    io_pool.submit(prepare, filepath)
+                    submitted += 1
+            except Exception as e:
+                logger.error(f"Erro ao enumerar arquivos: {e}")
+            finally:
+                results.put((fim, submitted))
+
+        # Os processos de OCR são criados aqui, antes das threads de E/S: um fork feito
+        # enquanto outra thread usa o SQLite (cache, índice de duplicatas) pode herdar
+        # um mutex travado e deixar o worker parado para sempre
+        ocr_pool.submit(os.getpid).result()
+        feeder = threading.Thread(target=feed, name='nf-feeder', daemon=True)
+        feeder.start()
+        received, expected = 0, None
+        try:
+            while expected is None or received < expected:
+                result = results.get()
+                if result[0] is fim:
+                    expected = result[1]
+                    continue
+                received += 1
+                slots.release()
+                filepath, docs, error, skipped = result
+                if skipped:
+                    logger.info(f"Ignorado (nota já lida do XML): {filepath}")
+                    continue
+                if not docs:
+                    yield filepath, None, [], error
+                for invoice_data, items in docs:
+                    yield filepath, invoice_data, items, None
+        finally:
+            stop.set()
+            slots.release()
+            feeder.join()
+            io_pool.shutdown(wait=True)
+            ocr_pool.shutdown(wait=True, cancel_futures=True)
+
+def process_files(file_paths, max_workers=None, opts=None, sink=None, journal=None, metrics=None,
+                  io_workers=4, queue_size=None):
+    """Processa múltiplos arquivos no pipeline em estágios (PipelineProcessamento)"""
+    opts = opts or OpcoesProcessamento()
     index_data = []
     items_data = []
     
-    if max_workers is None:
-        max_workers = max(1, os.cpu_count() // 2)
-    
     successful = 0
-    total = len(file_paths)
+    total = 0
     
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        future_to_file = {executor.submit(process_single_file, fp): fp for fp in file_paths}
-        
-        for future in as_completed(future_to_file):
-            filepath = future_to_file[future]
-            try:
-                invoice_data, items = future.result()
+    # Apenas o processo principal escreve no cache; workers e threads de E/S só leem
+    cache = CacheResultados(opts.cache_path, opts.versao()) if opts.cache_path else None
+    dedup = IndiceDuplicatas(opts.dedup_path) if opts.dedup_path else None
+    textos = ArquivoTextos(opts.textos_path, opts.versao()) if opts.textos_path else None
+    duplicates = 0
+    
+    pipeline = PipelineProcessamento(opts, ocr_workers=max_workers, io_workers=io_workers,
+                                     queue_size=queue_size, journal=journal)
+    for filepath, invoice_data, items, error in pipeline.run(file_paths):
+        total += 1
+        try:
+            if error:
+                raise RuntimeError(error)
+            texto = invoice_data.pop(CAMPO_TEXTO, None) if invoice_data else None
+            if (invoice_data and invoice_data.get('metodo_extracao') != 'xml'
+                    and invoice_data.get('chave_acesso') in pipeline.chaves_xml):
+                logger.info(f"Ignorado (nota já lida do XML): {filepath}")
+                if journal:
+                    journal.skipped(filepath, f"XML da chave {invoice_data['chave_acesso']} já processado")
+                continue
+            canonical = find_canonical(dedup, filepath, invoice_data) if dedup and invoice_data else None
+            if canonical:
+                canonico, motivo = canonical
+                logger.info(f"Duplicata ({motivo}): {filepath} -> {canonico}")
+                dedup.link(dedup_path(filepath, invoice_data), canonico, motivo, invoice_data.get('sha256'),
+                           invoice_data.get('chave_acesso'))
+                duplicates += 1
+                if journal:
+                    journal.skipped(filepath, f"duplicata de {canonico} ({motivo})")
+                continue
+            if metrics is not None and invoice_data:
+                metrics.add(invoice_data.get('tempos', {}))
+            if journal:
                 if invoice_data:
+                    journal.done(filepath, invoice_data, items)
+                else:
+                    journal.failed(filepath)
+            if invoice_data:
+                if sink is not None:
+                    sink.write(invoice_data, items)
+                else:
                     index_data.append(invoice_data)
                     items_data.extend(items)
-                    successful += 1
-            except Exception as e:
-                logger.error(f"Erro no processamento de {filepath}: {e}")
+                successful += 1
+                if cache and invoice_data['metodo_extracao'] != 'xml':
+                    cache.put(invoice_data['sha256'], invoice_data, items, commit=successful % 100 == 0)
+                if textos and texto:
+                    textos.put(invoice_data, texto, commit=successful % 100 == 0)
+        except Exception as e:
+            logger.error(f"Erro no processamento de {filepath}: {e}")
+            if journal:
+                journal.failed(filepath, str(e))
+    
+    if cache:
+        cache.commit()
+        cache.close()
+    if dedup:
+        dedup.commit()
+        dedup.close()
+        logger.info(f"Duplicatas ligadas ao canônico: {duplicates}")
+    if textos:
+        textos.commit()
+        textos.close()
+    
+    if sink is None:
+        index_data, items_data = prefer_xml_results(index_data, items_data)
     
-    logger.info(f"Processamento concluído: {successful}/{total} arquivos processados com sucesso")
+    logger.info(f"Processamento concluído: {successful}/{total} documentos processados com sucesso")
+    return index_data, items_data
+
+def reparse_range(path, first, last):
+    """Tarefa do reparse (worker): parsing dos textos com rowid entre ``first`` e ``last``"""
+    results = []
+    for sha256, arquivo, texto, info in get_worker_textos(path).iter_range(first, last):
+        timer = MedidorEstagios()
+        _stage_local.timer = timer
+        try:
+            invoice_data, items = parse_extracted_text(texto, info, arquivo, sha256)
+        except Exception as e:
+            logger.error(f"Erro no reparse de {arquivo} ({sha256[:12]}): {e}")
+            continue
+        finally:
+            _stage_local.timer = None
+        invoice_data['tempos'] = timer.to_dict()
+        results.append((invoice_data, items))
+    return results
+
+def reparse_texts(path, max_workers=None, sink=None, metrics=None, batch_size=REPARSE_LOTE):
+    """Refaz o parsing de todos os textos do ArquivoTextos, sem OCR"""
+    textos = ArquivoTextos(path, readonly=True)
+    try:
+        ranges = textos.rowid_ranges(batch_size)
+        logger.info(f"Reparse de {textos.count()} textos de {path}")
+    finally:
+        # Fechado antes de criar o pool: os workers abrem a própria conexão
+        textos.close()
+    
+    index_data = []
+    items_data = []
+    if not ranges:
+        return index_data, items_data
+    firsts, lasts = zip(*ranges)
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        for results in pool.map(reparse_range, itertools.repeat(path), firsts, lasts):
+            for invoice_data, items in results:
+                if metrics is not None:
+                    metrics.add(invoice_data['tempos'])
+                if sink is not None:
+                    sink.write(invoice_data, items)
+                else:
+                    index_data.append(invoice_data)
+                    items_data.extend(items)
     return index_data, items_data
 
 # ------------------------------ Validação e Exportação ------------------------------
-def validate_invoice_data(invoice_data):
+# Flags de validação, na ordem em que aparecem em flags_validacao
+FLAGS_VALIDACAO = (
+    'SEM_CHAVE_ACESSO', 'CHAVE_INVALIDA', 'SEM_CNPJ_EMITENTE', 'CNPJ_EMITENTE_INVALIDO',
+    'CNPJ_DESTINATARIO_INVALIDO', 'SEM_DATA_EMISSAO', 'SEM_VALOR_TOTAL', 'VALOR_ZERO',
+    'VALOR_DIVERGE_ITENS', 'SEM_ITENS', 'CHAVE_DIVERGE_CODIGO_BARRAS',
+    'DATA_FUTURA', 'DATA_MUITO_ANTIGA', 'DATA_INVALIDA',
+)
+DATA_MINIMA = '2000-01-01'
+# Diferença aceita entre valor_total e a soma dos itens: frete, seguro, IPI/ST e
+# descontos entram no total da nota, então só divergências maiores são sinalizadas
+VALOR_ITENS_TOLERANCIA = 0.01
+VALOR_ITENS_TOLERANCIA_MIN = 0.05
+
+def mod11_dv(digits, weights):
+    """Dígito verificador módulo 11 (resto < 2 -> 0) das primeiras posições de ``digits``"""
+    dv = 11 - sum(map(operator.mul, digits, weights)) % 11
+    return 0 if dv >= 10 else dv
+
+def documento_valido(doc):
+    """Confere os dígitos verificadores de um CNPJ (14 posições) ou CPF (11 dígitos)"""
+    if CNPJ_FORMATO_RX.fullmatch(doc):
+        weights = CNPJ_PESOS
+    elif CPF_FORMATO_RX.fullmatch(doc):
+        weights = CPF_PESOS
+    else:
+        return False
+    digits = [ord(c) - 48 for c in doc]
+    if len(set(digits)) == 1:  # 000..., 111...: passam no cálculo mas não existem
+        return False
+    return all(mod11_dv(digits, w) == digits[len(w)] for w in weights)
+
+def items_total_diverges(valor_total, soma_itens):
+    """Indica se a soma dos itens se afasta do valor total além da tolerância"""
+    tolerance = max(VALOR_ITENS_TOLERANCIA_MIN, VALOR_ITENS_TOLERANCIA * abs(valor_total))
+    return abs(soma_itens - valor_total) > tolerance
+
+def validate_invoice_data(invoice_data, items=None, hoje=None):
     """Valida dados da nota fiscal e retorna flags"""
-    flags = []
+    hoje = hoje or datetime.now().strftime('%Y-%m-%d')
+    flags = set()
     
-    if not invoice_data.get('chave_acesso'):
-        flags.append('SEM_CHAVE_ACESSO')
+    chave = invoice_data.get('chave_acesso')
+    if not chave:
+        flags.add('SEM_CHAVE_ACESSO')
+    elif not chave_valida(chave):
+        flags.add('CHAVE_INVALIDA')
     
     if not invoice_data.get('cnpj_emitente'):
-        flags.append('SEM_CNPJ_EMITENTE')
+        flags.add('SEM_CNPJ_EMITENTE')
+    elif not documento_valido(invoice_data['cnpj_emitente']):
+        flags.add('CNPJ_EMITENTE_INVALIDO')
+    if invoice_data.get('cnpj_destinatario') and not documento_valido(invoice_data['cnpj_destinatario']):
+        flags.add('CNPJ_DESTINATARIO_INVALIDO')
+    
+    valor_total = invoice_data.get('valor_total')
+    if valor_total is None or pd.isna(valor_total):
+        valor_total = None
+        flags.add('SEM_VALOR_TOTAL')
+    elif valor_total == 0:
+        flags.add('VALOR_ZERO')
+    valores = [item.vl_total for item in items or () if item.vl_total is not None]
+    if valor_total is not None and valores and items_total_diverges(valor_total, sum(valores)):
+        flags.add('VALOR_DIVERGE_ITENS')
+    
+    # No XML os itens vêm estruturados (det), sem bloco de texto
+    if not invoice_data.get('itens_raw') and invoice_data.get('metodo_extracao') != 'xml':
+        flags.add('SEM_ITENS')
+    
+    if invoice_data.get('chave_confere_codigo_barras') is False:
+        flags.add('CHAVE_DIVERGE_CODIGO_BARRAS')
+    
+    # Datas ISO comparadas como texto
+    data = invoice_data.get('data_emissao')
+    if not data:
+        flags.add('SEM_DATA_EMISSAO')
+    else:
+        try:
+            data = datetime.strptime(data, '%Y-%m-%d').strftime('%Y-%m-%d')
+            if data > hoje:
+                flags.add('DATA_FUTURA')
+            elif data < DATA_MINIMA:
+                flags.add('DATA_MUITO_ANTIGA')
+        except (TypeError, ValueError):
+            flags.add('DATA_INVALIDA')
+    
+    return ';'.join(flag for flag in FLAGS_VALIDACAO if flag in flags) or 'OK'
+
+def _text_column(df, name):
+    """Coluna como texto, com '' para nulos (e para a coluna ausente)"""
+    if name not in df:
+        return pd.Series('', index=df.index, dtype=object)
+    column = df[name]
+    return column.where(column.notna(), '').astype(str)
+
+def check_digits_mask(values, patterns, reject_repeated=True):
+    """Máscara dos documentos com dígitos verificadores corretos"""
+    valid = np.zeros(len(values), dtype=bool)
+    for pattern, weights in patterns:
+        fmt = values.str.fullmatch(pattern.pattern).to_numpy(dtype=bool)
+        if not fmt.any():
+            continue
+        width = len(weights[-1]) + 1
+        digits = np.frombuffer(values[fmt].str.cat().encode('ascii'), np.uint8).reshape(-1, width).astype(np.int64) - 48
+        ok = (digits != digits[:, :1]).any(axis=1) if reject_repeated else np.ones(len(digits), dtype=bool)
+        for w in weights:
+            dv = 11 - (digits[:, :len(w)] @ np.asarray(w)) % 11
+            ok &= np.where(dv >= 10, 0, dv) == digits[:, len(w)]
+        valid[fmt] = ok
+    return valid
+
+def validate_invoices(df_index, df_items=None, hoje=None):
+    """Validação vetorizada de todas as notas: Series com flags_validacao"""
+    hoje = hoje or datetime.now().strftime('%Y-%m-%d')
+    n = len(df_index)
+    masks = {}
+    
+    chave = _text_column(df_index, 'chave_acesso')
+    masks['SEM_CHAVE_ACESSO'] = (chave == '').to_numpy()
+    chave_ok = check_digits_mask(chave, [(CHAVE_FORMATO_RX, (CHAVE_PESOS[::-1],))], reject_repeated=False)
+    masks['CHAVE_INVALIDA'] = ~masks['SEM_CHAVE_ACESSO'] & ~chave_ok
+    
+    documentos = [(CNPJ_FORMATO_RX, CNPJ_PESOS), (CPF_FORMATO_RX, CPF_PESOS)]
+    emitente = _text_column(df_index, 'cnpj_emitente')
+    masks['SEM_CNPJ_EMITENTE'] = (emitente == '').to_numpy()
+    masks['CNPJ_EMITENTE_INVALIDO'] = ~masks['SEM_CNPJ_EMITENTE'] & ~check_digits_mask(emitente, documentos)
+    destinatario = _text_column(df_index, 'cnpj_destinatario')
+    masks['CNPJ_DESTINATARIO_INVALIDO'] = (destinatario != '').to_numpy() & ~check_digits_mask(destinatario, documentos)
     
-    if not invoice_data.get('data_emissao'):
-        flags.append('SEM_DATA_EMISSAO')
+    valor = pd.to_numeric(df_index['valor_total'], errors='coerce') if 'valor_total' in df_index else pd.Series(np.nan, index=df_index.index)
+    masks['SEM_VALOR_TOTAL'] = valor.isna().to_numpy()
+    masks['VALOR_ZERO'] = (valor == 0).to_numpy()
+    masks['VALOR_DIVERGE_ITENS'] = np.zeros(n, dtype=bool)
+    if df_items is not None and len(df_items) and 'vl_total' in df_items:
+        keys = ['arquivo', 'chave_acesso']
+        soma = (df_items.assign(**{k: _text_column(df_items, k) for k in keys})
+                .groupby(keys)['vl_total'].sum(min_count=1))
+        soma = soma.reindex(pd.MultiIndex.from_arrays([_text_column(df_index, k) for k in keys])).to_numpy(dtype=float)
+        valores = valor.to_numpy(dtype=float)
+        tolerance = np.maximum(VALOR_ITENS_TOLERANCIA_MIN, VALOR_ITENS_TOLERANCIA * np.abs(valores))
+        with np.errstate(invalid='ignore'):
+            masks['VALOR_DIVERGE_ITENS'] = np.abs(soma - valores) > tolerance
     
-    if invoice_data.get('valor_total') is None:
-        flags.append('SEM_VALOR_TOTAL')
-    elif invoice_data.get('valor_total') == 0:
-        flags.append('VALOR_ZERO')
+    itens_raw = _text_column(df_index, 'itens_raw')
+    masks['SEM_ITENS'] = ((itens_raw == '') & (_text_column(df_index, 'metodo_extracao') != 'xml')).to_numpy()
     
-    if not invoice_data.get('itens_raw'):
-        flags.append('SEM_ITENS')
+    confere = df_index['chave_confere_codigo_barras'] if 'chave_confere_codigo_barras' in df_index else None
+    masks['CHAVE_DIVERGE_CODIGO_BARRAS'] = (np.zeros(n, dtype=bool) if confere is None
+                                            else confere.map(lambda v: v is False).to_numpy(dtype=bool))
     
-    # Validação de data
+    data = _text_column(df_index, 'data_emissao')
+    masks['SEM_DATA_EMISSAO'] = (data == '').to_numpy()
+    parsed = pd.to_datetime(data.where(data != ''), format='%Y-%m-%d', errors='coerce')
+    masks['DATA_INVALIDA'] = ~masks['SEM_DATA_EMISSAO'] & parsed.isna().to_numpy()
+    iso = parsed.dt.strftime('%Y-%m-%d')
+    masks['DATA_FUTURA'] = (iso > hoje).to_numpy(dtype=bool)
+    masks['DATA_MUITO_ANTIGA'] = (iso < DATA_MINIMA).to_numpy(dtype=bool)
+    
+    codes = np.zeros(n, dtype=np.int64)
+    for bit, flag in enumerate(FLAGS_VALIDACAO):
+        codes |= masks[flag].astype(np.int64) << bit
+    labels = {
+        code: ';'.join(flag for bit, flag in enumerate(FLAGS_VALIDACAO) if code >> bit & 1) or 'OK'
+        for code in np.unique(codes).tolist()
+    }
+    return pd.Series([labels[code] for code in codes.tolist()], index=df_index.index, dtype=object)
+
+class EstatisticasNotas:
+    """Contadores de estatisticas.json, atualizados nota a nota"""
+
+    def __init__(self):
+        self.total_notas = 0
+        self.notas_validas = 0
+        self.total_itens = 0
+        self.tipos = Counter()
+        self.ufs = Counter()
+        self.metodos = Counter()
+        self.ocr_notas = 0
+        self.ocr_leituras = 0
+        self.ocr_passadas = 0
+        self.ocr_configs = Counter()
+        self.chaves_codigo_barras = 0
+        self.perfis = Counter()
+        self.progressivas = 0
+        self.escaladas = 0
+
+    def add(self, invoice_data, flags, n_items=0):
+        self.total_notas += 1
+        self.notas_validas += flags == 'OK'
+        self.total_itens += n_items
+        for counter, key in ((self.tipos, 'tipo'), (self.ufs, 'uf'), (self.metodos, 'metodo_extracao')):
+            if invoice_data.get(key):
+                counter[invoice_data[key]] += 1
+        self.chaves_codigo_barras += bool(invoice_data.get('chave_codigo_barras'))
+        if invoice_data.get('ocr_passadas') is not None:
+            self.ocr_notas += 1
+            self.ocr_leituras += invoice_data.get('ocr_leituras') or 0
+            self.ocr_passadas += invoice_data['ocr_passadas']
+            if invoice_data.get('ocr_config'):
+                self.ocr_configs[invoice_data['ocr_config']] += 1
+            if invoice_data.get('perfil_preprocessamento'):
+                self.perfis[invoice_data['perfil_preprocessamento']] += 1
+            if invoice_data.get('dpi_escalado') is not None:
+                self.progressivas += 1
+                self.escaladas += invoice_data['dpi_escalado']
+
+    def to_dict(self):
+        stats = {
+            'total_notas': self.total_notas,
+            'notas_validas': self.notas_validas,
+            'total_itens': self.total_itens,
+            'tipos_documento': dict(self.tipos.most_common()),
+            'ufs': dict(self.ufs.most_common()),
+            'metodos_extracao': dict(self.metodos.most_common()),
+            'ocr': {},
+        }
+        if self.ocr_notas:
+            # Passadas de OCR executadas e economizadas pelo agendador (cada leitura
+            # poderia ter executado todas as OCR_CONFIGS)
+            stats['ocr'] = {
+                'notas': self.ocr_notas,
+                'leituras': self.ocr_leituras,
+                'passadas_executadas': self.ocr_passadas,
+                'passadas_economizadas': max(0, self.ocr_leituras * len(OCR_CONFIGS) - self.ocr_passadas),
+                'configs_vencedoras': dict(self.ocr_configs.most_common()),
+                'chaves_codigo_barras': self.chaves_codigo_barras,
+                'perfis_preprocessamento': dict(self.perfis.most_common()),
+            }
+        if self.progressivas:
+            # Notas lidas em baixa resolução que precisaram ser re-renderizadas
+            stats['ocr']['dpi_progressivo'] = {
+                'notas': self.progressivas,
+                'escaladas': self.escaladas,
+                'taxa_escalonamento': round(self.escaladas / self.progressivas, 4),
+            }
+        return stats
+
+def write_json_atomic(path, data):
+    """Grava JSON via arquivo temporário + rename (nunca deixa o arquivo pela metade)"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+def flat_row(row):
+    """Serializa campos aninhados (ex.: tempos) como JSON para saídas tabulares"""
+    return {k: json.dumps(v, ensure_ascii=False) if isinstance(v, dict) else v for k, v in row.items()}
+
+def invoice_json_filename(invoice):
+    # O prefixo do SHA256 separa arquivos de mesmo nome vindos de pastas diferentes
+    return (f"{invoice['arquivo']}_{invoice.get('chave_acesso') or 'sem_chave'}"
+            f"_{(invoice.get('sha256') or '')[:12]}.json")
+
+# Colunas de duplicatas.csv
+DUPLICATAS_COLUNAS = ['caminho', 'sha256', 'chave', 'canonico', 'motivo', 'registrado_em']
+
+def export_duplicates(dedup_path, output_dir):
+    """Grava duplicatas.csv com todas as ligações arquivo -> canônico do índice"""
+    dedup = IndiceDuplicatas(dedup_path, readonly=True)
     try:
-        if invoice_data.get('data_emissao'):
-            emissao = datetime.strptime(invoice_data['data_emissao'], '%Y-%m-%d')
-            hoje = datetime.now()
-            if emissao > hoje:
-                flags.append('DATA_FUTURA')
-            elif emissao < datetime(2000, 1, 1):
-                flags.append('DATA_MUITO_ANTIGA')
-    except:
-        flags.append('DATA_INVALIDA')
-    
-    return ';'.join(flags) if flags else 'OK'
-
-def export_results(index_data, items_data, output_dir="saida_nf_avancada"):
-    """Exporta resultados em múltiplos formatos"""
+        rows = list(dedup.iter_duplicatas())
+    finally:
+        dedup.close()
+    pd.DataFrame(rows, columns=DUPLICATAS_COLUNAS).to_csv(
+        os.path.join(output_dir, 'duplicatas.csv'), index=False, encoding='utf-8-sig')
+    return len(rows)
+
+def export_results(index_data, items_data, output_dir="saida_nf_avancada", sqlite_path=None):
+    """Exporta resultados em múltiplos formatos (e no banco SQLite ``sqlite_path``, se informado)"""
     os.makedirs(output_dir, exist_ok=True)
     
     # DataFrame principal
-    df_index = pd.DataFrame(index_data)
-    
-    # Adiciona flags de validação
-    df_index['flags_validacao'] = df_index.apply(validate_invoice_data, axis=1)
+    df_index = pd.DataFrame([flat_row(invoice) for invoice in index_data])
     
     # DataFrame de itens
-    df_items = pd.DataFrame([item.__dict__ for item in items_data])
+    df_items = pd.DataFrame([asdict(item) for item in items_data])
+    df_index['flags_validacao'] = validate_invoices(df_index, df_items)
     
     # Exporta Excel
     with pd.ExcelWriter(os.path.join(output_dir, 'notas_fiscais.xlsx')) as writer:
@@ -684,72 +3192,895 @@ def export_results(index_data, items_data, output_dir="saida_nf_avancada"):
     df_index.to_csv(os.path.join(output_dir, 'notas_fiscais.csv'), index=False, encoding='utf-8-sig')
     df_items.to_csv(os.path.join(output_dir, 'itens.csv'), index=False, encoding='utf-8-sig')
     
+    if sqlite_path:
+        export_sqlite(index_data, items_data, df_index['flags_validacao'], sqlite_path)
+    
     # JSON individual
     json_dir = os.path.join(output_dir, 'json')
     os.makedirs(json_dir, exist_ok=True)
     
     for invoice in index_data:
-        filename = f"{invoice['arquivo']}_{invoice.get('chave_acesso', 'sem_chave')}.json"
-        with open(os.path.join(json_dir, filename), 'w', encoding='utf-8') as f:
+        with open(os.path.join(json_dir, invoice_json_filename(invoice)), 'w', encoding='utf-8') as f:
             json.dump(invoice, f, ensure_ascii=False, indent=2)
     
     # Estatísticas
-    stats = {
-        'total_notas': len(df_index),
-        'notas_validas': len(df_index[df_index['flags_validacao'] == 'OK']),
-        'total_itens': len(df_items),
-        'tipos_documento': df_index['tipo'].value_counts().to_dict(),
-        'ufs': df_index['uf'].value_counts().to_dict()
-    }
+    accumulator = EstatisticasNotas()
+    for invoice, flags in zip(index_data, df_index['flags_validacao']):
+        accumulator.add(invoice, flags)
+    accumulator.total_itens = len(df_items)
+    stats = accumulator.to_dict()
     
     with open(os.path.join(output_dir, 'estatisticas.json'), 'w', encoding='utf-8') as f:
         json.dump(stats, f, ensure_ascii=False, indent=2)
     
     return df_index, df_items, stats
 
+# ------------------------------ Banco SQLite ------------------------------
+# Colunas de notas consultáveis direto no banco (o registro completo fica em 'dados')
+BANCO_COLUNAS_NOTAS = (
+    'arquivo', 'tipo', 'numero_nf', 'serie', 'data_emissao', 'cnpj_emitente', 'razao_emitente',
+    'cnpj_destinatario', 'razao_destinatario', 'uf', 'valor_total', 'metodo_extracao', 'flags_validacao',
+)
+BANCO_COLUNAS_ITENS = tuple(f.name for f in fields(ItemNota) if f.name not in ('chave_acesso', 'arquivo'))
+# Versão do esquema (PRAGMA user_version); 2: o arquivo faz parte da chave de notas e itens
+BANCO_ESQUEMA = 2
+
+class BancoNotas:
+    """Notas e itens num banco SQLite, atualizado por upsert a cada execução"""
+
+    def __init__(self, path, batch_size=500, readonly=False):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = []
+        self.inserted = self.unchanged = 0
+        if not readonly:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        if not readonly:
+            self._create_schema()
+
+    def _create_schema(self):
+        colunas_notas = ''.join(
+            f" {col} {'REAL' if col == 'valor_total' else 'TEXT'}{' NOT NULL' if col == 'arquivo' else ''},"
+            for col in BANCO_COLUNAS_NOTAS
+        )
+        colunas_itens = ''.join(
+            f" {col} {'REAL' if col in ('qtd', 'vl_unit', 'vl_total') else 'TEXT'}," for col in BANCO_COLUNAS_ITENS
+        )
+        legado = self.conn.execute('PRAGMA user_version').fetchone()[0] < BANCO_ESQUEMA and self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'notas'").fetchone()
+        with self.conn:
+            self.conn.execute('BEGIN')
+            if legado:
+                # Esquema 1, sem o arquivo na chave: as linhas passam para as tabelas novas
+                self.conn.execute('ALTER TABLE notas RENAME TO notas_v1')
+                self.conn.execute('ALTER TABLE itens RENAME TO itens_v1')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS notas ('
+                ' sha256 TEXT NOT NULL,'
+                " chave_acesso TEXT NOT NULL DEFAULT '',"
+                f'{colunas_notas}'
+                ' dados TEXT NOT NULL,'
+                ' atualizado_em REAL NOT NULL,'
+                ' PRIMARY KEY (sha256, chave_acesso, arquivo))'
+            )
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS itens ('
+                ' sha256 TEXT NOT NULL,'
+                " chave_acesso TEXT NOT NULL DEFAULT '',"
+                ' arquivo TEXT NOT NULL,'
+                ' seq INTEGER NOT NULL,'
+                f'{colunas_itens}'
+                ' PRIMARY KEY (sha256, chave_acesso, arquivo, seq))'
+            )
+            if legado:
+                for tabela, colunas in (
+                    ('notas', ('sha256', 'chave_acesso') + BANCO_COLUNAS_NOTAS + ('dados', 'atualizado_em')),
+                    ('itens', ('sha256', 'chave_acesso', 'arquivo', 'seq') + BANCO_COLUNAS_ITENS),
+                ):
+                    origem = ', '.join("COALESCE(arquivo, '')" if col == 'arquivo' else col for col in colunas)
+                    self.conn.execute(f"INSERT INTO {tabela} ({', '.join(colunas)}) SELECT {origem} FROM {tabela}_v1")
+                    self.conn.execute(f'DROP TABLE {tabela}_v1')
+                logger.info(f"Banco SQLite {self.path} convertido para o esquema {BANCO_ESQUEMA}")
+            self.conn.execute(f'PRAGMA user_version = {BANCO_ESQUEMA}')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_notas_chave ON notas (chave_acesso)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_notas_cnpj ON notas (cnpj_emitente, data_emissao)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_notas_data ON notas (data_emissao)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_notas_uf ON notas (uf, data_emissao)')
+
+    def write(self, invoice_data, flags, items):
+        """Agenda o upsert de uma nota e seus itens (aplicado em lote)"""
+        self._pending.append((invoice_data, flags, items))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Aplica as gravações pendentes numa única transação"""
+        if not self._pending:
+            return
+        columns = ('sha256', 'chave_acesso') + BANCO_COLUNAS_NOTAS + ('dados', 'atualizado_em')
+        updates = ', '.join(f'{col} = excluded.{col}' for col in columns[2:])
+        upsert = (
+            f"INSERT INTO notas ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT (sha256, chave_acesso, arquivo) DO UPDATE SET {updates} "
+            "WHERE notas.dados IS NOT excluded.dados"
+        )
+        insert_item = (
+            f"INSERT INTO itens (sha256, chave_acesso, arquivo, seq, {', '.join(BANCO_COLUNAS_ITENS)}) "
+            f"VALUES ({', '.join('?' * (len(BANCO_COLUNAS_ITENS) + 4))})"
+        )
+        agora = time.time()
+        with self.conn:
+            for invoice_data, flags, items in self._pending:
+                # Os tempos mudam a cada execução e não fazem parte do resultado
+                dados = {k: v for k, v in invoice_data.items() if k != 'tempos'}
+                key = (invoice_data.get('sha256') or '', invoice_data.get('chave_acesso') or '',
+                       invoice_data.get('arquivo') or '')
+                row = dict(dados, flags_validacao=flags, arquivo=key[2])
+                values = key[:2] + tuple(row.get(col) for col in BANCO_COLUNAS_NOTAS) + (
+                    json.dumps(dados, ensure_ascii=False, sort_keys=True), agora)
+                if not self.conn.execute(upsert, values).rowcount:
+                    self.unchanged += 1
+                    continue
+                self.inserted += 1
+                self.conn.execute('DELETE FROM itens WHERE sha256 = ? AND chave_acesso = ? AND arquivo = ?', key)
+                self.conn.executemany(insert_item, [
+                    key + (seq,) + tuple(getattr(item, col) for col in BANCO_COLUNAS_ITENS)
+                    for seq, item in enumerate(items)
+                ])
+        self._pending = []
+
+    def query(self, chave=None, cnpj=None, mes=None, uf=None, limit=None):
+        """Notas (dicionários com os dados completos) que atendem a todos os filtros"""
+        where, params = [], []
+        if chave:
+            where.append('chave_acesso = ?')
+            params.append(chave)
+        if cnpj:
+            where.append('cnpj_emitente = ?')
+            params.append(cnpj)
+        if mes:
+            ano, mm = map(int, mes.split('-'))
+            where.append('data_emissao >= ? AND data_emissao < ?')
+            params += [f'{ano:04d}-{mm:02d}-01', f'{ano + mm // 12:04d}-{mm % 12 + 1:02d}-01']
+        if uf:
+            where.append('uf = ?')
+            params.append(uf.upper())
+        sql = 'SELECT sha256, chave_acesso, flags_validacao, dados FROM notas'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY data_emissao, CAST(numero_nf AS INTEGER)'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        notas = []
+        for sha256, chave_acesso, flags, dados in self.conn.execute(sql, params):
+            invoice_data = json.loads(dados)
+            invoice_data['flags_validacao'] = flags
+            notas.append(invoice_data)
+        return notas
+
+    def items(self, sha256, chave_acesso=None, arquivo=None):
+        """Itens de uma nota, na ordem original"""
+        cursor = self.conn.execute(
+            f"SELECT {', '.join(BANCO_COLUNAS_ITENS)} FROM itens "
+            'WHERE sha256 = ? AND chave_acesso = ? AND arquivo = ? ORDER BY seq',
+            (sha256, chave_acesso or '', arquivo or '')
+        )
+        return [ItemNota(chave_acesso, arquivo, *row) for row in cursor]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def export_sqlite(index_data, items_data, flags, path):
+    """Upsert das notas e itens de export_results no banco SQLite ``path``"""
+    by_invoice = {}
+    for item in items_data:
+        by_invoice.setdefault((item.arquivo, item.chave_acesso), []).append(item)
+    banco = BancoNotas(path)
+    try:
+        for invoice, invoice_flags in zip(index_data, flags):
+            banco.write(invoice, invoice_flags, by_invoice.get((invoice['arquivo'], invoice.get('chave_acesso')), []))
+    finally:
+        banco.close()
+    logger.info(f"Banco SQLite {path}: {banco.inserted} notas gravadas, {banco.unchanged} inalteradas")
+
+# ------------------------------ Saída Incremental ------------------------------
+# Colunas fixas de cada tabela (CSV e Parquet não dependem de qual nota chega primeiro):
+# campos da nota, metadados da extração e campos que só algumas notas trazem
+SAIDA_COLUNAS = {
+    'notas_fiscais': (tuple(f.name for f in fields(NotaFiscal) if f.name != 'itens') + tuple(new_extraction_info())
+                      + ('chave_confere_codigo_barras', 'duplicata_de', 'motivo_duplicata', 'tempos',
+                         'flags_validacao')),
+    'itens': tuple(f.name for f in fields(ItemNota)),
+}
+# Colunas numéricas no Parquet; as demais são gravadas como texto
+PARQUET_TIPOS = {
+    'valor_total': 'float64', 'ocr_score': 'float64', 'ocr_passadas': 'int64', 'ocr_leituras': 'int64',
+    'paginas_processadas': 'int64', 'qtd': 'float64', 'vl_unit': 'float64', 'vl_total': 'float64',
+}
+
+# Dataset particionado: colunas e tipos fixos, com dicionário nas colunas repetitivas.
+# Ficam de fora os textos brutos do OCR (itens_raw, linha_ocr), mantidos em CSV/JSON.
+DATASET_PARTICOES = ('uf', 'mes')
+# Partição das notas sem UF/mês (o nulo do hive quebra a leitura com filtros no pandas)
+DATASET_SEM_VALOR = 'indefinido'
+DATASET_NOTAS = {
+    'arquivo': 'string', 'sha256': 'string', 'tipo': 'dictionary', 'chave_acesso': 'string',
+    'numero_nf': 'string', 'serie': 'dictionary', 'data_emissao': 'string',
+    'cnpj_emitente': 'dictionary', 'razao_emitente': 'dictionary', 'ie_emitente': 'dictionary',
+    'endereco_emitente': 'dictionary', 'municipio_emitente': 'dictionary',
+    'cnpj_destinatario': 'dictionary', 'razao_destinatario': 'dictionary',
+    'valor_total': 'float64', 'chave_valida': 'bool', 'metodo_extracao': 'dictionary',
+    'ocr_config': 'dictionary', 'ocr_score': 'float64', 'ocr_passadas': 'int64',
+    'paginas_processadas': 'int64', 'perfil_preprocessamento': 'dictionary', 'dpi_ocr': 'int64',
+    'chave_codigo_barras': 'string', 'flags_validacao': 'dictionary',
+}
+DATASET_ITENS = {
+    'sha256': 'string', 'chave_acesso': 'string', 'arquivo': 'string', 'descricao': 'dictionary',
+    'ncm': 'dictionary', 'cfop': 'dictionary', 'unidade': 'dictionary',
+    'qtd': 'float64', 'vl_unit': 'float64', 'vl_total': 'float64',
+}
+
+class DatasetParticionado:
+    """Dataset Parquet particionado por UF e mês de emissão (uf=SP/mes=2023-05)"""
+    __slots__ = ('path', 'types', 'row_group_size', 'columns', 'rows', 'parts')
+
+    def __init__(self, path, types, row_group_size=100000):
+        self.path = path
+        self.types = dict(types, **{col: 'string' for col in DATASET_PARTICOES})
+        self.row_group_size = row_group_size
+        self.columns = {col: [] for col in self.types}
+        self.rows = 0
+        self.parts = 0
+
+    def append(self, values):
+        """Acrescenta uma linha (dicionário; colunas ausentes ficam nulas)"""
+        for col, buffer in self.columns.items():
+            buffer.append(values.get(col))
+        self.rows += 1
+        if self.rows >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        arrays = {}
+        for col, values in self.columns.items():
+            kind = self.types[col]
+            if kind == 'dictionary':
+                arrays[col] = pa.array(values, pa.string()).dictionary_encode()
+            else:
+                arrays[col] = pa.array(values, pa.type_for_alias(kind))
+        pq.write_to_dataset(pa.table(arrays), self.path, partition_cols=list(DATASET_PARTICOES),
+                            basename_template=f'parte-{self.parts:05d}-{{i}}.parquet',
+                            existing_data_behavior='overwrite_or_ignore')
+        self.parts += 1
+        self.columns = {col: [] for col in self.types}
+        self.rows = 0
+
+def dataset_partition(invoice_data):
+    """Valores das colunas de partição (uf, mes) de uma nota"""
+    mes = invoice_data.get('mes_emissao') or (invoice_data.get('data_emissao') or '')[:7]
+    return {'uf': invoice_data.get('uf') or DATASET_SEM_VALOR, 'mes': mes or DATASET_SEM_VALOR}
+
+class SaidaIncremental:
+    """Grava os resultados à medida que cada arquivo termina, com memória constante"""
+    FORMATOS = ('csv', 'jsonl', 'parquet', 'json', 'sqlite', 'dataset')
+
+    def __init__(self, output_dir, formats=('csv', 'jsonl', 'json'), row_group_size=10000, stats_every=500,
+                 sqlite_path=None):
+        unknown = set(formats) - set(self.FORMATOS)
+        if unknown:
+            raise ValueError(f"Formatos desconhecidos: {', '.join(sorted(unknown))}")
+        if ('parquet' in formats or 'dataset' in formats) and pq is None:
+            raise RuntimeError("Saída Parquet requer o pacote pyarrow")
+        self.output_dir = output_dir
+        self.formats = tuple(formats)
+        self.row_group_size = row_group_size
+        self.stats_every = stats_every
+        self.stats = EstatisticasNotas()
+        self._csv = {}
+        self._jsonl = {}
+        self._parquet = {}
+        os.makedirs(output_dir, exist_ok=True)
+        self._datasets = None
+        if 'dataset' in self.formats:
+            # Partes de uma execução anterior seriam lidas junto com as novas
+            dataset_dir = os.path.join(output_dir, 'dataset')
+            shutil.rmtree(dataset_dir, ignore_errors=True)
+            self._datasets = (
+                DatasetParticionado(os.path.join(dataset_dir, 'notas'), DATASET_NOTAS, row_group_size),
+                DatasetParticionado(os.path.join(dataset_dir, 'itens'), DATASET_ITENS, row_group_size),
+            )
+        self._banco = None
+        if 'sqlite' in self.formats:
+            self._banco = BancoNotas(sqlite_path or os.path.join(output_dir, 'notas_fiscais.sqlite'))
+        if 'json' in self.formats:
+            os.makedirs(os.path.join(output_dir, 'json'), exist_ok=True)
+
+    def write(self, invoice_data, items):
+        """Grava uma nota e seus itens"""
+        flags = validate_invoice_data(invoice_data, items)
+        self._append('notas_fiscais', [dict(invoice_data, flags_validacao=flags)])
+        self._append('itens', [asdict(item) for item in items])
+        if 'json' in self.formats:
+            with open(os.path.join(self.output_dir, 'json', invoice_json_filename(invoice_data)),
+                      'w', encoding='utf-8') as f:
+                json.dump(invoice_data, f, ensure_ascii=False, indent=2)
+        if self._banco:
+            self._banco.write(invoice_data, flags, items)
+        if self._datasets:
+            partition = dataset_partition(invoice_data)
+            notas, itens = self._datasets
+            notas.append(dict(invoice_data, flags_validacao=flags, **partition))
+            for item in items:
+                itens.append({'sha256': invoice_data.get('sha256'), 'chave_acesso': item.chave_acesso,
+                              'arquivo': item.arquivo, 'descricao': item.descricao, 'ncm': item.ncm,
+                              'cfop': item.cfop, 'unidade': item.unidade, 'qtd': item.qtd,
+                              'vl_unit': item.vl_unit, 'vl_total': item.vl_total, **partition})
+        
+        self.stats.add(invoice_data, flags, len(items))
+        if self.stats.total_notas % self.stats_every == 0:
+            self.flush()
+
+    def _open(self, name):
+        if 'csv' in self.formats and name not in self._csv:
+            f = open(os.path.join(self.output_dir, f'{name}.csv'), 'w', newline='', encoding='utf-8-sig')
+            writer = csv.DictWriter(f, fieldnames=SAIDA_COLUNAS[name], extrasaction='ignore')
+            writer.writeheader()
+            self._csv[name] = (f, writer)
+        if 'jsonl' in self.formats and name not in self._jsonl:
+            self._jsonl[name] = open(os.path.join(self.output_dir, f'{name}.jsonl'), 'w', encoding='utf-8')
+
+    def _append(self, name, rows):
+        if not rows:
+            return
+        self._open(name)
+        if 'csv' in self.formats:
+            self._csv[name][1].writerows(flat_row(row) for row in rows)
+        if 'jsonl' in self.formats:
+            f = self._jsonl[name]
+            for row in rows:
+                f.write(json.dumps(row, ensure_ascii=False) + '\n')
+        if 'parquet' in self.formats:
+            state = self._parquet.setdefault(name, {'writer': None, 'schema': None, 'rows': []})
+            state['rows'].extend(flat_row(row) for row in rows)
+            if len(state['rows']) >= self.row_group_size:
+                self._write_row_group(name, state)
+
+    def _write_row_group(self, name, state):
+        if not state['rows']:
+            return
+        if state['schema'] is None:
+            state['schema'] = pa.schema([
+                (col, pa.type_for_alias(PARQUET_TIPOS.get(col, 'string'))) for col in SAIDA_COLUNAS[name]
+            ])
+            state['writer'] = pq.ParquetWriter(os.path.join(self.output_dir, f'{name}.parquet'), state['schema'])
+        columns = {}
+        for col in state['schema']:
+            values = [row.get(col.name) for row in state['rows']]
+            if col.type == pa.string():
+                values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+            columns[col.name] = values
+        state['writer'].write_table(pa.table(columns, schema=state['schema']))
+        state['rows'] = []
+
+    def flush(self):
+        """Descarrega buffers e atualiza estatisticas.json"""
+        for f, _ in self._csv.values():
+            f.flush()
+        for f in self._jsonl.values():
+            f.flush()
+        if self._banco:
+            self._banco.flush()
+        write_json_atomic(os.path.join(self.output_dir, 'estatisticas.json'), self.stats.to_dict())
+
+    def close(self):
+        """Fecha todos os arquivos e retorna as estatísticas finais"""
+        # Como em export_results, itens.csv existe mesmo sem nenhum item
+        self._open('itens')
+        for name, state in self._parquet.items():
+            self._write_row_group(name, state)
+            if state['writer']:
+                state['writer'].close()
+        for dataset in self._datasets or ():
+            dataset.flush()
+        self.flush()
+        for f, _ in self._csv.values():
+            f.close()
+        for f in self._jsonl.values():
+            f.close()
+        if self._banco:
+            self._banco.close()
+            logger.info(f"Banco SQLite {self._banco.path}: {self._banco.inserted} notas gravadas, "
+                        f"{self._banco.unchanged} inalteradas")
+        return self.stats.to_dict()
+
+# ------------------------------ Merge de Shards ------------------------------
+def find_shard_dirs(paths):
+    """Diretórios de shards: os próprios ``paths`` ou seus subdiretórios com manifesto ou journal"""
+    def is_shard(path):
+        return any(os.path.exists(os.path.join(path, name)) for name in (SHARD_MANIFESTO, 'journal.jsonl'))
+    
+    shard_dirs = []
+    for path in paths:
+        if is_shard(path):
+            shard_dirs.append(path)
+            continue
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning(f"Não foi possível ler o diretório {path}: {e}")
+            continue
+        shard_dirs.extend(entry.path for entry in entries if entry.is_dir() and is_shard(entry.path))
+    return shard_dirs
+
+def check_shard_manifests(shard_dirs):
+    """Confere os manifestos: todos da mesma partição, avisando de shards ausentes ou repetidos"""
+    manifests = []
+    for shard_dir in shard_dirs:
+        path = os.path.join(shard_dir, SHARD_MANIFESTO)
+        if not os.path.exists(path):
+            logger.warning(f"{shard_dir} sem {SHARD_MANIFESTO}: combinado como um shard avulso")
+            continue
+        with open(path, encoding='utf-8') as f:
+            manifests.append(json.load(f))
+    partitions = {(m['total'], m['particao']) for m in manifests}
+    if len(partitions) > 1:
+        raise ValueError("shards de partições diferentes: " + ', '.join(
+            f"{total} shards por {particao}" for total, particao in sorted(partitions)))
+    if partitions:
+        (total, _), = partitions
+        found = Counter(m['shard'] for m in manifests)
+        missing = [i for i in range(1, total + 1) if i not in found]
+        if missing:
+            logger.warning(f"Shards ausentes: {', '.join(f'{i}/{total}' for i in missing)} (merge parcial)")
+        for i, count in sorted(found.items()):
+            if count > 1:
+                logger.warning(f"Shard {i}/{total} aparece {count} vezes: as notas repetidas serão descartadas")
+    return manifests
+
+def merge_key(invoice_data):
+    """Identidade de uma nota entre shards: a chave de acesso ou, sem chave válida, o conteúdo"""
+    chave = invoice_data.get('chave_acesso')
+    if chave_valida(chave):
+        return 'chave', chave
+    if invoice_data.get('sha256'):
+        return 'sha256', invoice_data['sha256'], invoice_data.get('arquivo', '').partition('#')[2]
+    return None
+
+def merge_shard_journals(journal_paths, sink=None):
+    """Combina os journals dos shards com uma nota por chave de acesso (a de XML prevalece)"""
+    def entries():
+        return itertools.chain.from_iterable(map(iter_journal_done, journal_paths))
+    
+    # Critério estável: XML antes de OCR, depois conteúdo e caminho (a ordem dos shards não importa)
+    winners = {}
+    for n, entry in enumerate(entries()):
+        key = merge_key(entry['nota'])
+        if key is None:
+            continue
+        rank = (entry['nota'].get('metodo_extracao') != 'xml', entry.get('sha256') or '', entry['arquivo'])
+        if key not in winners or rank < winners[key][0]:
+            winners[key] = (rank, n)
+    chosen = {n for _, n in winners.values()}
+    
+    index_data, items_data, links = [], [], []
+    for n, entry in enumerate(entries()):
+        invoice_data = entry['nota']
+        key = merge_key(invoice_data)
+        if key is not None and n not in chosen:
+            links.append({'caminho': entry['arquivo'], 'sha256': entry.get('sha256'),
+                          'chave': invoice_data.get('chave_acesso'), 'canonico': winners[key][0][2],
+                          'motivo': key[0], 'registrado_em': time.time()})
+            continue
+        items = [ItemNota(**item) for item in entry['itens']]
+        if sink:
+            sink.write(invoice_data, items)
+        else:
+            index_data.append(invoice_data)
+            items_data.extend(items)
+    return index_data, items_data, links
+
+def merge_duplicates(shard_dirs, links, output_dir):
+    """Grava duplicatas.csv com as duplicatas de cada shard e as descartadas no merge"""
+    frames = [pd.read_csv(path, dtype={'chave': str}, encoding='utf-8-sig')
+              for path in (os.path.join(d, 'duplicatas.csv') for d in shard_dirs) if os.path.exists(path)]
+    frames = [frame for frame in frames if len(frame)] + [pd.DataFrame(links, columns=DUPLICATAS_COLUNAS)]
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    df.to_csv(os.path.join(output_dir, 'duplicatas.csv'), index=False, encoding='utf-8-sig')
+    return len(df)
+
 # ------------------------------ Interface Principal ------------------------------
+def month_arg(value):
+    """Valida um mês no formato AAAA-MM (argparse)"""
+    import argparse
+    if not re.fullmatch(r'\d{4}-(0[1-9]|1[0-2])', value):
+        raise argparse.ArgumentTypeError(f"mês inválido: {value} (use AAAA-MM)")
+    return value
+
+def shard_arg(value):
+    """Valida um shard no formato i/N, com 1 <= i <= N (argparse)"""
+    import argparse
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if not match or not 1 <= int(match[1]) <= int(match[2]):
+        raise argparse.ArgumentTypeError(f"shard inválido: {value} (use i/N, com 1 <= i <= N)")
+    return int(match[1]), int(match[2])
+
+def main_query(argv):
+    """Subcomando query: consulta notas no banco SQLite gerado com --sqlite"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog='index_nf.py query',
+                                     description='Consulta notas no banco SQLite gerado com --sqlite')
+    parser.add_argument('banco', nargs='?', default=os.path.join('saida_nf_avancada', 'notas_fiscais.sqlite'),
+                        help='Banco SQLite (padrão: saida_nf_avancada/notas_fiscais.sqlite)')
+    parser.add_argument('--chave', help='Chave de acesso (44 dígitos, espaços são ignorados)')
+    parser.add_argument('--cnpj', help='CNPJ do emitente (com ou sem pontuação)')
+    parser.add_argument('--mes', type=month_arg, help='Mês de emissão (AAAA-MM)')
+    parser.add_argument('--uf', help='UF do emitente')
+    parser.add_argument('--itens', action='store_true', help='Inclui os itens de cada nota')
+    parser.add_argument('--limit', type=int, help='Máximo de notas retornadas')
+    parser.add_argument('--json', action='store_true', help='Uma nota por linha em JSON (padrão: tabela)')
+    args = parser.parse_args(argv)
+    
+    if not os.path.exists(args.banco):
+        parser.error(f"banco não encontrado: {args.banco}")
+    banco = BancoNotas(args.banco, readonly=True)
+    try:
+        start = time.perf_counter()
+        notas = banco.query(chave=clean_number(args.chave) or None, cnpj=clean_number(args.cnpj) or None,
+                            mes=args.mes, uf=args.uf, limit=args.limit)
+        if args.itens:
+            for nota in notas:
+                nota['itens'] = [asdict(item) for item in
+                                 banco.items(nota.get('sha256'), nota.get('chave_acesso'), nota.get('arquivo'))]
+        elapsed = (time.perf_counter() - start) * 1000
+    finally:
+        banco.close()
+    
+    if args.json:
+        for nota in notas:
+            print(json.dumps(nota, ensure_ascii=False))
+    else:
+        columns = ('chave_acesso', 'numero_nf', 'data_emissao', 'cnpj_emitente', 'uf', 'valor_total', 'arquivo')
+        print('\t'.join(columns))
+        for nota in notas:
+            print('\t'.join('' if nota.get(col) is None else str(nota[col]) for col in columns))
+            for item in nota.get('itens', []):
+                print(f"\t- {item['descricao']} | qtd {item['qtd']} | total {item['vl_total']}")
+    logger.info(f"{len(notas)} notas em {elapsed:.1f} ms")
+
+def main_reparse(argv):
+    """Subcomando reparse: refaz o parsing dos textos guardados com --keep-text, sem OCR"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog='index_nf.py reparse',
+                                     description='Refaz o parsing dos textos guardados com --keep-text, sem OCR')
+    parser.add_argument('textos', nargs='?', default=os.path.join('saida_nf_avancada', 'textos_nf.sqlite'),
+                        help='Arquivo de textos (padrão: saida_nf_avancada/textos_nf.sqlite)')
+    parser.add_argument('-o', '--output', default='saida_reparse', help='Diretório de saída')
+    parser.add_argument('-w', '--workers', type=int, help='Processos de parsing (padrão: número de núcleos)')
+    parser.add_argument('--batch-size', type=int, default=REPARSE_LOTE, help='Textos por tarefa de cada worker')
+    parser.add_argument('--stream', action='store_true',
+                        help='Grava cada resultado assim que fica pronto (memória constante, sem Excel)')
+    parser.add_argument('--formats', default='csv,jsonl,json',
+                        help=f"Formatos do modo --stream, separados por vírgula ({','.join(SaidaIncremental.FORMATOS)})")
+    parser.add_argument('--sqlite', nargs='?', const='', metavar='ARQUIVO',
+                        help='Grava notas e itens por upsert num banco SQLite (padrão: <saída>/notas_fiscais.sqlite)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log verboso')
+    args = parser.parse_args(argv)
+    
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    if not os.path.exists(args.textos):
+        parser.error(f"arquivo de textos não encontrado: {args.textos}")
+    
+    sqlite_path = None if args.sqlite is None else (args.sqlite or os.path.join(args.output, 'notas_fiscais.sqlite'))
+    metrics = MetricasEstagios()
+    start = time.perf_counter()
+    if args.stream:
+        formats = [f.strip() for f in args.formats.split(',') if f.strip()]
+        if sqlite_path and 'sqlite' not in formats:
+            formats.append('sqlite')
+        sink = SaidaIncremental(args.output, formats=formats, sqlite_path=sqlite_path)
+        try:
+            reparse_texts(args.textos, max_workers=args.workers, sink=sink, metrics=metrics,
+                          batch_size=args.batch_size)
+        finally:
+            stats = sink.close()
+    else:
+        index_data, items_data = reparse_texts(args.textos, max_workers=args.workers, metrics=metrics,
+                                               batch_size=args.batch_size)
+        if not index_data:
+            logger.error(f"Nenhum texto no arquivo {args.textos}")
+            return
+        _, _, stats = export_results(index_data, items_data, args.output, sqlite_path)
+    elapsed = time.perf_counter() - start
+    
+    os.makedirs(args.output, exist_ok=True)
+    write_json_atomic(os.path.join(args.output, 'metricas.json'), metrics.to_dict())
+    logger.info(f"Reparse: {stats['total_notas']} notas, {stats['total_itens']} itens em {elapsed:.1f} s "
+                f"({stats['total_notas'] / max(elapsed, 1e-9):.0f} notas/s)")
+    logger.info(f"Arquivos de saída salvos em: {args.output}")
+
+def main_merge(argv):
+    """Subcomando merge: combina as saídas dos shards de um lote processado com --shard"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(prog='index_nf.py merge',
+                                     description='Combina as saídas dos shards (--shard i/N) num único resultado, '
+                                                 'com uma nota por chave de acesso')
+    parser.add_argument('shards', nargs='*', default=['saida_nf_avancada'],
+                        help='Diretórios dos shards ou o diretório que os contém (padrão: saida_nf_avancada)')
+    parser.add_argument('-o', '--output',
+                        help='Diretório de saída (padrão: o diretório que contém os shards)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Grava cada resultado assim que fica pronto (memória constante, sem Excel)')
+    parser.add_argument('--formats', default='csv,jsonl,json',
+                        help=f"Formatos do modo --stream, separados por vírgula ({','.join(SaidaIncremental.FORMATOS)})")
+    parser.add_argument('--sqlite', nargs='?', const='', metavar='ARQUIVO',
+                        help='Grava notas e itens por upsert num banco SQLite (padrão: <saída>/notas_fiscais.sqlite)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log verboso')
+    args = parser.parse_args(argv)
+    
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+    shard_dirs = find_shard_dirs(args.shards)
+    if not shard_dirs:
+        parser.error(f"nenhum shard encontrado em {', '.join(args.shards)}")
+    try:
+        check_shard_manifests(shard_dirs)
+    except ValueError as e:
+        parser.error(str(e))
+    output = args.output
+    if output is None:
+        output = args.shards[0] if len(args.shards) == 1 and args.shards[0] not in shard_dirs else 'saida_merge'
+    if os.path.realpath(output) in {os.path.realpath(d) for d in shard_dirs}:
+        parser.error(f"a saída {output} é um dos shards")
+    
+    # Histogramas de tempo por estágio somados de todos os shards
+    metrics = MetricasEstagios()
+    for shard_dir in shard_dirs:
+        path = os.path.join(shard_dir, 'metricas.json')
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                metrics.merge(json.load(f))
+    
+    sqlite_path = None if args.sqlite is None else (args.sqlite or os.path.join(output, 'notas_fiscais.sqlite'))
+    journals = [os.path.join(d, 'journal.jsonl') for d in shard_dirs]
+    start = time.perf_counter()
+    if args.stream:
+        formats = [f.strip() for f in args.formats.split(',') if f.strip()]
+        if sqlite_path and 'sqlite' not in formats:
+            formats.append('sqlite')
+        sink = SaidaIncremental(output, formats=formats, sqlite_path=sqlite_path)
+        try:
+            _, _, links = merge_shard_journals(journals, sink=sink)
+        finally:
+            stats = sink.close()
+    else:
+        index_data, items_data, links = merge_shard_journals(journals)
+        if not index_data:
+            logger.error(f"Nenhuma nota concluída nos shards de {', '.join(args.shards)}")
+            return
+        _, _, stats = export_results(index_data, items_data, output, sqlite_path)
+    elapsed = time.perf_counter() - start
+    
+    os.makedirs(output, exist_ok=True)
+    write_json_atomic(os.path.join(output, 'metricas.json'), metrics.to_dict())
+    if links or any(os.path.exists(os.path.join(d, 'duplicatas.csv')) for d in shard_dirs):
+        merge_duplicates(shard_dirs, links, output)
+    logger.info(f"Merge de {len(shard_dirs)} shards: {stats['total_notas']} notas, {stats['total_itens']} itens "
+                f"({len(links)} notas repetidas entre shards descartadas) em {elapsed:.1f} s")
+    logger.info(f"Arquivos de saída salvos em: {output}")
+
+# Subcomandos de index_nf.py; sem subcomando as entradas são processadas
+SUBCOMANDOS = {'query': main_query, 'reparse': main_reparse, 'merge': main_merge}
+
 def main():
     """Função principal"""
     import sys
     import argparse
     
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMANDOS:
+        return SUBCOMANDOS[sys.argv[1]](sys.argv[2:])
+    
     parser = argparse.ArgumentParser(description='Processador Avançado de Notas Fiscais')
-    parser.add_argument('input', nargs='+', help='Arquivos ou diretórios para processar')
+    parser.add_argument('input', nargs='+',
+                        help='Arquivos ou diretórios para processar (PDF, imagens, XML de NF-e ou zip de XMLs)')
+    parser.add_argument('--no-recursive', action='store_true', help='Não percorre subdiretórios das entradas')
     parser.add_argument('-o', '--output', default='saida_nf_avancada', help='Diretório de saída')
-    parser.add_argument('-w', '--workers', type=int, help='Número de workers paralelos')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='Processos de OCR/parsing (padrão: número de núcleos)')
+    parser.add_argument('--io-workers', type=int, default=4, help='Threads de leitura, hash e consulta ao cache')
+    parser.add_argument('--queue-size', type=int,
+                        help='Máximo de arquivos em andamento no pipeline (padrão: 2x workers)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Log verboso')
+    parser.add_argument('--text-layer', choices=['auto', 'off'], default='auto',
+                        help='auto: usa o texto nativo de PDFs digitais antes do OCR; off: sempre OCR')
+    parser.add_argument('--ocr-strategy', choices=['adaptive', 'exhaustive'], default='adaptive',
+                        help='adaptive: para no primeiro OCR com chave + CNPJ; exhaustive: roda todas as configurações')
+    parser.add_argument('--ocr-backend', choices=['auto', 'tesserocr', 'pytesseract'], default='auto',
+                        help='Motor de OCR: tesserocr mantém o Tesseract carregado em cada worker')
+    parser.add_argument('--no-barcode', action='store_true',
+                        help='Não lê a chave de acesso do código de barras/QR Code antes do OCR')
+    parser.add_argument('--preprocess', choices=('auto',) + PERFIS_PREPROCESSAMENTO, default='auto',
+                        help='Perfil de pré-processamento: auto (pela qualidade da página), fast, standard ou heavy')
+    parser.add_argument('--dpi', type=int, default=200, help='Resolução de renderização das páginas de PDF para OCR')
+    parser.add_argument('--progressive', nargs='?', type=int, const=120, metavar='DPI',
+                        help='OCR de PDFs primeiro a DPI (padrão: 120), re-renderizando a --dpi '
+                             'só se faltar chave, CNPJ ou valor total')
+    parser.add_argument('--layout', action='store_true',
+                        help='OCR com layout: uma passada com posição das palavras, zonas da DANFE e tabela de itens '
+                             'por colunas, relendo só as zonas sem chave, CNPJ ou valor total')
+    parser.add_argument('--multipage', action='store_true',
+                        help='Lê páginas seguintes do PDF quando o bloco de itens continua')
+    parser.add_argument('--max-pages', type=int, default=50, help='Limite de páginas por PDF no modo --multipage')
+    parser.add_argument('--stream', action='store_true',
+                        help='Grava cada resultado assim que fica pronto (memória constante, sem Excel)')
+    parser.add_argument('--formats',
+                        help=f"Formatos do modo --stream, separados por vírgula ({','.join(SaidaIncremental.FORMATOS)}; "
+                             "padrão: csv,jsonl,json)")
+    parser.add_argument('--columnar', action='store_true',
+                        help='Saída colunar: datasets Parquet em <saída>/dataset particionados por UF e mês '
+                             '(modo --stream com o formato dataset, somado aos de --formats)')
+    parser.add_argument('--sqlite', nargs='?', const='', metavar='ARQUIVO',
+                        help='Grava notas e itens por upsert num banco SQLite consultável com o subcomando query '
+                             '(padrão: <saída>/notas_fiscais.sqlite)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Retoma um lote interrompido: pula arquivos já concluídos no journal da saída')
+    parser.add_argument('--no-journal', action='store_true', help='Não grava o journal de processamento')
+    parser.add_argument('--export-journal', action='store_true',
+                        help='Apenas exporta o que já está no journal (exportação parcial) e sai')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reaproveita resultados de arquivos já processados (cache por SHA256)')
+    parser.add_argument('--cache', help='Arquivo do cache de resultados (padrão: <saída>/cache_nf.sqlite)')
+    parser.add_argument('--cache-max-age', type=float, metavar='DIAS',
+                        help='Remove do cache entradas sem acesso há mais de DIAS dias')
+    parser.add_argument('--cache-max-entries', type=int, metavar='N',
+                        help='Mantém no máximo N entradas no cache (descarta as menos acessadas)')
+    parser.add_argument('--cache-clear', action='store_true', help='Invalida todo o cache antes de processar')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Liga arquivos repetidos (SHA256 ou chave de acesso) ao documento canônico em vez de '
+                             'reprocessá-los; o índice persiste entre execuções')
+    parser.add_argument('--dedup-index', help='Arquivo do índice de duplicatas (padrão: <saída>/dedup_nf.sqlite)')
+    parser.add_argument('--keep-text', nargs='?', const='', metavar='ARQUIVO',
+                        help='Guarda o texto extraído de cada arquivo (comprimido, por SHA256) para o subcomando '
+                             'reparse refazer o parsing sem OCR (padrão: <saída>/textos_nf.sqlite)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Grava um cProfile (.pstats) por worker em <saída>/profile')
+    parser.add_argument('--shard', type=shard_arg, metavar='i/N',
+                        help='Processa só o shard i de N do lote (partição determinística: um processo ou nó por '
+                             'shard), com saída em <saída>/shard_i_de_N; o subcomando merge combina os shards')
+    parser.add_argument('--shard-by', choices=['path', 'hash'], default='path',
+                        help='Partição do --shard: path (padrão, recomendado com vários nós: caminho relativo à '
+                             'entrada, sem ler os arquivos) ou hash (SHA256 dos primeiros 64 KiB + tamanho: cópias '
+                             'de um arquivo caem no mesmo shard, mas cada nó abre todos os arquivos)')
     
     args = parser.parse_args()
+    if args.columnar:
+        args.stream = True
+        formats = [f.strip() for f in (args.formats or '').split(',') if f.strip()]
+        args.formats = ','.join(dict.fromkeys(formats + ['dataset']))
+    elif args.formats is None:
+        args.formats = 'csv,jsonl,json'
+    if args.shard:
+        if args.no_journal:
+            parser.error("--shard requer o journal: o subcomando merge combina os journals dos shards")
+        args.output = os.path.join(args.output, SHARD_DIR.format(indice=args.shard[0], total=args.shard[1]))
     
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
     
-    # Coleta arquivos
-    files = []
-    for input_path in args.input:
-        if os.path.isdir(input_path):
-            for ext in ('*.jpg', '*.jpeg', '*.png', '*.tif', '*.tiff', '*.bmp', '*.pdf'):
-                files.extend(glob.glob(os.path.join(input_path, ext)))
-        else:
-            files.append(input_path)
+    opts = OpcoesProcessamento(text_layer=args.text_layer, ocr_strategy=args.ocr_strategy,
+                               multipage=args.multipage, max_pages=args.max_pages,
+                               ocr_backend=args.ocr_backend, codigo_barras=not args.no_barcode,
+                               preprocess=args.preprocess, dpi=args.dpi, dpi_inicial=args.progressive,
+                               layout=args.layout)
+    if args.profile:
+        opts.profile_dir = os.path.join(args.output, 'profile')
+    if args.incremental or args.cache:
+        opts.cache_path = args.cache or os.path.join(args.output, 'cache_nf.sqlite')
+        cache = CacheResultados(opts.cache_path, opts.versao())
+        if args.cache_clear:
+            logger.info(f"Cache invalidado: {cache.clear()} entradas removidas")
+        removed = cache.evict(args.cache_max_age, args.cache_max_entries)
+        if removed:
+            logger.info(f"Cache: {removed} entradas expiradas removidas")
+        logger.info(f"Cache de resultados: {opts.cache_path} ({cache.count()} entradas válidas)")
+        cache.close()
+    if args.dedup or args.dedup_index:
+        opts.dedup_path = args.dedup_index or os.path.join(args.output, 'dedup_nf.sqlite')
+        IndiceDuplicatas(opts.dedup_path).close()
+    if args.keep_text is not None:
+        opts.textos_path = args.keep_text or os.path.join(args.output, 'textos_nf.sqlite')
+        ArquivoTextos(opts.textos_path).close()
     
-    files = sorted(set(files))
+    sqlite_path = None if args.sqlite is None else (args.sqlite or os.path.join(args.output, 'notas_fiscais.sqlite'))
+    journal_path = os.path.join(args.output, 'journal.jsonl')
+    if args.export_journal:
+        index_data, items_data = load_journal_results(journal_path)
+        if not index_data:
+            logger.error(f"Nenhum resultado concluído no journal {journal_path}")
+            return
+        export_results(index_data, items_data, args.output, sqlite_path)
+        logger.info(f"Exportadas {len(index_data)} notas do journal para {args.output}")
+        return
+    
+    if args.shard:
+        # Gravado antes da coleta: um shard sem arquivos também conta como concluído no merge
+        os.makedirs(args.output, exist_ok=True)
+        write_json_atomic(os.path.join(args.output, SHARD_MANIFESTO), {
+            'shard': args.shard[0], 'total': args.shard[1], 'particao': args.shard_by, 'entradas': args.input,
+        })
+        logger.info(f"Shard {args.shard[0]}/{args.shard[1]} (partição por {args.shard_by}): saída em {args.output}")
     
-    if not files:
-        logger.error("Nenhum arquivo encontrado para processar")
+    # Coleta arquivos sob demanda: o processamento começa antes de a árvore ser toda percorrida
+    files = iter_input_files(args.input, recursive=not args.no_recursive, shard=args.shard,
+                             shard_by=args.shard_by)
+    first = next(files, None)
+    if first is None:
+        if args.shard:
+            logger.info(f"Shard {args.shard[0]}/{args.shard[1]} sem arquivos para processar")
+        else:
+            logger.error("Nenhum arquivo encontrado para processar")
         return
+    files = itertools.chain([first], files)
     
-    logger.info(f"Encontrados {len(files)} arquivos para processar")
+    if args.resume:
+        finished = journal_finished_files(journal_path)
+        files = (f for f in files if os.path.abspath(f) not in finished)
+        logger.info(f"Retomando lote: {len(finished)} arquivos já concluídos serão pulados")
+    journal = None if args.no_journal else JournalProcessamento(journal_path, resume=args.resume)
     
     # Processamento
-    index_data, items_data = process_files(files, max_workers=args.workers)
-    
-    if not index_data:
-        logger.error("Nenhum arquivo foi processado com sucesso")
-        return
+    metrics = MetricasEstagios()
+    try:
+        if args.stream:
+            formats = [f.strip() for f in args.formats.split(',') if f.strip()]
+            if sqlite_path and 'sqlite' not in formats:
+                formats.append('sqlite')
+            sink = SaidaIncremental(args.output, formats=formats, sqlite_path=sqlite_path)
+            try:
+                # Ao retomar, a saída é refeita a partir do journal antes de continuar
+                if args.resume:
+                    for invoice_data, items in iter_journal_results(journal_path):
+                        sink.write(invoice_data, items)
+                process_files(files, max_workers=args.workers, opts=opts, sink=sink, journal=journal,
+                              metrics=metrics, io_workers=args.io_workers, queue_size=args.queue_size)
+            finally:
+                stats = sink.close()
+            if not stats['total_notas']:
+                logger.error("Nenhum arquivo foi processado com sucesso")
+                return
+        else:
+            index_data, items_data = load_journal_results(journal_path) if args.resume else ([], [])
+            new_index, new_items = process_files(files, max_workers=args.workers, opts=opts, journal=journal,
+                                                 metrics=metrics, io_workers=args.io_workers,
+                                                 queue_size=args.queue_size)
+            index_data.extend(new_index)
+            items_data.extend(new_items)
+    finally:
+        if journal:
+            journal.close()
+        # Tempos por estágio dos arquivos processados nesta execução
+        os.makedirs(args.output, exist_ok=True)
+        write_json_atomic(os.path.join(args.output, 'metricas.json'), metrics.to_dict())
+        if opts.dedup_path:
+            export_duplicates(opts.dedup_path, args.output)
     
-    # Exportação
-    df_index, df_items, stats = export_results(index_data, items_data, args.output)
+    if not args.stream:
+        if not index_data:
+            logger.error("Nenhum arquivo foi processado com sucesso")
+            return
+        
+        # Exportação
+        df_index, df_items, stats = export_results(index_data, items_data, args.output, sqlite_path)
     
     # Relatório final
     logger.info("\n" + "="*50)
@@ -759,6 +4090,17 @@ def main():
     logger.info(f"Notas válidas: {stats['notas_validas']}")
     logger.info(f"Total de itens: {stats['total_itens']}")
     logger.info(f"Tipos de documento: {stats['tipos_documento']}")
+    if stats['ocr']:
+        logger.info(f"Passadas de OCR: {stats['ocr']['passadas_executadas']} executadas, "
+                    f"{stats['ocr']['passadas_economizadas']} economizadas")
+        if 'dpi_progressivo' in stats['ocr']:
+            progressivo = stats['ocr']['dpi_progressivo']
+            logger.info(f"DPI progressivo: {progressivo['escaladas']}/{progressivo['notas']} notas re-renderizadas "
+                        f"({progressivo['taxa_escalonamento']:.1%})")
+    for name, metric in list(metrics.to_dict()['estagios'].items())[:5]:
+        logger.info(f"Estágio {name}: {metric['wall_total_ms']:.0f} ms total, p50 {metric['wall_p50_ms']} ms")
+    if opts.profile_dir:
+        logger.info(f"Perfis cProfile dos workers em: {opts.profile_dir}")
     logger.info(f"Arquivos de saída salvos em: {args.output}")
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Configuração dos testes Python (pytest): torna os módulos de py/ importáveis e
+oferece fábricas de chaves de acesso e XMLs de NF-e mínimos"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'py'))
+
+NFE_XML = '''<?xml version="1.0" encoding="UTF-8"?>
+<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00"><NFe><infNFe Id="NFe{chave}" versao="4.00">
+<ide><cUF>35</cUF><mod>55</mod><serie>1</serie><nNF>{numero}</nNF><dhEmi>2023-05-10T10:00:00-03:00</dhEmi></ide>
+<emit><CNPJ>11222333000181</CNPJ><xNome>EMPRESA ALFA LTDA</xNome><enderEmit><xLgr>RUA DAS FLORES</xLgr><nro>123</nro>
+<xMun>SAO PAULO</xMun><UF>SP</UF></enderEmit><IE>123456789110</IE></emit>
+<dest><CNPJ>45997418000153</CNPJ><xNome>CLIENTE BETA SA</xNome></dest>
+{dets}
+<total><ICMSTot><vProd>{valor}</vProd><vNF>{valor}</vNF></ICMSTot></total></infNFe></NFe>
+<protNFe versao="4.00"><infProt><chNFe>{chave}</chNFe><cStat>100</cStat></infProt></protNFe></nfeProc>'''
+
+NFE_DET = ('<det nItem="{i}"><prod><cProd>{i}</cProd><xProd>PRODUTO {i}</xProd><NCM>73181500</NCM>'
+           '<CFOP>5102</CFOP><uCom>UN</uCom><qCom>2.0000</qCom><vUnCom>7.5000</vUnCom><vProd>15.00</vProd></prod></det>')
+
+
+def chave_com_dv(digits):
+    """Completa 43 dígitos com o DV módulo 11 da chave de acesso (pesos 2 a 9 da direita)"""
+    total = sum(int(d) * (2 + i % 8) for i, d in enumerate(reversed(digits)))
+    dv = 11 - total % 11
+    return digits + str(0 if dv >= 10 else dv)
+
+
+def build_chave(numero, cnpj='11222333000181', uf='35', aamm='2305', modelo='55', serie=1):
+    return chave_com_dv(f'{uf}{aamm}{cnpj}{modelo}{serie:03d}{numero:09d}1{numero:08d}')
+
+
+def build_nfe_xml(numero, itens=2):
+    """(chave, XML) de uma NF-e autorizada com ``itens`` itens de 15,00"""
+    chave = build_chave(numero)
+    dets = ''.join(NFE_DET.format(i=i) for i in range(1, itens + 1))
+    return chave, NFE_XML.format(chave=chave, numero=numero, dets=dets, valor=f'{15 * itens:.2f}')
+
+
+@pytest.fixture
+def make_chave():
+    return build_chave
+
+
+@pytest.fixture
+def nfe_xml():
+    return build_nfe_xml
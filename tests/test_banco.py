@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Testes do banco SQLite de notas (--sqlite) e do subcomando query (py/index_nf.py)"""
+
+import shutil
+import sqlite3
+import sys
+import zipfile
+
+import index_nf
+
+
+def make_inputs(tmp_path, nfe_xml):
+    """Quatro notas: nf1.xml, uma cópia byte a byte dele, o mesmo XML dentro de um zip e nf2.xml"""
+    entradas = tmp_path / 'entradas'
+    entradas.mkdir()
+    chave1, xml1 = nfe_xml(1)
+    (entradas / 'nf1.xml').write_text(xml1, encoding='utf-8')
+    shutil.copy(entradas / 'nf1.xml', entradas / 'copia.xml')
+    with zipfile.ZipFile(entradas / 'lote.zip', 'w') as archive:
+        archive.write(entradas / 'nf1.xml', 'nf1.xml')
+    (entradas / 'nf2.xml').write_text(nfe_xml(2, itens=1)[1], encoding='utf-8')
+    return entradas, chave1
+
+
+def write_all(path, docs):
+    banco = index_nf.BancoNotas(str(path))
+    for invoice_data, items in docs:
+        banco.write(invoice_data, index_nf.validate_invoice_data(invoice_data, items), items)
+    banco.close()
+    return banco
+
+
+def test_identical_rerun_writes_no_rows(tmp_path, nfe_xml):
+    entradas, chave1 = make_inputs(tmp_path, nfe_xml)
+    docs = [doc for path in sorted(entradas.iterdir()) for doc in index_nf.read_xml_documents(str(path))]
+    path = tmp_path / 'notas.sqlite'
+    
+    first = write_all(path, docs)
+    assert (first.inserted, first.unchanged) == (4, 0)
+    again = write_all(path, docs)
+    assert (again.inserted, again.unchanged) == (0, 4)
+    
+    # Arquivos de mesmo conteúdo são notas distintas, cada uma com seus itens
+    banco = index_nf.BancoNotas(str(path), readonly=True)
+    try:
+        notas = banco.query(chave=chave1)
+        assert sorted(nota['arquivo'] for nota in notas) == ['copia.xml', 'lote.zip#nf1.xml', 'nf1.xml']
+        for nota in notas:
+            items = banco.items(nota['sha256'], nota['chave_acesso'], nota['arquivo'])
+            assert [item.arquivo for item in items] == [nota['arquivo']] * 2
+    finally:
+        banco.close()
+
+
+def test_incremental_sqlite_rerun_keeps_rows(tmp_path, monkeypatch, nfe_xml):
+    entradas, _ = make_inputs(tmp_path, nfe_xml)
+    saida = tmp_path / 'saida'
+    argv = ['index_nf.py', str(entradas), '-o', str(saida), '-w', '1', '--incremental', '--sqlite',
+            '--stream', '--formats', 'jsonl']
+    
+    def rows():
+        with sqlite3.connect(saida / 'notas_fiscais.sqlite') as conn:
+            return sorted(conn.execute('SELECT arquivo, atualizado_em FROM notas'))
+    
+    monkeypatch.setattr(sys, 'argv', argv)
+    index_nf.main()
+    before = rows()
+    index_nf.main()
+    assert len(before) == 4
+    assert rows() == before
+
+
+def test_legacy_schema_is_migrated(tmp_path, nfe_xml):
+    path = tmp_path / 'legado.sqlite'
+    invoice_data, items = next(index_nf.iter_nfe_xml(nfe_xml(5)[1].encode('utf-8'), 'nf5.xml', 'f' * 64))
+    # Esquema 1: notas e itens identificados só por (sha256, chave_acesso)
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE notas (sha256 TEXT NOT NULL, chave_acesso TEXT NOT NULL DEFAULT '', "
+            + ''.join(f"{col} {'REAL' if col == 'valor_total' else 'TEXT'}, " for col in index_nf.BANCO_COLUNAS_NOTAS)
+            + 'dados TEXT NOT NULL, atualizado_em REAL NOT NULL, PRIMARY KEY (sha256, chave_acesso))')
+        conn.execute(
+            "CREATE TABLE itens (sha256 TEXT NOT NULL, chave_acesso TEXT NOT NULL DEFAULT '', seq INTEGER NOT NULL, "
+            'arquivo TEXT, descricao TEXT, ncm TEXT, cfop TEXT, qtd REAL, unidade TEXT, vl_unit REAL, vl_total REAL, '
+            'linha_ocr TEXT, PRIMARY KEY (sha256, chave_acesso, seq))')
+        conn.execute('CREATE INDEX idx_notas_chave ON notas (chave_acesso)')
+        conn.execute(
+            f"INSERT INTO notas (sha256, chave_acesso, {', '.join(index_nf.BANCO_COLUNAS_NOTAS)}, dados, atualizado_em) "
+            f"VALUES (?, ?, {', '.join('?' * len(index_nf.BANCO_COLUNAS_NOTAS))}, ?, 1.0)",
+            ('f' * 64, invoice_data['chave_acesso'], *[invoice_data.get(col) for col in index_nf.BANCO_COLUNAS_NOTAS],
+             '{}'))
+        conn.executemany(
+            'INSERT INTO itens VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [('f' * 64, invoice_data['chave_acesso'], seq, item.arquivo, item.descricao, item.ncm, item.cfop,
+              item.qtd, item.unidade, item.vl_unit, item.vl_total, item.linha_ocr) for seq, item in enumerate(items)])
+    
+    banco = index_nf.BancoNotas(str(path))
+    try:
+        [nota] = banco.query(chave=invoice_data['chave_acesso'])
+        assert [item.descricao for item in banco.items('f' * 64, invoice_data['chave_acesso'], 'nf5.xml')] == [
+            'PRODUTO 1', 'PRODUTO 2']
+        assert banco.conn.execute('PRAGMA user_version').fetchone()[0] == index_nf.BANCO_ESQUEMA
+        assert banco.conn.execute("SELECT name FROM sqlite_master WHERE name LIKE '%_v1'").fetchall() == []
+    finally:
+        banco.close()
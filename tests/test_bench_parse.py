@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""Conferência da saída do parsing com a esperada para o corpus de py/bench_parse.py"""
+
+import bench_parse
+
+
+def test_parse_output_matches_committed_expected():
+    expected = bench_parse.load_expected()
+    corpus = bench_parse.make_corpus(expected['documentos'], expected['seed'])
+
+    # Mudança intencional do parsing: regravar com `python py/bench_parse.py
+    # --update-expected` e incrementar PIPELINE_VERSION
+    assert bench_parse.count_divergent(corpus, expected['seed'], expected) == 0
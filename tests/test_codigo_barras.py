@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Testes da chave de acesso lida do código de barras da DANFE (py/index_nf.py)"""
+
+import random
+
+import cv2
+import numpy as np
+import pytest
+
+import index_nf
+from conftest import build_chave, chave_com_dv
+
+
+def code128c_row(digits, module=3, quiet=20):
+    """Linha de pixels (0 = barra, 255 = espaço) do Code-128 subconjunto C de ``digits``"""
+    values = [int(digits[i:i + 2]) for i in range(0, len(digits), 2)]
+    check = (index_nf.CODE128_START_C + sum(v * (i + 1) for i, v in enumerate(values))) % 103
+    widths = ''.join(index_nf.CODE128_PADROES[v]
+                     for v in [index_nf.CODE128_START_C, *values, check, index_nf.CODE128_STOP])
+    row = [255] * quiet * module
+    for i, width in enumerate(widths):
+        row += [0 if i % 2 == 0 else 255] * int(width) * module
+    row += [255] * quiet * module
+    return np.array(row, dtype=np.uint8)
+
+
+def test_chave_valida_accepts_computed_dv():
+    rng = random.Random(13)
+    for _ in range(500):
+        chave = chave_com_dv(''.join(str(rng.randint(0, 9)) for _ in range(43)))
+        assert index_nf.chave_valida(chave)
+
+
+def test_chave_valida_rejects_wrong_dv():
+    chave = build_chave(339250)
+    for dv in '0123456789':
+        if dv != chave[-1]:
+            assert not index_nf.chave_valida(chave[:-1] + dv)
+
+
+@pytest.mark.parametrize('chave', [None, '', '1' * 43, build_chave(1)[:-1] + 'X', build_chave(1) + '0'])
+def test_chave_valida_rejects_malformed(chave):
+    assert not index_nf.chave_valida(chave)
+
+
+def test_decode_code128_row_reads_chave():
+    chave = build_chave(339250)
+    assert index_nf.decode_code128_row(code128c_row(chave)) == chave
+
+
+def test_decode_code128_row_tolerates_scale_and_noise():
+    chave = build_chave(42)
+    row = code128c_row(chave, module=1)
+    # Módulo de 2,7 px com interpolação e ruído, como numa página escaneada; a leitura
+    # decodifica a média de uma faixa de linhas
+    row = cv2.resize(row.reshape(1, -1), (int(len(row) * 2.7), 1), interpolation=cv2.INTER_LINEAR)[0]
+    noise = np.random.default_rng(0).normal(0, 20, (9, row.size))
+    band = np.clip(row + noise, 0, 255)
+    assert index_nf.decode_code128_row(band.mean(axis=0)) == chave
+
+
+def test_decode_code128_row_rejects_bad_checksum():
+    chave = build_chave(7)
+    row = code128c_row(chave)
+    # Troca o símbolo do primeiro par de dígitos por outro de mesma largura total
+    start = (20 + 11) * 3
+    wrong = '12' if chave[:2] != '12' else '13'
+    patched = code128c_row(wrong + chave[2:])
+    row[start:start + 33] = patched[start:start + 33]
+    assert index_nf.decode_code128_row(row) is None
+    assert index_nf.decode_code128_row(np.full(600, 255, dtype=np.uint8)) is None
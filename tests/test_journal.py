@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Testes do journal de processamento e do --resume (py/index_nf.py)"""
+
+import json
+import os
+import sys
+from collections import defaultdict
+
+import index_nf
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, 'argv', ['index_nf.py', *map(str, argv)])
+    index_nf.main()
+
+
+def statuses_by_file(journal_path):
+    statuses = defaultdict(list)
+    for entry in index_nf.JournalProcessamento.iter_entries(str(journal_path)):
+        statuses[os.path.basename(entry['arquivo'])].append(entry['status'])
+    return statuses
+
+
+def test_resume_skips_finished_files(tmp_path, monkeypatch, nfe_xml):
+    entradas, saida = tmp_path / 'entradas', tmp_path / 'saida'
+    entradas.mkdir()
+    for numero in (1, 2):
+        (entradas / f'nf{numero}.xml').write_text(nfe_xml(numero)[1], encoding='utf-8')
+    args = (entradas, '-o', saida, '-w', '1', '--stream', '--formats', 'jsonl')
+    run_main(monkeypatch, *args)
+    journal = saida / 'journal.jsonl'
+    
+    # Queda simulada: nf2 ficou só 'pendente' e a última linha foi gravada pela metade
+    lines = [line for line in journal.read_text(encoding='utf-8').splitlines()
+             if not ('nf2.xml' in line and '"ok"' in line)]
+    journal.write_text('\n'.join(lines) + '\n{"arquivo": "trunc', encoding='utf-8')
+    (entradas / 'nf3.xml').write_text(nfe_xml(3)[1], encoding='utf-8')
+    
+    assert index_nf.journal_finished_files(str(journal)) == {str(entradas / 'nf1.xml')}
+    run_main(monkeypatch, *args, '--resume')
+    
+    statuses = statuses_by_file(journal)
+    assert statuses['nf1.xml'] == ['pendente', 'ok']
+    assert statuses['nf2.xml'] == ['pendente', 'pendente', 'ok']
+    assert statuses['nf3.xml'] == ['pendente', 'ok']
+    # A saída é refeita do journal e completada com os arquivos novos, sem repetições
+    with open(saida / 'notas_fiscais.jsonl', encoding='utf-8') as f:
+        notas = [json.loads(line) for line in f]
+    assert sorted(nota['arquivo'] for nota in notas) == ['nf1.xml', 'nf2.xml', 'nf3.xml']
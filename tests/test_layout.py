@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Testes do parsing do texto do OCR com layout (--layout) (py/index_nf.py)"""
+
+import index_nf
+
+TEXTO_LAYOUT = '\n'.join([
+    'EMPRESA ALFA COMERCIO LTDA',
+    'RUA DAS FLORES, 123',
+    'CNPJ',
+    '12.345.678/0001-95',
+    'DESTINATARIO / REMETENTE',
+    'NOME / RAZAO SOCIAL',
+    'CLIENTE BETA SERVICOS S/A',
+    'CNPJ/CPF',
+    '11.222.333/0001-81',
+    'CALCULO DO IMPOSTO',
+    'VALOR TOTAL DA NOTA',
+    '1.234,56',
+    'DADOS DOS PRODUTOS / SERVICOS',
+    'CODIGO\tDESCRICAO\tNCM\tCFOP\tUN\tQTD\tV.UNIT\tV.TOTAL',
+    '0001\tPARAFUSO SEXTAVADO ACO INOX M8X40\t73181500\t5102\tUN\t4,0000\t273,50\t1.094,00',
+    '0002\tPORCA M8\t73181600\t5102\tUN\t2,0000\t70,28\t140,56',
+    'DADOS ADICIONAIS',
+])
+
+
+def info_layout():
+    info = index_nf.new_extraction_info()
+    info.update(metodo_extracao='ocr', ocr_config=index_nf.OCR_LAYOUT_ROTULO)
+    return info
+
+
+def test_layout_text_fields_and_table_items():
+    invoice_data, items = index_nf.parse_extracted_text(TEXTO_LAYOUT, info_layout(), 'nf.png', 'ab' * 32)
+
+    assert invoice_data['cnpj_emitente'] == '12345678000195'
+    assert invoice_data['razao_emitente'] == 'EMPRESA ALFA COMERCIO LTDA'
+    assert invoice_data['cnpj_destinatario'] == '11222333000181'
+    assert invoice_data['razao_destinatario'] == 'CLIENTE BETA SERVICOS S/A'
+    assert invoice_data['valor_total'] == 1234.56
+    assert [(i.descricao, i.ncm, i.cfop, i.unidade, i.qtd, i.vl_unit, i.vl_total) for i in items] == [
+        ('PARAFUSO SEXTAVADO ACO INOX M8X40', '73181500', '5102', 'UN', 4.0, 273.5, 1094.0),
+        ('PORCA M8', '73181600', '5102', 'UN', 2.0, 70.28, 140.56),
+    ]
+
+
+def test_table_columns_only_with_layout(monkeypatch):
+    block = TEXTO_LAYOUT.split('DADOS DOS PRODUTOS / SERVICOS\n')[1]
+    assert len(index_nf.parse_items_detailed(block, None, 'nf.png', layout=True)) == 2
+
+    chamadas = []
+    monkeypatch.setattr(index_nf, 'parse_table_items', lambda *args: chamadas.append(args) or [])
+    index_nf.parse_items_detailed(block, None, 'nf.pdf')
+
+    assert chamadas == []
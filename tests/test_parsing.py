@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Testes das heurísticas de parsing do texto de notas fiscais (py/index_nf.py)"""
+
+import random
+import re
+
+import numpy as np
+import pytest
+
+import index_nf
+
+
+def total_by_priority(upper_text):
+    """Referência de find_total_value: um re.search por padrão, na ordem de VALOR_PATS"""
+    for pattern in index_nf.VALOR_PATS:
+        match = re.search(pattern, upper_text)
+        if match and index_nf.parse_money(match.group(1)):
+            return index_nf.parse_money(match.group(1))
+    return None
+
+
+@pytest.mark.parametrize('text, expected', [
+    # VALOR TOTAL DA NOTA prevalece mesmo aparecendo depois do total dos produtos
+    ('VALOR TOTAL DOS PRODUTOS 1.000,00 FRETE 10,00 VALOR TOTAL DA NOTA 1.010,00', 1010.00),
+    # Sem ele, o total dos produtos vem antes de "TOTAL DA NOTA"
+    ('TOTAL DA NOTA 90,00 VALOR TOTAL DOS PRODUTOS R$ 100,00', 100.00),
+    ('VALOR DA NOTA: 55,10 TOTAL 3,00', 55.10),
+    ('TOTAL R$ 12,34', 12.34),
+    ('VALOR TOTAL DO SERVICO = 250,00 TOTAL 1,00', 250.00),
+    ('VALOR TOTAL DOS SERVICOS 80,00', 80.00),
+    # Um valor que não converte passa para o padrão seguinte
+    ('VALOR TOTAL DA NOTA ,, VALOR TOTAL DOS PRODUTOS 7,50', 7.50),
+    ('SEM VALORES AQUI', None),
+])
+def test_find_total_value_follows_valor_pats_priority(text, expected):
+    assert index_nf.find_total_value(text) == expected
+    assert total_by_priority(text) == expected
+
+
+def test_find_total_value_matches_reference_on_random_texts():
+    rng = random.Random(6)
+    fragments = ['VALOR TOTAL DA NOTA', 'VALOR TOTAL DOS PRODUTOS', 'VALOR TOTAL DO SERVICO:', 'VALOR DA NOTA',
+                 'TOTAL DA NOTA', 'VALOR TOTAL', 'TOTAL', 'VALOR TOTAL DA NFSE', 'VALOR TOTAL DOS SERVICOS',
+                 'DESCONTO', 'FRETE', 'R$']
+    for _ in range(2000):
+        parts = []
+        for _ in range(rng.randint(1, 6)):
+            parts.append(rng.choice(fragments))
+            parts.append(rng.choice([f'{rng.randint(0, 99999)},{rng.randint(0, 99):02d}', '0,00', ',', 'ISENTO']))
+        text = ' '.join(parts)
+        assert index_nf.find_total_value(text) == total_by_priority(text), text
+
+
+def test_decode_chave_acesso_fields(make_chave):
+    chave = make_chave(339250, cnpj='11222333000181', uf='35', aamm='2305', modelo='65', serie=12)
+    assert index_nf.decode_chave_acesso(chave) == {
+        'uf': 'SP',
+        'mes_emissao': '2023-05',
+        'cnpj_emitente': '11222333000181',
+        'modelo': '65',
+        'tipo': index_nf.MODELOS_DOCUMENTO['65'],
+        'serie': '12',
+        'numero_nf': '339250',
+        'tipo_emissao': '1',
+    }
+
+
+@pytest.mark.parametrize('kwargs', [{'uf': '99'}, {'aamm': '2313'}, {'aamm': '2300'}])
+def test_decode_chave_acesso_rejects_invalid_fields(make_chave, kwargs):
+    assert index_nf.decode_chave_acesso(make_chave(1, **kwargs)) is None
+
+
+def test_decode_chave_acesso_rejects_wrong_dv(make_chave):
+    chave = make_chave(1)
+    assert index_nf.decode_chave_acesso(chave[:-1] + str((int(chave[-1]) + 1) % 10)) is None
+
+
+@pytest.mark.parametrize('numero_texto', ['000339250', '000.339.250', '339250'])
+def test_numero_nf_same_format_on_every_path(make_chave, nfe_xml, numero_texto):
+    chave = make_chave(339250)
+    sem_chave = index_nf.parse_invoice_data(f'DANFE\nNº {numero_texto} SÉRIE 1\n', 'nf.pdf')
+    com_chave = index_nf.parse_invoice_data(f'DANFE\nNº {numero_texto}\nCHAVE DE ACESSO\n{chave}\n', 'nf.pdf')
+    root = index_nf.ET.fromstring(nfe_xml(339250)[1].encode('utf-8'))
+    inf = next(el for el in root.iter() if el.tag.endswith('infNFe'))
+    xml = index_nf.parse_nfe_element(inf, 'nf.xml', None)[0]
+    # Sem chave válida o número vem do próprio nNF
+    inf.set('Id', 'NFe' + chave[:-1])
+    xml_sem_chave = index_nf.parse_nfe_element(inf, 'nf.xml', None)[0]
+    assert {sem_chave['numero_nf'], com_chave['numero_nf'], xml['numero_nf'], xml_sem_chave['numero_nf']} == {'339250'}
+
+
+@pytest.mark.parametrize('serie_texto', ['001', '1', '01'])
+def test_serie_same_format_on_every_path(make_chave, nfe_xml, serie_texto):
+    chave = make_chave(339250, serie=1)
+    sem_chave = index_nf.parse_invoice_data(f'DANFE\nNº 339250 SÉRIE {serie_texto}\n', 'nf.pdf')
+    com_chave = index_nf.parse_invoice_data(f'DANFE\nSÉRIE {serie_texto}\nCHAVE DE ACESSO\n{chave}\n', 'nf.pdf')
+    xml_text = nfe_xml(339250)[1].replace('<serie>1</serie>', f'<serie>{serie_texto}</serie>')
+    inf = next(el for el in index_nf.ET.fromstring(xml_text.encode('utf-8')).iter() if el.tag.endswith('infNFe'))
+    xml = index_nf.parse_nfe_element(inf, 'nf.xml', None)[0]
+    inf.set('Id', 'NFe' + chave[:-1])
+    xml_sem_chave = index_nf.parse_nfe_element(inf, 'nf.xml', None)[0]
+    assert {sem_chave['serie'], com_chave['serie'], xml['serie'], xml_sem_chave['serie']} == {'1'}
+    assert index_nf.normalize_serie('U') == 'U' and index_nf.normalize_serie('') is None
+
+
+def danfe_text(chave):
+    """Texto de uma DANFE linha a linha, como o do OCR com layout"""
+    return '\n'.join([
+        'DANFE',
+        'DOCUMENTO AUXILIAR DA NOTA FISCAL ELETRÔNICA',
+        'Nº 000.339.250 SÉRIE 1',
+        'EMPRESA ALFA COMÉRCIO LTDA',
+        'CNPJ 12.345.678/0001-95',
+        'RUA DAS FLORES, 123',
+        'SÃO PAULO, SP',
+        'CHAVE DE ACESSO',
+        ' '.join(chave[i:i + 4] for i in range(0, 44, 4)),
+        'DESTINATÁRIO / REMETENTE',
+        'CLIENTE BETA SERVIÇOS S/A',
+        'CNPJ/CPF 11.222.333/0001-81 DATA DA EMISSÃO 10/05/2023',
+        'INSCRIÇÃO ESTADUAL 123.456.789.110',
+        'CÁLCULO DO IMPOSTO',
+        'VALOR TOTAL DOS PRODUTOS 1.234,56',
+        'VALOR TOTAL DA NOTA 1.244,56',
+        'DADOS DOS PRODUTOS/SERVIÇOS',
+        'CÓDIGO DESCRIÇÃO NCM CST CFOP UN QTD V.UNIT V.TOTAL',
+        '0001 PARAFUSO SEXTAVADO 73181500 000 5102 UN 4,0000 273,50 1.094,00',
+        '0002 PORCA M8 73181600 000 5102 UN 2,0000 70,28 140,56',
+        'DADOS ADICIONAIS',
+        'INFORMAÇÕES COMPLEMENTARES: frete 10,00',
+    ])
+
+
+def test_normalize_text_keeps_line_breaks_only_with_layout():
+    assert index_nf.normalize_text('  EMPRESA   ALFA \r\n\tCNPJ  12 \n') == 'EMPRESA ALFA CNPJ 12'
+    assert index_nf.normalize_text('COD\t DESCRIÇÃO \nA  B', layout=True) == 'COD\tDESCRICAO\nA B'
+
+
+def test_danfe_text_fields(make_chave):
+    chave = make_chave(339250, cnpj='12345678000195')
+
+    invoice_data = index_nf.parse_invoice_data(danfe_text(chave), 'nf.pdf', layout=True)
+
+    assert {k: v for k, v in invoice_data.items() if k != 'itens_raw'} == {
+        'arquivo': 'nf.pdf', 'tipo': 'NF-e', 'chave_acesso': chave, 'numero_nf': '339250', 'serie': '1',
+        'data_emissao': '2023-05-10', 'cnpj_emitente': '12345678000195',
+        'razao_emitente': 'EMPRESA ALFA COMERCIO LTDA', 'cnpj_destinatario': '11222333000181',
+        'razao_destinatario': 'CLIENTE BETA SERVICOS S/A', 'uf': 'SP', 'valor_total': 1244.56,
+        'endereco_emitente': 'RUA DAS FLORES, 123 SAO PAULO, SP', 'municipio_emitente': 'SAO PAULO',
+        'ie_emitente': '123.456.789.110', 'mes_emissao': '2023-05', 'chave_valida': True,
+    }
+    assert invoice_data['itens_raw'].splitlines()[2:] == [
+        '0001 PARAFUSO SEXTAVADO 73181500 000 5102 UN 4,0000 273,50 1.094,00',
+        '0002 PORCA M8 73181600 000 5102 UN 2,0000 70,28 140,56',
+    ]
+
+
+def test_danfe_text_items_one_per_line(make_chave):
+    chave = make_chave(339250, cnpj='12345678000195')
+    invoice_data = index_nf.parse_invoice_data(danfe_text(chave), 'nf.pdf', layout=True)
+
+    items = index_nf.parse_items_detailed(invoice_data['itens_raw'], chave, 'nf.pdf', layout=True)
+
+    # Quantidade e unitário saem das heurísticas de parse_single_item (quantidade
+    # antes da unidade), que não cobrem a ordem das colunas da DANFE
+    assert [(i.chave_acesso, i.arquivo, i.descricao, i.ncm, i.cfop, i.vl_total) for i in items] == [
+        (chave, 'nf.pdf', '0001 PARAFUSO SEXTAVADO 73181500 000 5102 UN 4,0000 273,50 1.094,00',
+         '73181500', '5102', 1094.0),
+        (chave, 'nf.pdf', '0002 PORCA M8 73181600 000 5102 UN 2,0000 70,28 140,56',
+         '73181600', '5102', 140.56),
+    ]
+    assert [i.linha_ocr for i in items] == [i.descricao for i in items]
+
+
+class BackendFixo(index_nf.BackendOCR):
+    """Backend de OCR que devolve sempre o mesmo texto e conta as passadas"""
+    name = 'fixo'
+
+    def __init__(self, text):
+        self.text = text
+        self.configs = []
+
+    def image_to_string(self, img, config):
+        self.configs.append(config)
+        return self.text
+
+
+@pytest.mark.parametrize('text, early_exit', [('', False), ('DANFE CNPJ 12.345.678/0001-95', True)])
+def test_barcode_chave_needs_text_evidence_to_stop_ocr(monkeypatch, make_chave, text, early_exit):
+    chave = make_chave(1, cnpj='12345678000195')
+    backend = BackendFixo(text)
+    monkeypatch.setattr(index_nf, '_ocr_backend', backend)
+    monkeypatch.setattr(index_nf, '_ocr_scheduler', None)
+    monkeypatch.setattr(index_nf, 'choose_preprocess_profile', lambda quality: 'standard')
+    opts = index_nf.OpcoesProcessamento(preprocess='auto')
+    img = np.full((200, 200), 255, dtype=np.uint8)
+
+    text_out, _, score, passes, profile, readings = index_nf.ocr_image(img, opts, chave)
+
+    assert (score >= index_nf.OCR_EARLY_EXIT_SCORE) == early_exit
+    if early_exit:
+        assert (passes, readings) == (1, 1)
+    else:
+        # Texto vazio: todas as configurações e a nova leitura com o perfil 'heavy'
+        assert (passes, readings, profile) == (2 * len(index_nf.OCR_CONFIGS), 2, 'heavy')
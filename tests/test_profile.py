@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+"""Testes do --profile: pstats por worker (py/index_nf.py)"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import index_nf
+
+
+def test_worker_profile_written_once_at_exit(tmp_path):
+    opts = index_nf.OpcoesProcessamento(profile_dir=str(tmp_path / 'profile'))
+    arquivos = [str(tmp_path / f'nf{i}.png') for i in range(4)]
+    for arquivo in arquivos:
+        open(arquivo, 'wb').close()
+
+    with ProcessPoolExecutor(1) as executor:
+        list(executor.map(index_nf.process_single_file, arquivos, [opts] * len(arquivos)))
+        # Menos de PROFILE_GRAVAR_A_CADA arquivos: nada gravado enquanto o worker vive
+        assert not list((tmp_path / 'profile').glob('*.pstats'))
+
+    assert len(list((tmp_path / 'profile').glob('worker_*.pstats'))) == 1
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Testes da saída incremental (--stream) (py/index_nf.py)"""
+
+import csv
+import sys
+
+import pandas as pd
+
+import index_nf
+
+
+def test_first_record_duplicate_keeps_all_columns(tmp_path, nfe_xml):
+    root = index_nf.ET.fromstring(nfe_xml(1)[1].encode('utf-8'))
+    inf = next(el for el in root.iter() if el.tag.endswith('infNFe'))
+    invoice_data, items = index_nf.parse_nfe_element(inf, 'nf1.xml', 'ab' * 32)
+    invoice_data['chave_confere_codigo_barras'] = True
+    duplicata = index_nf.duplicate_record('copia.xml', '/entradas/nf1.xml', 'sha256', 'ab' * 32,
+                                          invoice_data['chave_acesso'])
+
+    saida = index_nf.SaidaIncremental(str(tmp_path), formats=('csv', 'parquet'))
+    saida.write(duplicata, [])
+    saida.write(invoice_data, items)
+    saida.close()
+
+    with open(tmp_path / 'notas_fiscais.csv', encoding='utf-8-sig', newline='') as f:
+        rows = list(csv.DictReader(f))
+    parquet = pd.read_parquet(tmp_path / 'notas_fiscais.parquet')
+    for colunas in (list(rows[0]), list(parquet.columns)):
+        assert colunas == list(index_nf.SAIDA_COLUNAS['notas_fiscais'])
+    assert rows[0]['motivo_duplicata'] == 'sha256' and rows[0]['cnpj_emitente'] == ''
+    assert rows[1]['cnpj_emitente'] == '11222333000181'
+    assert rows[1]['chave_confere_codigo_barras'] == 'True'
+    assert rows[1]['flags_validacao'] == parquet['flags_validacao'][1]
+    assert parquet['valor_total'][1] == 30.0
+
+
+def test_ocr_stats_count_every_reading():
+    stats = index_nf.EstatisticasNotas()
+    n_configs = len(index_nf.OCR_CONFIGS)
+    # 3 páginas com 2 passadas cada; uma página refeita com 'heavy', todas as configs nas duas leituras
+    stats.add({'ocr_passadas': 6, 'ocr_leituras': 3, 'ocr_config': index_nf.OCR_CONFIGS[0]}, 'OK')
+    stats.add({'ocr_passadas': 2 * n_configs, 'ocr_leituras': 2, 'ocr_config': index_nf.OCR_CONFIGS[1]}, 'OK')
+    stats.add({'metodo_extracao': 'xml'}, 'OK')
+
+    ocr = stats.to_dict()['ocr']
+
+    assert (ocr['notas'], ocr['leituras'], ocr['passadas_executadas']) == (2, 5, 6 + 2 * n_configs)
+    assert ocr['passadas_economizadas'] == 3 * n_configs - 6
+
+
+def test_columnar_adds_dataset_to_requested_formats(tmp_path, monkeypatch, nfe_xml):
+    entradas, saida = tmp_path / 'entradas', tmp_path / 'saida'
+    entradas.mkdir()
+    (entradas / 'nf1.xml').write_text(nfe_xml(1)[1], encoding='utf-8')
+    monkeypatch.setattr(sys, 'argv', ['index_nf.py', str(entradas), '-o', str(saida), '-w', '1',
+                                      '--columnar', '--formats', 'csv'])
+    index_nf.main()
+
+    assert (saida / 'notas_fiscais.csv').exists()
+    assert not (saida / 'notas_fiscais.jsonl').exists()
+    assert len(pd.read_parquet(saida / 'dataset' / 'notas')) == 1
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Testes da partição em shards (--shard, --shard-by) e do merge dos journals (py/index_nf.py)"""
+
+import itertools
+import os
+
+import pytest
+
+import index_nf
+
+
+def make_tree(root):
+    """Árvore com subdiretórios, cópias do mesmo conteúdo e arquivos ignorados pela extensão"""
+    for d in range(4):
+        sub = root / f'lote{d}' / 'mes'
+        sub.mkdir(parents=True)
+        for k in range(10):
+            (sub / f'nf{k}.pdf').write_bytes(f'%PDF lote {d} nota {k}'.encode())
+        (sub / 'copia.pdf').write_bytes(b'%PDF mesmo conteudo')
+        (sub / 'leia.txt').write_text('fora do lote')
+    return root
+
+
+def listing(root, **kwargs):
+    return list(index_nf.iter_input_files([str(root)], **kwargs))
+
+
+@pytest.mark.parametrize('shard_by', ['path', 'hash'])
+def test_shards_cover_the_input_without_overlap(tmp_path, shard_by):
+    root = make_tree(tmp_path / 'entradas')
+    todos = listing(root)
+    total = 3
+
+    shards = [listing(root, shard=(i, total), shard_by=shard_by) for i in range(1, total + 1)]
+
+    assert len(todos) == 44
+    assert sorted(itertools.chain.from_iterable(shards)) == sorted(todos)
+    assert all(shard for shard in shards)
+
+
+def test_shard_by_path_is_independent_of_the_mount_point(tmp_path):
+    a, b = make_tree(tmp_path / 'a'), make_tree(tmp_path / 'b')
+
+    shard_a = [os.path.relpath(p, a) for p in listing(a, shard=(2, 3))]
+    shard_b = [os.path.relpath(p, b) for p in listing(b, shard=(2, 3))]
+
+    assert shard_a == shard_b
+
+
+def test_shard_by_hash_keeps_copies_together(tmp_path):
+    root = make_tree(tmp_path / 'entradas')
+    grande = os.urandom(index_nf.SHARD_HASH_PREFIXO + 1000)
+    (root / 'lote0' / 'grande.pdf').write_bytes(grande)
+    (root / 'lote3' / 'grande.pdf').write_bytes(grande)
+
+    shards = [listing(root, shard=(i, 5), shard_by='hash') for i in range(1, 6)]
+
+    for nome in ('copia.pdf', 'grande.pdf'):
+        com_copia = [i for i, shard in enumerate(shards) if any(p.endswith(os.sep + nome) for p in shard)]
+        assert len(com_copia) == 1
+    # Mesmo início, tamanhos diferentes: chaves diferentes
+    (root / 'lote3' / 'grande.pdf').write_bytes(grande + b'x')
+    assert (index_nf.shard_key(str(root / 'lote0' / 'grande.pdf'), str(root), 'hash') !=
+            index_nf.shard_key(str(root / 'lote3' / 'grande.pdf'), str(root), 'hash'))
+
+
+def nota(arquivo, chave, metodo, sha256):
+    invoice_data = {'arquivo': os.path.basename(arquivo), 'chave_acesso': chave,
+                    'metodo_extracao': metodo, 'sha256': sha256}
+    item = index_nf.ItemNota(chave_acesso=chave, arquivo=invoice_data['arquivo'], descricao=f'ITEM {metodo}',
+                             ncm=None, cfop=None, qtd=None, unidade=None, vl_unit=None, vl_total=15.0,
+                             linha_ocr='')
+    return invoice_data, [item]
+
+
+def write_journal(path, notas):
+    journal = index_nf.JournalProcessamento(str(path))
+    for arquivo, invoice_data, items in notas:
+        journal.pending(arquivo)
+        journal.done(arquivo, invoice_data, items)
+    journal.close()
+    return str(path)
+
+
+def test_merge_prefers_the_xml_note_for_the_same_chave(tmp_path, make_chave):
+    chave, outra = make_chave(1), make_chave(2)
+    pdf, xml, nf2 = (str(tmp_path / nome) for nome in ('a_nf1.pdf', 'z_nf1.xml', 'nf2.pdf'))
+    # A cópia em OCR vem antes pelo caminho e pelo sha256: só o método decide
+    shard1 = write_journal(tmp_path / 'j1.jsonl', [(pdf, *nota(pdf, chave, 'ocr', '0' * 64)),
+                                                    (nf2, *nota(nf2, outra, 'ocr', '1' * 64))])
+    shard2 = write_journal(tmp_path / 'j2.jsonl', [(xml, *nota(xml, chave, 'xml', 'f' * 64))])
+
+    for journals in ([shard1, shard2], [shard2, shard1]):
+        index_data, items_data, links = index_nf.merge_shard_journals(journals)
+
+        assert sorted((n['chave_acesso'], n['metodo_extracao']) for n in index_data) == sorted(
+            [(chave, 'xml'), (outra, 'ocr')])
+        assert sorted(i.descricao for i in items_data) == ['ITEM ocr', 'ITEM xml']
+        assert [(l['caminho'], l['canonico'], l['chave'], l['motivo']) for l in links] == [
+            (os.path.abspath(pdf), os.path.abspath(xml), chave, 'chave')]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Paridade da validação vetorizada (validate_invoices, check_digits_mask) com as
+regras por nota (validate_invoice_data, documento_valido) (py/index_nf.py)
+
+As duas implementações das regras convivem; entradas sorteadas com semente fixa
+cobrem os casos limite de cada regra para que não divirjam."""
+
+import random
+
+import pandas as pd
+
+import index_nf
+from conftest import chave_com_dv
+
+HOJE = '2026-10-17'
+DOCUMENTOS = [(index_nf.CNPJ_FORMATO_RX, index_nf.CNPJ_PESOS), (index_nf.CPF_FORMATO_RX, index_nf.CPF_PESOS)]
+
+
+def com_dvs(base, pesos):
+    """Acrescenta a ``base`` os DVs módulo 11 (um por conjunto de pesos)"""
+    digits = [ord(c) - 48 for c in base]
+    for w in pesos:
+        digits.append(index_nf.mod11_dv(digits, w))
+    return base + ''.join(str(d) for d in digits[len(base):])
+
+
+def random_digits(rng, n):
+    return ''.join(rng.choice('0123456789') for _ in range(n))
+
+
+def random_documento(rng):
+    """CNPJ/CPF válidos, alfanuméricos, com DV trocado, repetidos ou fora de formato"""
+    return rng.choice((
+        com_dvs(random_digits(rng, 12), index_nf.CNPJ_PESOS),
+        com_dvs(''.join(rng.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(12)), index_nf.CNPJ_PESOS),
+        com_dvs(random_digits(rng, 9), index_nf.CPF_PESOS),
+        com_dvs(random_digits(rng, 12), index_nf.CNPJ_PESOS)[:-1] + rng.choice('0123456789'),
+        com_dvs(random_digits(rng, 9), index_nf.CPF_PESOS)[:-1] + rng.choice('0123456789'),
+        rng.choice('0123456789') * rng.choice((11, 14)),
+        random_digits(rng, rng.choice((3, 13, 15))),
+        '12abc34501de00',
+    ))
+
+
+def test_documento_valido_matches_check_digits_mask():
+    rng = random.Random(22)
+    docs = [random_documento(rng) for _ in range(3000)]
+
+    esperado = [index_nf.documento_valido(doc) for doc in docs]
+
+    assert index_nf.check_digits_mask(pd.Series(docs), DOCUMENTOS).tolist() == esperado
+    assert any(esperado) and not all(esperado)
+
+
+def random_row(rng, i):
+    chave = chave_com_dv(random_digits(rng, 43))
+    return dict(
+        arquivo=f'nf{i}.pdf',
+        chave_acesso=rng.choice((chave, chave[:-1] + str((int(chave[-1]) + 1) % 10), None, '', 'abc')),
+        cnpj_emitente=rng.choice((random_documento(rng), None, '')),
+        cnpj_destinatario=rng.choice((random_documento(rng), None, '')),
+        valor_total=rng.choice((None, 0.0, 30.0, 55.5, float('nan'))),
+        itens_raw=rng.choice((None, '', 'PRODUTO 1')),
+        metodo_extracao=rng.choice(('xml', 'ocr')),
+        chave_confere_codigo_barras=rng.choice((None, True, False)),
+        data_emissao=rng.choice((None, '', '2023-05-01', '2023-5-1', '1999-12-31', '2023-02-30',
+                                 'lixo', HOJE, '2026-10-18')),
+    )
+
+
+def test_validate_invoices_matches_validate_invoice_data():
+    rng = random.Random(22)
+    rows, items = [], []
+    for i in range(2000):
+        row = random_row(rng, i)
+        rows.append(row)
+        items.append([index_nf.ItemNota(arquivo=row['arquivo'], chave_acesso=row['chave_acesso'],
+                                        descricao='PRODUTO', ncm=None, cfop=None, qtd=None, unidade=None,
+                                        vl_unit=None, vl_total=rng.choice((None, 15.0, 27.75)), linha_ocr='')
+                      for _ in range(rng.randint(0, 3))])
+    df_index = pd.DataFrame(rows)
+    df_items = pd.DataFrame([index_nf.asdict(item) for its in items for item in its])
+
+    esperado = [index_nf.validate_invoice_data(row, its, HOJE) for row, its in zip(rows, items)]
+
+    assert index_nf.validate_invoices(df_index, df_items, HOJE).tolist() == esperado
+    assert len(set(esperado)) > 20
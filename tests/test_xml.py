@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Testes da leitura direta de XML de NF-e e zips de XMLs (py/index_nf.py)"""
+
+import hashlib
+import zipfile
+from dataclasses import asdict
+
+import index_nf
+
+# NF-e avulsa mínima, sem namespace nem protocolo
+NFE_MINIMA = '''<NFe><infNFe Id="NFe{chave}">
+<ide><mod>55</mod><serie>3</serie><nNF>000123</nNF><dEmi>2023-05-10</dEmi></ide>
+<emit><CPF>12345678909</CPF><xNome>JOAO DA SILVA</xNome><enderEmit><xMun>CAMPINAS</xMun><UF>SP</UF></enderEmit></emit>
+<det nItem="1"><prod><xProd>PARAFUSO</xProd><NCM>73181500</NCM><CFOP>5102</CFOP><uCom>CX</uCom>
+<qCom>1.5000</qCom><vUnCom>10.0000</vUnCom><vProd>15.00</vProd></prod></det>
+<det nItem="2"><imposto/></det>
+<total><ICMSTot><vNF>15.00</vNF></ICMSTot></total>
+</infNFe></NFe>'''
+
+
+def parse_first(xml, arquivo='nf.xml', sha256='abc'):
+    root = index_nf.ET.fromstring(xml.encode('utf-8'))
+    inf = next(el for el in root.iter() if el.tag.rpartition('}')[2] == 'infNFe')
+    return index_nf.parse_nfe_element(inf, arquivo, sha256)
+
+
+def test_parse_nfe_element_minimal(make_chave):
+    chave = make_chave(123, serie=3)
+    invoice_data, items = parse_first(NFE_MINIMA.format(chave=chave))
+    
+    expected = {
+        'arquivo': 'nf.xml', 'tipo': 'NF-e', 'chave_acesso': chave, 'numero_nf': '123', 'serie': '3',
+        'data_emissao': '2023-05-10', 'cnpj_emitente': '12345678909', 'razao_emitente': 'JOAO DA SILVA',
+        'cnpj_destinatario': None, 'razao_destinatario': None, 'uf': 'SP', 'valor_total': 15.0,
+        'itens_raw': None, 'endereco_emitente': None, 'municipio_emitente': 'CAMPINAS', 'ie_emitente': None,
+        'mes_emissao': '2023-05', 'chave_valida': True, 'sha256': 'abc', 'metodo_extracao': 'xml',
+    }
+    assert {k: invoice_data[k] for k in expected} == expected
+    # Um det sem prod não vira item
+    assert [asdict(item) for item in items] == [{
+        'chave_acesso': chave, 'arquivo': 'nf.xml', 'descricao': 'PARAFUSO', 'ncm': '73181500', 'cfop': '5102',
+        'qtd': 1.5, 'unidade': 'CX', 'vl_unit': 10.0, 'vl_total': 15.0, 'linha_ocr': '',
+    }]
+
+
+def test_parse_nfe_element_invalid_chave(make_chave):
+    chave = make_chave(123)
+    invoice_data, _ = parse_first(NFE_MINIMA.format(chave=chave[:-1] + str((int(chave[-1]) + 1) % 10)))
+    assert invoice_data['chave_valida'] is False
+    assert invoice_data['mes_emissao'] is None
+    assert invoice_data['numero_nf'] == '123'
+
+
+def test_parse_nfe_element_with_namespace(nfe_xml):
+    chave, xml = nfe_xml(7, itens=3)
+    invoice_data, items = parse_first(xml)
+    assert invoice_data['chave_acesso'] == chave
+    assert invoice_data['cnpj_destinatario'] == '45997418000153'
+    assert invoice_data['endereco_emitente'] == 'RUA DAS FLORES, 123'
+    assert invoice_data['valor_total'] == 45.0
+    assert [item.descricao for item in items] == ['PRODUTO 1', 'PRODUTO 2', 'PRODUTO 3']
+
+
+def test_read_xml_documents_file_and_zip(tmp_path, nfe_xml):
+    chave1, xml1 = nfe_xml(1)
+    chave2, xml2 = nfe_xml(2)
+    path = tmp_path / 'nf1.xml'
+    path.write_text(xml1, encoding='utf-8')
+    
+    [(invoice_data, items)] = index_nf.read_xml_documents(str(path))
+    assert invoice_data['chave_acesso'] == chave1
+    assert invoice_data['sha256'] == hashlib.sha256(path.read_bytes()).hexdigest()
+    assert len(items) == 2
+    
+    lote = tmp_path / 'lote.zip'
+    with zipfile.ZipFile(lote, 'w') as archive:
+        archive.writestr('nfe/nf1.xml', xml1)
+        archive.writestr('nfe/nf2.xml', xml2)
+        archive.writestr('nfe/quebrado.xml', '<NFe><infNFe>')
+        archive.writestr('leiame.txt', 'sem notas')
+    docs = index_nf.read_xml_documents(str(lote))
+    assert [(d['arquivo'], d['chave_acesso']) for d, _ in docs] == [
+        ('lote.zip#nf1.xml', chave1), ('lote.zip#nf2.xml', chave2)]
+    assert docs[1][0]['sha256'] == hashlib.sha256(xml2.encode('utf-8')).hexdigest()